@@ -24,7 +24,7 @@ This module provides all Django-admins of the lti_provider-App.
 """
 from django.contrib import admin
 
-from lti_provider.models import Consumer
+from lti_provider.models import Consumer, Platform
 
 
 class ConsumerAdmin(admin.ModelAdmin):
@@ -36,4 +36,14 @@ class ConsumerAdmin(admin.ModelAdmin):
     search_fields = ['key', 'user', ]
 
 
+class PlatformAdmin(admin.ModelAdmin):
+    """
+    Adds the Platform model to the admin site. It is used to register LTI
+    1.3 platforms.
+    """
+    list_display = ('issuer', 'client_id', 'consumer',)
+    search_fields = ['issuer', 'client_id', ]
+
+
 admin.site.register(Consumer, ConsumerAdmin)
+admin.site.register(Platform, PlatformAdmin)
@@ -32,4 +32,16 @@ class LTIProviderConfig(AppConfig):
     sets some metadata
     """
     name = 'lti_provider'
+    default_auto_field = 'django.db.models.AutoField'
     verbose_name = _('LTI Provider')
+
+    def ready(self):
+        """
+        connects the signal handlers, registers the checks, compiles
+        PARAMETERS_TO_VIEW and resolves HOOK_AFTER_USER_CREATION, so
+        configuration errors are raised at startup
+        """
+        from lti_provider import checks, hooks, metrics, signals  # noqa: F401
+        from lti_provider.redirects import get_redirect_table
+        get_redirect_table()
+        hooks.load()
@@ -25,87 +25,374 @@ This module provides backends for the lti_provider.
 
 from hashlib import sha1
 
+from asgiref.sync import sync_to_async
 from django.core.exceptions import PermissionDenied
-from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
 
-from lti_provider.utils import get_by_py_path
-from lti_provider.validators import LTIValidator
+from lti_provider import usercache
+from lti_provider.cache import consumer_cache
+from lti_provider.groups import format_group_ids, group_cache, \
+    parse_group_ids, role_groups
+from lti_provider.lti13 import PlatformLaunch
+from lti_provider.models import LTIIdentity
+from lti_provider.hooks import run_hook_after_user_creation
+from lti_provider.metrics import measure, outcome
+from lti_provider.outcomes import arecord_result, record_result
+from lti_provider.validators import AsyncLTIValidator, LTIValidator
 
 User = get_user_model()
 
+PROVISIONING_ATTEMPTS = 3
+
+
+def get_launch_user(params):
+    """
+    Returns a tuple of the sha1 hex digest of the LTI user_id and a
+    dictionary of the user attributes of launch parameters. Raises a
+    KeyError if the user_id or the email address is missing.
+
+    Keyword arguments:
+        - params -- the launch parameters
+    """
+    uid = params['user_id']
+    profile = {'email': params['lis_person_contact_email_primary']}
+    try:
+        profile['first_name'] = params['lis_person_name_given'][:30]
+    except KeyError:
+        pass
+    try:
+        profile['last_name'] = params['lis_person_name_family'][:30]
+    except KeyError:
+        pass
+    return sha1(uid.encode('utf-8')).hexdigest(), profile
+
+
+def get_username(uid_hash, profile):
+    """
+    Returns the username of a new LTI user.
+
+    Keyword arguments:
+        - uid_hash -- sha1 hex digest of the LTI user_id
+        - profile -- dictionary of user attributes from the request
+    """
+    return (profile['email'] + '_' + uid_hash)[:120]
+
+
+def new_user_defaults(profile):
+    """
+    Returns the attributes of a new LTI user.
+
+    Keyword arguments:
+        - profile -- dictionary of user attributes from the request
+    """
+    defaults = {
+        'password': make_password(None),
+        'first_name': 'LTI',
+        'last_name': 'LTI',
+    }
+    defaults.update(profile)
+    return defaults
+
 
 class LTIAuthBackend(object):
     """
     This is a authentication backend for LTI.
     """
 
-    def authenticate(self, request, tool_provider=None):
+    def authenticate(self, request, tool_provider=None, launch=None):
         """
-        Authenticates a user via a LTI request from a consumer.
+        Authenticates a user via a LTI request from a consumer or a verified
+        LTI 1.3 launch of a platform.
 
         Keyword arguments:
             - request -- the HttpRequest
             - tool_provider -- the LTI tool provider instance
+            - launch -- the PlatformLaunch of a LTI 1.3 launch
         """
+        if isinstance(launch, PlatformLaunch):
+            # the id_token was verified by lti13.verify_launch
+            with measure('resolve_user'):
+                return self.resolve_user(launch.tool_provider)
         if not tool_provider:
             return None
 
-        validator = LTIValidator()
-        ok = tool_provider.is_valid_request(validator)
+        validator = LTIValidator(defer_nonce=True)
+        with measure('verify'):
+            ok = tool_provider.is_valid_request(validator)
+        # the nonce is recorded after the signature was verified
+        if ok:
+            with measure('nonce'):
+                ok = validator.record_nonce()
         if not ok:
+            outcome(validator.failure_reason())
             raise PermissionDenied
 
-        try:
-            uid = tool_provider.launch_params['user_id']
-        except KeyError:
-            raise PermissionDenied
-        try:
-            email = tool_provider.launch_params[
-                'lis_person_contact_email_primary']
-        except KeyError:
+        with measure('resolve_user'):
+            return self.resolve_user(tool_provider)
+
+    def resolve_user(self, tool_provider):
+        """
+        Returns the user of a validated LTI request. The user is created if
+        it does not exist and its profile is updated otherwise.
+
+        Keyword arguments:
+            - tool_provider -- the validated LTI tool provider instance
+        """
+        uid_hash, profile = self.get_launch_user(tool_provider)
+        consumer = consumer_cache.get(
+            tool_provider.launch_params.get('oauth_consumer_key'))
+        if consumer is None:
+            outcome('unknown_consumer')
             raise PermissionDenied
-        try:
-            given_name = tool_provider.launch_params['lis_person_name_given']
-        except KeyError:
-            given_name = 'LTI'
-        try:
-            family_name = tool_provider.launch_params['lis_person_name_family']
-        except KeyError:
-            family_name = 'LTI'
 
-        username = email + '_' + sha1(uid.encode('utf-8')).hexdigest()
-        username = username[:120]
-        user = None
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            user = User(username=username, password='LTI user')
-            user.set_unusable_password()
-            user.email = email
-            user.first_name = given_name[:30]
-            user.last_name = family_name[:30]
-            user.save()
+        for attempt in range(PROVISIONING_ATTEMPTS):
+            try:
+                with measure('lookup'):
+                    identity = LTIIdentity.objects.select_related(
+                        'user').get(consumer=consumer, uid_hash=uid_hash)
+                user, created = identity.user, False
+                break
+            except LTIIdentity.DoesNotExist:
+                identity = None
             try:
-                hook = get_by_py_path(
-                    settings.LTI_PROVIDER['HOOK_AFTER_USER_CREATION'])
-                hook(user)
-            except KeyError:
-                pass
+                with measure('provision'):
+                    user, created = self.provision_user(
+                        consumer, uid_hash, profile)
+                break
+            except IntegrityError:
+                # a concurrent launch created the rows first, look them up
+                if attempt == PROVISIONING_ATTEMPTS - 1:
+                    raise
 
-        if not user:
+        if created:
+            self.run_hook(user)
+        else:
+            self.save_profile(user, profile)
+
+        if role_groups():
+            self.sync_groups(consumer, uid_hash, user, identity,
+                             tool_provider.launch_params.get('roles'))
+        record_result(consumer, user, tool_provider.launch_params)
+        return user
+
+    async def aauthenticate(self, request, tool_provider=None):
+        """
+        Async version of authenticate used by the async launch view. The
+        consumer, the nonce and a returning user are handled with the async
+        ORM. Creating a new user needs a transaction which the async ORM
+        does not support, so it runs provision_user and the hook in a
+        thread.
+
+        Keyword arguments:
+            - request -- the HttpRequest
+            - tool_provider -- the LTI tool provider instance
+        """
+        if not tool_provider:
+            return None
+
+        validator = AsyncLTIValidator()
+        with measure('verify'):
+            await validator.aprepare(
+                tool_provider.launch_params.get('oauth_consumer_key'),
+                tool_provider.launch_params.get('oauth_timestamp'),
+                tool_provider.launch_params.get('oauth_nonce'))
+            # HMAC signatures are cheap, so they are verified in the event loop
+            ok = tool_provider.is_valid_request(validator)
+        if ok:
+            with measure('nonce'):
+                ok = await validator.arecord_nonce()
+        if not ok:
+            outcome(validator.failure_reason())
             raise PermissionDenied
 
+        with measure('resolve_user'):
+            return await self.aresolve_user(tool_provider, validator.consumer)
+
+    async def aresolve_user(self, tool_provider, consumer):
+        """
+        Async version of resolve_user.
+
+        Keyword arguments:
+            - tool_provider -- the validated LTI tool provider instance
+            - consumer -- the consumer of the request
+        """
+        uid_hash, profile = self.get_launch_user(tool_provider)
+
+        for attempt in range(PROVISIONING_ATTEMPTS):
+            try:
+                with measure('lookup'):
+                    identity = await LTIIdentity.objects.select_related(
+                        'user').aget(consumer=consumer, uid_hash=uid_hash)
+                user, created = identity.user, False
+                break
+            except LTIIdentity.DoesNotExist:
+                identity = None
+            try:
+                with measure('provision'):
+                    user, created = await sync_to_async(
+                        self.provision_user)(consumer, uid_hash, profile)
+                break
+            except IntegrityError:
+                if attempt == PROVISIONING_ATTEMPTS - 1:
+                    raise
+
+        if created:
+            await sync_to_async(self.run_hook)(user)
+        else:
+            await self.asave_profile(user, profile)
+
+        if role_groups():
+            await sync_to_async(self.sync_groups)(
+                consumer, uid_hash, user, identity,
+                tool_provider.launch_params.get('roles'))
+        await arecord_result(consumer, user, tool_provider.launch_params)
         return user
 
+    def get_launch_user(self, tool_provider):
+        """
+        Returns a tuple of the sha1 hex digest of the LTI user_id and a
+        dictionary of the user attributes sent with the request.
+
+        Keyword arguments:
+            - tool_provider -- the LTI tool provider instance
+        """
+        try:
+            return get_launch_user(tool_provider.launch_params)
+        except KeyError:
+            outcome('missing_parameter')
+            raise PermissionDenied
+
+    def run_hook(self, user):
+        """
+        Calls HOOK_AFTER_USER_CREATION with a new user if it is configured.
+        It is resolved once and executed according to HOOK_MODE.
+
+        Keyword arguments:
+            - user -- the created user
+        """
+        run_hook_after_user_creation(user)
+
+    def sync_groups(self, consumer, uid_hash, user, identity, roles):
+        """
+        Adds the user to the groups mapped to the roles of a launch by
+        ROLE_GROUPS and removes it from the mapped groups of the previous
+        launch which are not mapped anymore. The IDs of the groups are
+        stored with the identity, so nothing is written if they did not
+        change.
+
+        Keyword arguments:
+            - consumer -- the consumer of the request
+            - uid_hash -- sha1 hex digest of the LTI user_id
+            - user -- the user of the launch
+            - identity -- the identity found before the launch or None if
+              it was created by the launch
+            - roles -- the roles of the launch
+        """
+        if isinstance(roles, str):
+            roles = roles.split(',')
+        group_ids = group_cache.group_ids(roles or ())
+        previous = parse_group_ids(identity.role_groups if identity else '')
+        if group_ids == previous:
+            return
+        with transaction.atomic():
+            if previous - group_ids:
+                user.groups.remove(*(previous - group_ids))
+            if group_ids - previous:
+                user.groups.add(*(group_ids - previous))
+            LTIIdentity.objects.filter(
+                consumer=consumer, uid_hash=uid_hash).update(
+                    role_groups=format_group_ids(group_ids))
+        # the groups change without post_save of the user, whose cached
+        # copy may hold the permissions of the old groups
+        if usercache.enabled():
+            usercache.user_cache.invalidate(user.pk)
+
+    def provision_user(self, consumer, uid_hash, profile):
+        """
+        Creates the identity of a user and returns a tuple of the user and a
+        flag if the user was created. Users created before the identities
+        existed are found by their username. Both rows are written in one
+        transaction, so an IntegrityError caused by a concurrent launch
+        leaves nothing behind and the caller could look up the rows of the
+        other launch.
+
+        Keyword arguments:
+            - consumer -- the consumer of the request
+            - uid_hash -- sha1 hex digest of the LTI user_id
+            - profile -- dictionary of user attributes from the request
+        """
+        with transaction.atomic():
+            user, created = User.objects.get_or_create(
+                username=get_username(uid_hash, profile),
+                defaults=new_user_defaults(profile))
+            LTIIdentity.objects.create(
+                consumer=consumer, uid_hash=uid_hash, user=user)
+        return user, created
+
+    def save_profile(self, user, profile):
+        """
+        Updates the attributes of a user which differ from the request with
+        a single UPDATE of the changed fields. Nothing is written if the
+        attributes did not change.
+
+        Keyword arguments:
+            - user -- the user to update
+            - profile -- dictionary of user attributes from the request
+        """
+        changed = self.update_profile(user, profile)
+        if changed:
+            user.save(update_fields=changed)
+
+    async def asave_profile(self, user, profile):
+        """
+        Async version of save_profile.
+
+        Keyword arguments:
+            - user -- the user to update
+            - profile -- dictionary of user attributes from the request
+        """
+        changed = self.update_profile(user, profile)
+        if changed:
+            await user.asave(update_fields=changed)
+
+    def update_profile(self, user, profile):
+        """
+        Sets the attributes of a user which differ from the request and
+        returns the names of the changed fields.
+
+        Keyword arguments:
+            - user -- the user to update
+            - profile -- dictionary of user attributes from the request
+        """
+        changed = []
+        for field, value in profile.items():
+            if getattr(user, field) != value:
+                setattr(user, field, value)
+                changed.append(field)
+        return changed
+
     def get_user(self, user_id):
         """
-        Returns a user object.
+        Returns a user object. If USER_CACHING is enabled, the user is read
+        from the user cache and memoized for the rest of the request.
 
         Keyword arguments:
             - user_id -- the id of the user to return
         """
         try:
-            return User.objects.get(pk=user_id)
+            if usercache.enabled():
+                return usercache.user_cache.get(user_id, self.load_user)
+            return self.load_user(user_id)
         except User.DoesNotExist:
             return None
+
+    def load_user(self, user_id):
+        """
+        Returns the user with the given id from the database.
+
+        Keyword arguments:
+            - user_id -- the id of the user to return
+        """
+        return User.objects.get(pk=user_id)
@@ -0,0 +1,436 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides benchmarks of the launch of the lti_provider-App. They
+generate signed launch requests locally, drive them through the Django test
+client and check the number of queries per launch against a budget. The
+nonce stores are compared by insert and replay cost and size on disk and
+the page views of a logged in user with and without the user cache.
+"""
+
+import random
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY,
+                                 SESSION_KEY, get_user, login)
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import PermissionDenied
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from lti import ToolConsumer
+from lti.contrib.django import DjangoToolProvider
+
+from lti_provider import usercache
+from lti_provider.backends import LTIAuthBackend
+from lti_provider.models import Consumer, NonceDigest, TimestampAndNonce
+from lti_provider.nonces import (CompactNonceStore, ModelNonceStore,
+                                 nonce_digest)
+from lti_provider.prevalidation import prevalidate
+from lti_provider.validators import LTIValidator
+from lti_provider.views import redirect_to_destination
+
+SCENARIOS = ('new_user', 'returning_user', 'bad_signature', 'replayed_nonce',
+             'unknown_consumer', 'malformed')
+
+# maximum queries of a launch in autocommit mode, measured with SQLite which
+# also reports BEGIN and COMMIT; an unknown consumer needs no query with
+# PREVALIDATION once its key is remembered
+QUERY_BUDGETS = {
+    'new_user': 21,
+    'returning_user': 14,
+    'bad_signature': 1,
+    'replayed_nonce': 1,
+    'unknown_consumer': 1,
+    'malformed': 0,
+}
+
+PHASES = ('prevalidate', 'parse', 'verify', 'nonce', 'resolve_user',
+          'login', 'redirect')
+
+
+def signed_launch_data(consumer, launch_url, **params):
+    """
+    Returns the POST data of a launch request signed by the consumer.
+
+    Keyword arguments:
+        - consumer -- the consumer signing the request
+        - launch_url -- absolute URL of the launch view
+        - params -- launch parameters overriding the defaults
+    """
+    launch_params = {
+        'lti_message_type': 'basic-lti-launch-request',
+        'lti_version': 'LTI-1p0',
+        'resource_link_id': '1',
+        'user_id': '42',
+        'lis_person_name_given': 'Jane',
+        'lis_person_name_family': 'Doe',
+        'lis_person_contact_email_primary': 'jane@example.com',
+    }
+    launch_params.update(params)
+    tool_consumer = ToolConsumer(consumer_key=consumer.key,
+                                 consumer_secret=consumer.secret,
+                                 launch_url=launch_url,
+                                 params=launch_params)
+    return tool_consumer.generate_launch_data()
+
+
+class LaunchBenchmark(object):
+    """
+    Runs the launch scenarios of a consumer.
+    """
+
+    def __init__(self, consumer, host='testserver'):
+        """
+        Keyword arguments:
+            - consumer -- the consumer sending the launches
+            - host -- host of the requests, has to be allowed
+        """
+        self.consumer = consumer
+        self.host = host
+        self.path = reverse('lti_provider.views.lti_launch')
+        self.launch_url = 'http://%s%s' % (host, self.path)
+        self.counter = 0
+        self.replay = None
+
+    def launch_data(self, scenario):
+        """
+        Returns the POST data of the next launch of a scenario.
+
+        Keyword arguments:
+            - scenario -- one of SCENARIOS
+        """
+        self.counter += 1
+        if scenario == 'new_user':
+            uid = 'benchmark-%d-%d' % (time.time_ns(), self.counter)
+            return signed_launch_data(
+                self.consumer, self.launch_url, user_id=uid,
+                lis_person_contact_email_primary=uid + '@example.com')
+        if scenario == 'returning_user':
+            return signed_launch_data(self.consumer, self.launch_url,
+                                      user_id='benchmark-returning')
+        if scenario == 'bad_signature':
+            data = signed_launch_data(self.consumer, self.launch_url)
+            data['user_id'] = 'tampered'
+            return data
+        if scenario == 'replayed_nonce':
+            if self.replay is None:
+                self.replay = signed_launch_data(self.consumer,
+                                                 self.launch_url)
+            return self.replay
+        if scenario == 'unknown_consumer':
+            unknown = Consumer(key='unknownkey0123456789',
+                               secret='unknownsecret0123456789')
+            return signed_launch_data(unknown, self.launch_url)
+        if scenario == 'malformed':
+            data = signed_launch_data(self.consumer, self.launch_url)
+            del data['resource_link_id']
+            return data
+        raise ValueError('unknown scenario %s' % scenario)
+
+    def run(self, scenario, n):
+        """
+        Runs n launches of a scenario through the test client after two
+        warm up launches and returns a dictionary of the results.
+
+        Keyword arguments:
+            - scenario -- one of SCENARIOS
+            - n -- number of launches
+        """
+        client = Client(HTTP_HOST=self.host)
+        for i in range(2):
+            client.post(self.path, self.launch_data(scenario))
+        data = [self.launch_data(scenario) for i in range(n)]
+        queries = 0
+        max_queries = 0
+        start = time.perf_counter()
+        for d in data:
+            with CaptureQueriesContext(connection) as captured:
+                client.post(self.path, d)
+            queries += len(captured)
+            max_queries = max(max_queries, len(captured))
+        duration = time.perf_counter() - start
+        return {
+            'scenario': scenario,
+            'launches': n,
+            'seconds': duration,
+            'launches_per_second': n / duration if duration > 0 else 0.0,
+            'queries': queries / n if n else 0.0,
+            'max_queries': max_queries,
+            'budget': QUERY_BUDGETS[scenario],
+        }
+
+    def run_phases(self, scenario, n):
+        """
+        Runs n launches of a scenario phase by phase without the middleware
+        and returns the mean seconds of each phase. Rejected launches stop
+        after the pre-validation or the verification.
+
+        Keyword arguments:
+            - scenario -- one of SCENARIOS
+            - n -- number of launches
+        """
+        factory = RequestFactory(HTTP_HOST=self.host)
+        engine = import_module(settings.SESSION_ENGINE)
+        backend = LTIAuthBackend()
+        totals = dict((phase, 0.0) for phase in PHASES)
+        self.launch_data(scenario)
+        for i in range(n):
+            request = factory.post(self.path, self.launch_data(scenario))
+            request.session = engine.SessionStore()
+            request.user = AnonymousUser()
+
+            start = time.perf_counter()
+            rejected = prevalidate(request)
+            prevalidated = time.perf_counter()
+            totals['prevalidate'] += prevalidated - start
+            if rejected:
+                continue
+            tool_provider = DjangoToolProvider.from_django_request(
+                request=request)
+            parsed = time.perf_counter()
+            validator = LTIValidator(defer_nonce=True)
+            ok = tool_provider.is_valid_request(validator)
+            checked = time.perf_counter()
+            ok = ok and validator.record_nonce()
+            verified = time.perf_counter()
+            totals['parse'] += parsed - prevalidated
+            totals['verify'] += checked - parsed
+            totals['nonce'] += verified - checked
+            if not ok:
+                continue
+            try:
+                user = backend.resolve_user(tool_provider)
+            except PermissionDenied:
+                continue
+            resolved = time.perf_counter()
+            login(request, user,
+                  backend='lti_provider.backends.LTIAuthBackend')
+            request.session.save()
+            logged_in = time.perf_counter()
+            redirect_to_destination(tool_provider)
+            redirected = time.perf_counter()
+            totals['resolve_user'] += resolved - verified
+            totals['login'] += logged_in - resolved
+            totals['redirect'] += redirected - logged_in
+        return dict((phase, totals[phase] / n if n else 0.0)
+                    for phase in PHASES)
+
+
+class PageViewBenchmark(object):
+    """
+    Runs page views of a logged in LTI user through the
+    AuthenticationMiddleware with and without USER_CACHING. The view reads
+    request.user and calls django.contrib.auth.get_user once more, like
+    code which authenticates the request on its own.
+    """
+
+    def __init__(self, user, host='testserver'):
+        """
+        Keyword arguments:
+            - user -- the logged in user
+            - host -- host of the requests, has to be allowed
+        """
+        self.factory = RequestFactory(HTTP_HOST=host)
+        self.engine = import_module(settings.SESSION_ENGINE)
+        session = self.engine.SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = \
+            'lti_provider.backends.LTIAuthBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        self.session_key = session.session_key
+        self.middleware = AuthenticationMiddleware(self.view)
+
+    def view(self, request):
+        """
+        The view of a page of the logged in user.
+        """
+        if not request.user.is_authenticated or \
+                get_user(request).pk != request.user.pk:
+            raise PermissionDenied
+        return HttpResponse()
+
+    def page_view(self):
+        """
+        Runs a page view in a request scope of the user cache.
+        """
+        request = self.factory.get('/')
+        request.session = self.engine.SessionStore(self.session_key)
+        usercache.start_request()
+        try:
+            return self.middleware(request)
+        finally:
+            usercache.finish_request()
+
+    def run(self, cached, n):
+        """
+        Runs n page views after a warm up view and returns a dictionary of
+        the results.
+
+        Keyword arguments:
+            - cached -- flag if USER_CACHING is enabled
+            - n -- number of page views
+        """
+        lti_settings = dict(getattr(settings, 'LTI_PROVIDER', {}),
+                            USER_CACHING=cached)
+        with override_settings(LTI_PROVIDER=lti_settings):
+            self.page_view()
+            queries = 0
+            start = time.perf_counter()
+            for i in range(n):
+                with CaptureQueriesContext(connection) as captured:
+                    self.page_view()
+                queries += len(captured)
+            duration = time.perf_counter() - start
+        return {
+            'variant': 'cached' if cached else 'uncached',
+            'views': n,
+            'seconds': duration,
+            'views_per_second': n / duration if duration > 0 else 0.0,
+            'queries': queries / n if n else 0.0,
+        }
+
+
+# the compared nonce stores and their models
+NONCE_STORES = (
+    ('model', ModelNonceStore, TimestampAndNonce),
+    ('compact', CompactNonceStore, NonceDigest),
+)
+
+
+class NonceBenchmark(object):
+    """
+    Fills the tables of the nonce stores with the same requests and
+    measures recording new nonces, rejecting replays and the size of the
+    tables including their indexes.
+    """
+
+    def __init__(self, consumer, requests_per_second=100, seed=0):
+        """
+        Keyword arguments:
+            - consumer -- the consumer of the requests
+            - requests_per_second -- rate of the generated timestamps
+            - seed -- seed of the generated nonces
+        """
+        self.consumer = consumer
+        self.requests_per_second = requests_per_second
+        self.random = random.Random(seed)
+        self.now = int(time.time())
+
+    def nonce(self):
+        """
+        Returns a random nonce like the ones of the lti package.
+        """
+        return '%032x' % self.random.getrandbits(128)
+
+    def fill(self, rows, batch_size=50000):
+        """
+        Inserts rows requests into the tables of all stores, ending at the
+        current time.
+
+        Keyword arguments:
+            - rows -- number of requests
+            - batch_size -- rows per insert
+        """
+        bucket_seconds = CompactNonceStore().bucket_seconds
+        first = self.now - rows // self.requests_per_second
+        for offset in range(0, rows, batch_size):
+            batch = [(first + i // self.requests_per_second, self.nonce())
+                     for i in range(offset, min(offset + batch_size, rows))]
+            with transaction.atomic():
+                TimestampAndNonce.objects.bulk_create([
+                    TimestampAndNonce(consumer=self.consumer,
+                                      timestamp=timestamp, nonce=nonce)
+                    for timestamp, nonce in batch])
+                NonceDigest.objects.bulk_create([
+                    NonceDigest(digest=nonce_digest(self.consumer.pk,
+                                                    timestamp, nonce),
+                                bucket=timestamp // bucket_seconds)
+                    for timestamp, nonce in batch], ignore_conflicts=True)
+
+    def run(self, name, n):
+        """
+        Records n new nonces with a store and replays them and returns a
+        dictionary of the microseconds per insert and replay and the size.
+
+        Keyword arguments:
+            - name -- the name of the store in NONCE_STORES
+            - n -- number of nonces
+        """
+        store_class, model = [(s, m) for key, s, m in NONCE_STORES
+                              if key == name][0]
+        store = store_class()
+        nonces = [self.nonce() for i in range(n)]
+        timestamp = str(self.now)
+
+        start = time.perf_counter()
+        for nonce in nonces:
+            store.add(self.consumer, timestamp, nonce, 600)
+        inserted = time.perf_counter()
+        for nonce in nonces:
+            store.add(self.consumer, timestamp, nonce, 600)
+        replayed = time.perf_counter()
+        return {
+            'store': name,
+            'rows': model.objects.count(),
+            'insert_us': (inserted - start) / n * 1e6 if n else 0.0,
+            'replay_us': (replayed - inserted) / n * 1e6 if n else 0.0,
+            'bytes': table_size(model),
+        }
+
+
+def table_size(model):
+    """
+    Returns the bytes of the table of a model including its indexes or None
+    if the size is unknown for the database.
+
+    Keyword arguments:
+        - model -- the model class
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+                    '(SELECT name FROM sqlite_master WHERE tbl_name = %s)',
+                    [table])
+            except Exception:
+                # SQLite without the dbstat virtual table
+                return None
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT data_length + index_length FROM '
+                'information_schema.tables WHERE table_schema = DATABASE() '
+                'AND table_name = %s', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row else None
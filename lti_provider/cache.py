@@ -0,0 +1,326 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the in-process caches of the lti_provider-App: the
+consumers used by the validators and the tool configurations.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import get_script_prefix, reverse
+from lti import ToolConfig
+
+from lti_provider.models import Consumer
+from lti_provider.routers import consumer_read_database
+from lti_provider.utils import get_setting
+
+# key of the generation of the consumers in the default cache, replaced
+# whenever a consumer is saved or deleted in any process
+CONSUMER_GENERATION_KEY = 'lti_provider:consumer_generation'
+
+
+def shared_consumer_generation():
+    """
+    Returns the generation of the consumers shared by all processes or None
+    if no consumer changed since the cache was cleared.
+    """
+    return caches['default'].get(CONSUMER_GENERATION_KEY)
+
+
+def mark_consumers_changed():
+    """
+    Replaces the shared generation of the consumers, so the unknown keys
+    remembered by all processes are forgotten.
+    """
+    caches['default'].set(CONSUMER_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+class ConsumerCache(object):
+    """
+    A per-process cache of consumers identified by their key. Entries expire
+    after CONSUMER_CACHE_TTL seconds and the least recently used entries are
+    evicted if more than CONSUMER_CACHE_SIZE consumers are cached. Unknown
+    keys are not cached for get, but the last UNKNOWN_KEY_CACHE_SIZE of them
+    are remembered for the pre-validation of a launch (is_unknown). The
+    cache is cleared by the signal handlers in lti_provider.signals whenever
+    a consumer is saved or deleted. An unknown key is remembered with the
+    shared generation of the consumers in the default cache, so a consumer
+    created by another process is no longer rejected as unknown.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        Creates an empty cache.
+
+        Keyword arguments:
+            - clock -- callable returning the current time in seconds
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._unknown = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ttl(self):
+        """
+        Returns the time to live of an entry in seconds. 0 disables caching.
+        """
+        return get_setting('CONSUMER_CACHE_TTL', 300)
+
+    @property
+    def max_size(self):
+        """
+        Returns the maximum number of cached consumers.
+        """
+        return get_setting('CONSUMER_CACHE_SIZE', 1000)
+
+    @property
+    def max_unknown(self):
+        """
+        Returns the maximum number of remembered unknown keys.
+        """
+        return get_setting('UNKNOWN_KEY_CACHE_SIZE', 10000)
+
+    def get(self, key):
+        """
+        Returns the consumer with the given key or None if it does not exist.
+
+        Keyword arguments:
+            - key -- the key of the consumer
+        """
+        hit, consumer, generation = self._lookup(key)
+        if hit:
+            return consumer
+        try:
+            consumer = Consumer.objects.using(
+                consumer_read_database()).get(key=key)
+        except Consumer.DoesNotExist:
+            self._store_unknown(key, generation)
+            return None
+        self._store(key, consumer, generation)
+        return consumer
+
+    async def aget(self, key):
+        """
+        Async version of get which loads missing consumers with the async
+        ORM.
+
+        Keyword arguments:
+            - key -- the key of the consumer
+        """
+        hit, consumer, generation = self._lookup(key)
+        if hit:
+            return consumer
+        try:
+            consumer = await Consumer.objects.using(
+                consumer_read_database()).aget(key=key)
+        except Consumer.DoesNotExist:
+            self._store_unknown(key, generation)
+            return None
+        self._store(key, consumer, generation)
+        return consumer
+
+    def _lookup(self, key):
+        """
+        Returns a tuple of a hit flag, the cached consumer and the generation
+        of the cache.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0], self._generation
+            self.misses += 1
+            return False, None, self._generation
+
+    def _store(self, key, consumer, generation):
+        """
+        Caches a loaded consumer unless the cache was cleared while it was
+        loaded.
+        """
+        ttl = self.ttl
+        if ttl <= 0:
+            return
+        expires = self._clock() + ttl
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (consumer, expires)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def _store_unknown(self, key, generation):
+        """
+        Remembers a key which does not exist unless the cache was cleared
+        while it was looked up.
+        """
+        ttl = self.ttl
+        if ttl <= 0:
+            return
+        expires = self._clock() + ttl
+        shared = shared_consumer_generation()
+        with self._lock:
+            if generation == self._generation:
+                self._unknown[key] = (expires, shared)
+                self._unknown.move_to_end(key)
+                while len(self._unknown) > self.max_unknown:
+                    self._unknown.popitem(last=False)
+
+    def is_unknown(self, key):
+        """
+        Returns true if the key was recently looked up and does not exist.
+        It never accesses the database; only for remembered keys the shared
+        generation is read from the default cache.
+
+        Keyword arguments:
+            - key -- the key of the consumer
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._unknown.get(key)
+        if entry is None or entry[0] <= now:
+            return False
+        if entry[1] != shared_consumer_generation():
+            # a consumer was saved by another process since
+            with self._lock:
+                self._unknown.pop(key, None)
+            return False
+        return True
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._unknown.clear()
+            self._generation += 1
+
+    def stats(self):
+        """
+        Returns a dictionary with the hits, misses and size of the cache and
+        the number of remembered unknown keys.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'unknown': len(self._unknown),
+            }
+
+
+consumer_cache = ConsumerCache()
+
+
+class ToolConfigEntry(object):
+    """
+    The cached tool configuration of a host. The ETag is computed from the
+    values of the configuration, so a conditional request could be answered
+    without generating the XML.
+    """
+
+    def __init__(self, title, description, launch_url):
+        """
+        Keyword arguments:
+            - title -- title of the tool
+            - description -- description of the tool
+            - launch_url -- absolute URL of the launch view
+        """
+        self.title = title
+        self.description = description
+        self.launch_url = launch_url
+        self.etag = sha1('\n'.join(
+            (title, description, launch_url)).encode('utf-8')).hexdigest()
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        self._xml = None
+
+    @property
+    def xml(self):
+        """
+        Returns the XML of the tool configuration, generated once.
+        """
+        if self._xml is None:
+            self._xml = ToolConfig(
+                title=self.title,
+                launch_url=self.launch_url,
+                secure_launch_url=self.launch_url,
+                description=self.description
+            ).to_xml()
+        return self._xml
+
+
+class ToolConfigCache(object):
+    """
+    A per-process cache of the tool configurations by scheme and host. It
+    is cleared by the signal handlers in lti_provider.signals whenever the
+    settings change and is empty after a restart.
+    """
+
+    def __init__(self, max_size=100):
+        """
+        Keyword arguments:
+            - max_size -- maximum number of cached hosts
+        """
+        self.max_size = max_size
+        self._entries = {}
+
+    def get(self, request):
+        """
+        Returns the tool configuration for the host of a request.
+
+        Keyword arguments:
+            - request -- calling HttpRequest
+        """
+        key = (request.scheme, request.get_host(), get_script_prefix())
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = ToolConfigEntry(
+                settings.LTI_PROVIDER['TITLE'],
+                settings.LTI_PROVIDER['DESCRIPTION'],
+                request.build_absolute_uri(
+                    reverse('lti_provider.views.lti_launch')))
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[key] = entry
+        return entry
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        self._entries.clear()
+
+
+tool_config_cache = ToolConfigCache()
@@ -0,0 +1,153 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the launch context of the lti_provider-App. It holds
+the parameters of the last launch which downstream views need and is stored
+compactly in the session by the launch views.
+"""
+
+import logging
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+LAUNCH_CONTEXT_SESSION_KEY = '_lti_launch'
+
+# increased whenever the fields change, older contexts are dropped
+LAUNCH_CONTEXT_VERSION = 1
+
+# pairs of a field and the launch parameter it is read from
+LAUNCH_CONTEXT_PARAMETERS = (
+    ('consumer_key', 'oauth_consumer_key'),
+    ('user_id', 'user_id'),
+    ('roles', 'roles'),
+    ('context_id', 'context_id'),
+    ('context_label', 'context_label'),
+    ('context_title', 'context_title'),
+    ('resource_link_id', 'resource_link_id'),
+    ('resource_link_title', 'resource_link_title'),
+    ('tool_consumer_instance_guid', 'tool_consumer_instance_guid'),
+    ('outcome_service_url', 'lis_outcome_service_url'),
+    ('result_sourcedid', 'lis_result_sourcedid'),
+    ('return_url', 'launch_presentation_return_url'),
+)
+
+
+class LaunchContext(object):
+    """
+    The parameters of a launch needed after the redirect: the consumer, the
+    LTI user, the roles, the course (context), the resource link, the outcome
+    service and the custom parameters (without the prefix custom_). Missing
+    parameters are None, the roles are a tuple and the custom parameters a
+    dictionary. An empty context (no launch in the session) is false.
+    """
+
+    __slots__ = tuple(field for field, parameter in
+                      LAUNCH_CONTEXT_PARAMETERS) + ('custom',)
+
+    def __init__(self, **values):
+        """
+        Keyword arguments:
+            - values -- the fields of the context, missing ones are None
+        """
+        for field, parameter in LAUNCH_CONTEXT_PARAMETERS:
+            setattr(self, field, values.get(field))
+        self.roles = tuple(self.roles or ())
+        self.custom = dict(values.get('custom') or {})
+
+    @classmethod
+    def from_tool_provider(cls, tool_provider):
+        """
+        Returns the context of a launch.
+
+        Keyword arguments:
+            - tool_provider -- the LTI tool provider instance
+        """
+        params = tool_provider.launch_params
+        values = dict((field, params.get(parameter) or None)
+                      for field, parameter in LAUNCH_CONTEXT_PARAMETERS)
+        values['custom'] = dict((name[7:], value) for name, value in
+                                params.items()
+                                if name.startswith('custom_'))
+        return cls(**values)
+
+    def serialize(self):
+        """
+        Returns the context as a JSON serializable list: the version followed
+        by the fields in the order of __slots__.
+        """
+        return [LAUNCH_CONTEXT_VERSION] + [
+            list(self.roles) if field == 'roles' else getattr(self, field)
+            for field in self.__slots__]
+
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Returns the context of a serialized list or an empty context if it
+        is missing or of another version.
+
+        Keyword arguments:
+            - data -- the list returned by serialize or None
+        """
+        if not data or data[0] != LAUNCH_CONTEXT_VERSION or \
+                len(data) != len(cls.__slots__) + 1:
+            if data:
+                logger.debug('launch context of another version dropped')
+            return cls()
+        return cls(**dict(zip(cls.__slots__, data[1:])))
+
+    def __bool__(self):
+        return self.consumer_key is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, LaunchContext):
+            return NotImplemented
+        return self.serialize() == other.serialize()
+
+    def __repr__(self):
+        return '<LaunchContext %s %s %s>' % (
+            self.consumer_key, self.context_id, self.resource_link_id)
+
+
+def store_launch_context(request, tool_provider):
+    """
+    Stores the context of a launch in the session of the request.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+        - tool_provider -- the LTI tool provider instance
+    """
+    context = LaunchContext.from_tool_provider(tool_provider)
+    request.session[LAUNCH_CONTEXT_SESSION_KEY] = context.serialize()
+    return context
+
+
+def get_launch_context(request):
+    """
+    Returns the context of the last launch stored in the session of the
+    request, which is empty if there was none.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    return LaunchContext.deserialize(
+        request.session.get(LAUNCH_CONTEXT_SESSION_KEY))
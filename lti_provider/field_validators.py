@@ -32,6 +32,9 @@ from django.utils.translation import gettext_lazy as _
 # Get an instance of a logger
 logger = logging.getLogger('LTI.lti_provider')
 
+# the characters allowed in keys and secrets
+OAUTH_CHARACTERS = frozenset(UNICODE_ASCII_CHARACTER_SET)
+
 
 def validate_oauth_chars(value):
     """
@@ -40,9 +43,7 @@ def validate_oauth_chars(value):
     Keyword arguments:
         - value -- string to validate
     """
-    a = set(UNICODE_ASCII_CHARACTER_SET)
-    v = set(value)
-    if not v <= a:
+    if not OAUTH_CHARACTERS.issuperset(value):
         logger.debug('unsave characters')
         raise ValidationError(
             _('%(value)s contains unsave characters.'),
@@ -0,0 +1,157 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module maps the LTI roles of a launch to Django groups. The groups are
+configured by ROLE_GROUPS and their IDs are resolved once per process.
+"""
+
+import threading
+
+from django.contrib.auth.models import Group
+
+from lti_provider.utils import get_setting
+
+
+# prefixes of the context roles of LTI 1.1 and LIS v2, other roles like
+# institution and system roles are matched by their full name
+CONTEXT_ROLE_PREFIXES = (
+    'urn:lti:role:ims/lis/',
+    'http://purl.imsglobal.org/vocab/lis/v2/membership#',
+    'http://purl.imsglobal.org/vocab/lis/v2/membership/',
+)
+
+
+def normalize_role(role):
+    """
+    Returns the short name of a context role, e.g. Instructor for
+    Instructor, urn:lti:role:ims/lis/Instructor and
+    http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor. Sub-roles
+    like urn:lti:role:ims/lis/Instructor/TeachingAssistant are named by the
+    sub-role. Other roles, e.g. urn:lti:instrole:ims/lis/Instructor, are
+    returned unchanged, so they never match a context role.
+
+    Keyword arguments:
+        - role -- a role of a launch
+    """
+    role = role.strip()
+    for prefix in CONTEXT_ROLE_PREFIXES:
+        if role.startswith(prefix):
+            return role[len(prefix):].replace('#', '/').rsplit('/', 1)[-1]
+    return role
+
+
+def role_groups():
+    """
+    Returns the ROLE_GROUPS setting as a dictionary of short role names and
+    tuples of group names. It is empty if no groups are configured.
+    """
+    mapping = {}
+    for role, names in get_setting('ROLE_GROUPS', {}).items():
+        if isinstance(names, str):
+            names = (names,)
+        mapping.setdefault(normalize_role(role), set()).update(names)
+    return dict((role, tuple(sorted(names)))
+                for role, names in mapping.items())
+
+
+def parse_group_ids(value):
+    """
+    Returns the set of group IDs stored as role_groups of an identity.
+
+    Keyword arguments:
+        - value -- the comma separated IDs
+    """
+    return set(int(pk) for pk in value.split(',') if pk)
+
+
+def format_group_ids(group_ids):
+    """
+    Returns the group IDs as stored in role_groups of an identity.
+
+    Keyword arguments:
+        - group_ids -- iterable of group IDs
+    """
+    return ','.join(str(pk) for pk in sorted(group_ids))
+
+
+class GroupCache(object):
+    """
+    A per-process cache of the IDs of the configured groups by name. Groups
+    which do not exist are created at their first use. The cache is cleared
+    by the signal handlers in lti_provider.signals whenever a group is saved
+    or deleted or the settings change.
+    """
+
+    def __init__(self):
+        """
+        Creates an empty cache.
+        """
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._generation = 0
+        self.misses = 0
+
+    def group_ids(self, roles):
+        """
+        Returns the set of IDs of the groups mapped to the roles of a
+        launch.
+
+        Keyword arguments:
+            - roles -- iterable of roles of a launch
+        """
+        mapping = role_groups()
+        names = set()
+        for role in roles:
+            names.update(mapping.get(normalize_role(role), ()))
+        with self._lock:
+            ids = dict((name, self._ids[name]) for name in names
+                       if name in self._ids)
+            generation = self._generation
+        if len(ids) < len(names):
+            ids.update(self._resolve(names.difference(ids), generation))
+        return set(ids.values())
+
+    def _resolve(self, names, generation):
+        """
+        Loads or creates the groups of the given names and caches their IDs
+        unless the cache was cleared while they were loaded.
+        """
+        self.misses += 1
+        ids = dict(Group.objects.filter(name__in=names).values_list(
+            'name', 'pk'))
+        for name in names.difference(ids):
+            ids[name] = Group.objects.get_or_create(name=name)[0].pk
+        with self._lock:
+            if generation == self._generation:
+                self._ids.update(ids)
+        return ids
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self._lock:
+            self._ids.clear()
+            self._generation += 1
+
+
+group_cache = GroupCache()
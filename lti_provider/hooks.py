@@ -0,0 +1,328 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module runs the HOOK_AFTER_USER_CREATION of the lti_provider-App. The
+HOOK_MODE entry of the LTI_PROVIDER setting selects how it is executed:
+
+    - 'inline' -- in the launch request (default)
+    - 'on_commit' -- in the launch request after the transaction commits
+    - 'thread' -- in a bounded thread pool after the transaction commits
+    - 'queue' -- handed to HOOK_QUEUE_ADAPTER after the transaction commits
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+
+from lti_provider.utils import get_by_py_path, get_setting
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+HOOK_MODES = ('inline', 'on_commit', 'thread', 'queue')
+
+
+# upper bounds of the buckets of the hook durations in seconds
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                    30.0, 60.0)
+
+
+class HookStats(object):
+    """
+    Counts the executions of the hook, measures their duration in the
+    buckets of DURATION_BUCKETS and tracks the hooks waiting in or running
+    on the thread pool. The metrics view exports them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Sets all counters to zero.
+        """
+        with self._lock:
+            self.calls = 0
+            self.failures = 0
+            self.rejected = 0
+            self.queued = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+
+    def record(self, duration, failed):
+        """
+        Records an execution of the hook.
+
+        Keyword arguments:
+            - duration -- seconds the hook took
+            - failed -- true if the hook raised an exception
+        """
+        with self._lock:
+            self.calls += 1
+            self.failures += int(failed)
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+            self.buckets[bisect_left(DURATION_BUCKETS, duration)] += 1
+
+    def record_rejected(self):
+        """
+        Records a hook which was run inline because the pool was saturated.
+        """
+        with self._lock:
+            self.rejected += 1
+
+    def record_queued(self, change):
+        """
+        Changes the number of hooks submitted to the pool which did not
+        finish yet.
+
+        Keyword arguments:
+            - change -- 1 for a submitted and -1 for a finished hook
+        """
+        with self._lock:
+            self.queued += change
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the counters.
+        """
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'queued': self.queued,
+                'total_time': self.total_time,
+                'max_time': self.max_time,
+                'buckets': list(self.buckets),
+            }
+
+
+hook_stats = HookStats()
+
+
+@lru_cache(maxsize=None)
+def _load(py_path):
+    """
+    Imports a callable once per path.
+
+    Keyword arguments:
+        py_path -- callable to load
+    """
+    return get_by_py_path(py_path) if py_path else None
+
+
+def get_hook():
+    """
+    Returns the configured HOOK_AFTER_USER_CREATION or None.
+    """
+    return _load(get_setting('HOOK_AFTER_USER_CREATION'))
+
+
+def get_queue_adapter():
+    """
+    Returns the configured HOOK_QUEUE_ADAPTER. It is called with the primary
+    key of a new user and has to run call_hook with it in a worker.
+    """
+    adapter = _load(get_setting('HOOK_QUEUE_ADAPTER'))
+    if adapter is None:
+        raise ImproperlyConfigured(
+            "HOOK_MODE 'queue' requires HOOK_QUEUE_ADAPTER")
+    return adapter
+
+
+def get_mode():
+    """
+    Returns the configured HOOK_MODE.
+    """
+    mode = get_setting('HOOK_MODE', 'inline')
+    if mode not in HOOK_MODES:
+        raise ImproperlyConfigured('HOOK_MODE has to be one of %s' % (
+            ', '.join(HOOK_MODES)))
+    return mode
+
+
+def load():
+    """
+    Resolves the hook and validates the mode, used at startup.
+    """
+    mode = get_mode()
+    get_hook()
+    if mode == 'queue':
+        get_queue_adapter()
+
+
+def reset():
+    """
+    Drops the resolved callables and the thread pool, e.g. if the settings
+    changed.
+    """
+    global _executor
+    _load.cache_clear()
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = None
+
+
+def execute(hook, user):
+    """
+    Runs the hook and records its duration. Exceptions are raised.
+
+    Keyword arguments:
+        - hook -- the hook to run
+        - user -- the created user
+    """
+    start = time.perf_counter()
+    failed = True
+    try:
+        hook(user)
+        failed = False
+    finally:
+        hook_stats.record(time.perf_counter() - start, failed)
+
+
+def execute_isolated(hook, user):
+    """
+    Runs the hook and logs exceptions instead of raising them.
+
+    Keyword arguments:
+        - hook -- the hook to run
+        - user -- the created user
+    """
+    try:
+        execute(hook, user)
+    except Exception:
+        logger.exception('HOOK_AFTER_USER_CREATION failed for user %s',
+                         user.pk)
+
+
+def call_hook(user_pk):
+    """
+    Loads a user and runs the hook with it. This is the entry point for
+    the workers of a task queue.
+
+    Keyword arguments:
+        - user_pk -- primary key of the created user
+    """
+    hook = get_hook()
+    if hook is None:
+        return
+    user = get_user_model().objects.get(pk=user_pk)
+    execute_isolated(hook, user)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = None
+
+
+def _get_executor():
+    """
+    Returns the thread pool and the semaphore bounding its pending work.
+    """
+    global _executor, _pending
+    with _executor_lock:
+        if _executor is None:
+            threads = get_setting('HOOK_THREADS', 4)
+            _executor = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix='lti-hook')
+            _pending = threading.BoundedSemaphore(
+                threads + get_setting('HOOK_QUEUE_SIZE', 100))
+        return _executor, _pending
+
+
+def _run_in_thread(hook, user):
+    """
+    Runs the hook in a worker of the thread pool and closes its database
+    connection afterwards.
+    """
+    try:
+        close_old_connections()
+        execute_isolated(hook, user)
+    finally:
+        close_old_connections()
+
+
+def _submit(hook, user):
+    """
+    Submits the hook to the thread pool. If the pool is saturated the hook
+    runs in the calling thread, so no work is lost.
+    """
+    executor, pending = _get_executor()
+    if not pending.acquire(blocking=False):
+        hook_stats.record_rejected()
+        execute_isolated(hook, user)
+        return
+    hook_stats.record_queued(1)
+    future = executor.submit(_run_in_thread, hook, user)
+    future.add_done_callback(lambda f: _finished(pending))
+
+
+def _finished(pending):
+    """
+    Frees the place in the pool of a finished hook.
+    """
+    hook_stats.record_queued(-1)
+    pending.release()
+
+
+def _enqueue(adapter, user):
+    """
+    Hands a new user to the task queue adapter and logs its exceptions.
+    """
+    try:
+        adapter(user.pk)
+    except Exception:
+        logger.exception('could not enqueue HOOK_AFTER_USER_CREATION for '
+                         'user %s', user.pk)
+
+
+def run_hook_after_user_creation(user):
+    """
+    Runs HOOK_AFTER_USER_CREATION for a new user according to HOOK_MODE.
+
+    Keyword arguments:
+        - user -- the created user
+    """
+    hook = get_hook()
+    if hook is None:
+        return
+    mode = get_mode()
+    if mode == 'inline':
+        execute(hook, user)
+    elif mode == 'on_commit':
+        transaction.on_commit(lambda: execute_isolated(hook, user))
+    elif mode == 'thread':
+        transaction.on_commit(lambda: _submit(hook, user))
+    else:
+        adapter = get_queue_adapter()
+        transaction.on_commit(lambda: _enqueue(adapter, user))
@@ -0,0 +1,199 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module caches the JSON Web Key Sets of the LTI 1.3 platforms in the
+process, so verifying a launch needs no HTTP request. The keys of a set are
+kept by kid for JWKS_CACHE_TTL seconds (default: 3600). Expired keys are
+still used while the set is refreshed in a background thread. A set is only
+fetched in the request if it is not cached yet or a token names an unknown
+kid, e.g. after a key rotation; concurrent requests wait for a single fetch
+and a set is fetched at most every JWKS_MIN_REFETCH seconds (default: 10)
+for unknown kids.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+
+from lti_provider.tokens import TokenError, load_jwk
+from lti_provider.utils import get_setting
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+
+class KeySet(object):
+    """
+    The keys of a set by kid and the time they were fetched.
+    """
+
+    __slots__ = ('keys', 'fetched')
+
+    def __init__(self, keys, fetched):
+        self.keys = keys
+        self.fetched = fetched
+
+
+def parse_key_set(data):
+    """
+    Returns a dictionary of the RSA keys of a JWKS by kid. Keys of other
+    types or uses and keys shorter than MIN_KEY_BITS are skipped.
+
+    Keyword arguments:
+        - data -- the decoded JWKS
+    """
+    keys = {}
+    for jwk in data.get('keys', []):
+        if jwk.get('use', 'sig') != 'sig' or \
+                not isinstance(jwk.get('kid'), str):
+            continue
+        try:
+            keys[jwk['kid']] = load_jwk(jwk)
+        except TokenError:
+            logger.debug('skipped key %s', jwk.get('kid'))
+    return keys
+
+
+class KeySetCache(object):
+    """
+    Caches the key sets of the platforms by their URL.
+    """
+
+    def __init__(self, clock=time.monotonic, session=None):
+        """
+        Keyword arguments:
+            - clock -- callable returning the current time in seconds
+            - session -- the requests session used to fetch the sets
+        """
+        self._clock = clock
+        self._session = session or requests.Session()
+        self._lock = threading.Lock()
+        self._sets = {}
+        self._attempts = {}
+        self._fetches = {}
+        self.fetched = 0
+
+    @property
+    def ttl(self):
+        """
+        Returns the seconds the keys of a set are fresh.
+        """
+        return get_setting('JWKS_CACHE_TTL', 3600)
+
+    @property
+    def min_refetch(self):
+        """
+        Returns the minimal seconds between fetches of a set for unknown
+        kids.
+        """
+        return get_setting('JWKS_MIN_REFETCH', 10)
+
+    @property
+    def timeout(self):
+        """
+        Returns the seconds to wait for a platform.
+        """
+        return get_setting('JWKS_TIMEOUT', 5)
+
+    def get(self, url, kid):
+        """
+        Returns the key of a kid of a set or None if the set does not
+        contain it. Raises a TokenError if the kid is not a string.
+
+        Keyword arguments:
+            - url -- the URL of the JWKS
+            - kid -- the key ID from the header of a token
+        """
+        if not isinstance(kid, str):
+            raise TokenError('invalid kid')
+        now = self._clock()
+        with self._lock:
+            key_set = self._sets.get(url)
+            if key_set is not None and kid in key_set.keys:
+                if now - key_set.fetched >= self.ttl:
+                    fetch, started = self._start_fetch(url)
+                    if started:
+                        threading.Thread(target=self._fetch,
+                                         args=(url, fetch),
+                                         daemon=True).start()
+                return key_set.keys[kid]
+            attempt = self._attempts.get(url)
+            if attempt is not None and now - attempt < self.min_refetch \
+                    and url not in self._fetches:
+                return None
+            fetch, started = self._start_fetch(url)
+        if started:
+            self._fetch(url, fetch)
+        else:
+            fetch.wait(self.timeout + 1)
+        with self._lock:
+            key_set = self._sets.get(url)
+        if key_set is None:
+            return None
+        return key_set.keys.get(kid)
+
+    def _start_fetch(self, url):
+        """
+        Returns the event of the running fetch of a set and false or a new
+        event and true if the caller has to fetch the set. Has to be called
+        with the lock held.
+        """
+        fetch = self._fetches.get(url)
+        if fetch is not None:
+            return fetch, False
+        fetch = self._fetches[url] = threading.Event()
+        self._attempts[url] = self._clock()
+        return fetch, True
+
+    def _fetch(self, url, fetch):
+        """
+        Fetches a set, stores it and wakes up the waiting requests. A failed
+        fetch keeps the previous keys.
+        """
+        try:
+            response = self._session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            keys = parse_key_set(response.json())
+        except (requests.RequestException, ValueError, AttributeError):
+            logger.warning('fetching the key set %s failed', url,
+                           exc_info=True)
+        else:
+            with self._lock:
+                self._sets[url] = KeySet(keys, self._clock())
+                self.fetched += 1
+        finally:
+            with self._lock:
+                self._fetches.pop(url, None)
+            fetch.set()
+
+    def clear(self):
+        """
+        Removes all sets.
+        """
+        with self._lock:
+            self._sets.clear()
+            self._attempts.clear()
+
+
+key_set_cache = KeySetCache()
@@ -0,0 +1,302 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the LTI 1.3 launches of the lti_provider-App. The OIDC
+login of a registered platform is answered with a redirect to its
+authorization endpoint and the id_token of the following launch is verified
+with the cached keys of the platform. Its claims are translated into the
+parameters of a LTI 1.1 launch, so the user, the redirect and the launch
+context are handled like a LTI 1.1 launch of the consumer linked to the
+platform.
+"""
+
+import hmac
+import logging
+import secrets
+import time
+from urllib.parse import urlencode
+
+from django.core.cache import caches
+from lti.contrib.django import DjangoToolProvider
+
+from lti_provider.jwks import key_set_cache
+from lti_provider.models import Platform
+from lti_provider.tokens import TokenError, verify_token
+from lti_provider.utils import get_setting
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+CLAIM = 'https://purl.imsglobal.org/spec/lti/claim/'
+
+MESSAGE_TYPE = 'LtiResourceLinkRequest'
+
+VERSION = '1.3.0'
+
+STATE_KEY = 'lti_provider:lti13:state:%s'
+
+STATE_COOKIE = 'lti13_state_%s'
+
+# pairs of a launch parameter and the claim and optionally the member of
+# the claim it is read from
+CLAIM_PARAMETERS = (
+    ('user_id', 'sub', None),
+    ('lis_person_contact_email_primary', 'email', None),
+    ('lis_person_name_given', 'given_name', None),
+    ('lis_person_name_family', 'family_name', None),
+    ('lis_person_name_full', 'name', None),
+    ('context_id', CLAIM + 'context', 'id'),
+    ('context_label', CLAIM + 'context', 'label'),
+    ('context_title', CLAIM + 'context', 'title'),
+    ('resource_link_id', CLAIM + 'resource_link', 'id'),
+    ('resource_link_title', CLAIM + 'resource_link', 'title'),
+    ('tool_consumer_instance_guid', CLAIM + 'tool_platform', 'guid'),
+    ('launch_presentation_return_url', CLAIM + 'launch_presentation',
+     'return_url'),
+)
+
+
+class LaunchError(Exception):
+    """
+    Raised if a LTI 1.3 login or launch is rejected.
+
+    Attributes:
+        - reason -- the outcome of the launch
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class PlatformLaunch(object):
+    """
+    A verified LTI 1.3 launch: the platform, the claims of the id_token and
+    a tool provider with the translated launch parameters.
+    """
+
+    __slots__ = ('platform', 'claims', 'tool_provider')
+
+    def __init__(self, platform, claims, tool_provider):
+        self.platform = platform
+        self.claims = claims
+        self.tool_provider = tool_provider
+
+
+def state_cache():
+    """
+    Returns the cache of the login states (LTI13_STATE_CACHE, default:
+    'default'), which has to be shared by all processes.
+    """
+    return caches[get_setting('LTI13_STATE_CACHE', 'default')]
+
+
+def get_platform(issuer, client_id=None):
+    """
+    Returns the platform of an issuer and client ID. The client ID may be
+    omitted if the issuer has a single registration.
+
+    Keyword arguments:
+        - issuer -- the iss of the platform
+        - client_id -- the client ID of the tool or None
+    """
+    platforms = Platform.objects.select_related('consumer').filter(
+        issuer=issuer)
+    if client_id:
+        platforms = platforms.filter(client_id=client_id)
+    platforms = list(platforms[:2])
+    if len(platforms) != 1:
+        raise LaunchError('unknown_consumer',
+                          'unknown platform %s' % issuer)
+    return platforms[0]
+
+
+def login_redirect_url(params, redirect_uri):
+    """
+    Returns a tuple of the URL of the authorization request of an OIDC
+    login, the name of its state cookie and the secret binding the login to
+    the browser, which has to be set by set_state_cookie. The state, the
+    nonce and the secret are stored in the state cache for
+    LTI13_STATE_TIMEOUT seconds (default: 600).
+
+    Keyword arguments:
+        - params -- the parameters of the login request
+        - redirect_uri -- the absolute URL of the launch view
+    """
+    for name in ('iss', 'login_hint', 'target_link_uri'):
+        if not params.get(name):
+            raise LaunchError('missing_parameter', 'missing %s' % name)
+    platform = get_platform(params['iss'], params.get('client_id'))
+    state = secrets.token_urlsafe(32)
+    nonce = secrets.token_urlsafe(32)
+    browser = secrets.token_urlsafe(32)
+    state_cache().set(STATE_KEY % state, (platform.pk, nonce, browser),
+                      get_setting('LTI13_STATE_TIMEOUT', 600))
+    query = {
+        'scope': 'openid',
+        'response_type': 'id_token',
+        'response_mode': 'form_post',
+        'prompt': 'none',
+        'client_id': platform.client_id,
+        'redirect_uri': redirect_uri,
+        'login_hint': params['login_hint'],
+        'state': state,
+        'nonce': nonce,
+    }
+    if params.get('lti_message_hint'):
+        query['lti_message_hint'] = params['lti_message_hint']
+    separator = '&' if '?' in platform.auth_login_url else '?'
+    return (platform.auth_login_url + separator + urlencode(query),
+            STATE_COOKIE % state, browser)
+
+
+def set_state_cookie(response, request, name, browser, path):
+    """
+    Sets the cookie binding a login to the browser. The platform posts the
+    launch from another site, so the cookie is sent with SameSite=None,
+    which browsers only accept for secure cookies, on HTTPS.
+
+    Keyword arguments:
+        - response -- the redirect to the platform
+        - request -- calling HttpRequest
+        - name -- the name of the cookie
+        - browser -- the secret of the login
+        - path -- the path of the launch view
+    """
+    secure = request.is_secure()
+    response.set_cookie(name, browser,
+                        max_age=get_setting('LTI13_STATE_TIMEOUT', 600),
+                        path=path, secure=secure, httponly=True,
+                        samesite='None' if secure else 'Lax')
+
+
+def verify_launch(request, clock=time.time):
+    """
+    Returns the PlatformLaunch of a request with a valid id_token and state.
+    The state is used once and only by the browser which started the login,
+    which has to send the cookie of the login. The signature is verified
+    with the cached keys of the platform, so no HTTP request is needed as
+    long as they are cached.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+        - clock -- callable returning the current time in seconds
+    """
+    id_token = request.POST.get('id_token')
+    state = request.POST.get('state')
+    if not id_token or not state:
+        raise LaunchError('missing_parameter', 'missing id_token or state')
+    browser = request.COOKIES.get(STATE_COOKIE % state)
+    if not browser:
+        raise LaunchError('invalid_request', 'state of another browser')
+    cache = state_cache()
+    entry = cache.get(STATE_KEY % state)
+    if entry is None:
+        raise LaunchError('replay', 'unknown or used state')
+    platform_pk, nonce, expected = entry
+    if not hmac.compare_digest(browser, expected):
+        raise LaunchError('invalid_request', 'state of another browser')
+    if not cache.delete(STATE_KEY % state):
+        raise LaunchError('replay', 'unknown or used state')
+    try:
+        platform = Platform.objects.select_related('consumer').get(
+            pk=platform_pk)
+    except Platform.DoesNotExist:
+        raise LaunchError('unknown_consumer', 'platform removed')
+
+    try:
+        claims = verify_token(id_token, lambda kid: key_set_cache.get(
+            platform.key_set_url, kid))
+    except TokenError as e:
+        raise LaunchError('bad_signature', str(e))
+    check_claims(claims, platform, nonce, clock())
+
+    tool_provider = DjangoToolProvider(
+        consumer_key=platform.consumer.key,
+        params=launch_parameters(claims, platform),
+        launch_url=request.build_absolute_uri())
+    return PlatformLaunch(platform, claims, tool_provider)
+
+
+def check_claims(claims, platform, nonce, now):
+    """
+    Raises a LaunchError if the claims of an id_token are not issued for
+    this tool by the platform, expired, of another login or not a resource
+    link launch. The time claims are checked with LTI13_LEEWAY seconds
+    (default: 60).
+
+    Keyword arguments:
+        - claims -- the verified claims
+        - platform -- the platform of the login
+        - nonce -- the nonce of the login
+        - now -- the current time in seconds
+    """
+    leeway = get_setting('LTI13_LEEWAY', 60)
+    audience = claims.get('aud')
+    if isinstance(audience, str):
+        audience = [audience]
+    if claims.get('iss') != platform.issuer or \
+            not isinstance(audience, list) or \
+            platform.client_id not in audience or \
+            (len(audience) > 1 and claims.get('azp') != platform.client_id):
+        raise LaunchError('invalid_request', 'wrong issuer or audience')
+    expires = claims.get('exp')
+    issued = claims.get('iat')
+    if not isinstance(expires, (int, float)) or \
+            not isinstance(issued, (int, float)) or \
+            now > expires + leeway or now < issued - leeway:
+        raise LaunchError('invalid_request', 'expired token')
+    if not isinstance(claims.get('nonce'), str) or \
+            not hmac.compare_digest(claims['nonce'], nonce):
+        raise LaunchError('replay', 'wrong nonce')
+    if platform.deployment_id and \
+            claims.get(CLAIM + 'deployment_id') != platform.deployment_id:
+        raise LaunchError('invalid_request', 'unknown deployment')
+    if claims.get(CLAIM + 'message_type') != MESSAGE_TYPE or \
+            claims.get(CLAIM + 'version') != VERSION:
+        raise LaunchError('invalid_request', 'unsupported message')
+
+
+def launch_parameters(claims, platform):
+    """
+    Returns the LTI 1.1 launch parameters of the claims of a LTI 1.3
+    launch. The custom claim becomes the custom_ parameters.
+
+    Keyword arguments:
+        - claims -- the verified claims
+        - platform -- the platform of the launch
+    """
+    params = {'oauth_consumer_key': platform.consumer.key}
+    for parameter, claim, member in CLAIM_PARAMETERS:
+        value = claims.get(claim)
+        if member is not None:
+            value = value.get(member) if isinstance(value, dict) else None
+        if value is not None:
+            params[parameter] = str(value)
+    roles = claims.get(CLAIM + 'roles')
+    if isinstance(roles, list):
+        params['roles'] = [str(role) for role in roles]
+    custom = claims.get(CLAIM + 'custom')
+    if isinstance(custom, dict):
+        for name, value in custom.items():
+            params['custom_' + name] = str(value)
+    return params
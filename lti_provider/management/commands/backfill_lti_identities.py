@@ -0,0 +1,104 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command to create the LTI identities of
+users created before the identities existed.
+"""
+
+import re
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.db.models.functions import Right
+
+from lti_provider.models import Consumer, LTIIdentity
+
+User = get_user_model()
+
+USERNAME_PATTERN = re.compile(r'_([0-9a-f]{40})$')
+
+
+class Command(BaseCommand):
+    """
+    Creates the missing LTI identities of a consumer from the usernames of
+    existing LTI users (email + '_' + sha1 of the user_id). The usernames do
+    not contain the consumer and user_ids are only unique per consumer, so
+    the command refuses to run unless the given consumer is the only one.
+    With several consumers the users are linked at their next launch by
+    provision_user. Usernames which were truncated to 120 characters do not
+    contain the complete hash, and hashes of several users (e.g. after a
+    changed email address) are ambiguous; these users are skipped and also
+    get their identity at their next launch.
+    """
+    help = 'Creates LTI identities from the usernames of existing users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('consumer', help='key of the consumer')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of users processed per batch')
+
+    def handle(self, *args, **options):
+        try:
+            consumer = Consumer.objects.get(key=options['consumer'])
+        except Consumer.DoesNotExist:
+            raise CommandError('unknown consumer %s' % options['consumer'])
+        if Consumer.objects.exclude(pk=consumer.pk).exists():
+            raise CommandError(
+                'the usernames do not contain the consumer, so they could '
+                'only be assigned if there is a single consumer; the users '
+                'are linked at their next launch instead')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size has to be at least 1')
+
+        users = User.objects.filter(
+            username__regex=USERNAME_PATTERN.pattern,
+            lti_identities__isnull=True).annotate(
+                uid_hash=Right('username', 40))
+        ambiguous = set(users.values('uid_hash').annotate(
+            users=Count('pk')).filter(users__gt=1).values_list(
+                'uid_hash', flat=True))
+        ambiguous.update(LTIIdentity.objects.filter(
+            consumer=consumer).values_list('uid_hash', flat=True))
+        users = users.order_by('pk')
+        created = 0
+        skipped = 0
+        last_pk = None
+        while True:
+            batch = users
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values_list('pk', 'uid_hash')[:batch_size])
+            if not rows:
+                break
+            identities = [
+                LTIIdentity(consumer=consumer, uid_hash=uid_hash, user_id=pk)
+                for pk, uid_hash in rows if uid_hash not in ambiguous]
+            # a concurrent launch could link a user in the meantime
+            LTIIdentity.objects.bulk_create(identities, ignore_conflicts=True)
+            created += len(identities)
+            skipped += len(rows) - len(identities)
+            last_pk = rows[-1][0]
+
+        self.stdout.write('Processed %d users, skipped %d ambiguous users.'
+                          % (created, skipped))
@@ -0,0 +1,90 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command to copy the nonces of the
+TimestampAndNonce table to the table of the CompactNonceStore.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from lti_provider.models import NonceDigest, TimestampAndNonce
+from lti_provider.nonces import CompactNonceStore, nonce_digest
+from lti_provider.routers import nonce_database
+from lti_provider.validators import LTIValidator
+
+
+class Command(BaseCommand):
+    """
+    Copies the timestamps and nonces which are still within the accepted
+    timestamp window (or all with --all) to the NonceDigest table, so
+    replays of requests recorded before NONCE_BACKEND was switched to the
+    CompactNonceStore are still rejected. Rows which are copied already are
+    skipped, so the command could run before and after the switch.
+    """
+    help = 'Copies the LTI nonces to the compact nonce store.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of rows copied per transaction')
+        parser.add_argument('--all', action='store_true',
+                            help='copy expired rows as well')
+        parser.add_argument('--delete', action='store_true',
+                            help='delete the copied rows of the old table')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size has to be at least 1')
+        bucket_seconds = CompactNonceStore().bucket_seconds
+        using = nonce_database()
+        rows = TimestampAndNonce.objects.using(using).order_by('pk')
+        if not options['all']:
+            rows = rows.filter(timestamp__gte=int(time.time()) -
+                               LTIValidator().timestamp_lifetime)
+
+        copied = 0
+        last_pk = 0
+        start = time.monotonic()
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk).values_list(
+                'pk', 'consumer_id', 'timestamp', 'nonce')[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic(using=using):
+                NonceDigest.objects.using(using).bulk_create([
+                    NonceDigest(
+                        digest=nonce_digest(consumer_id, timestamp, nonce),
+                        bucket=timestamp // bucket_seconds)
+                    for pk, consumer_id, timestamp, nonce in batch],
+                    ignore_conflicts=True)
+                if options['delete']:
+                    TimestampAndNonce.objects.using(using).filter(
+                        pk__in=[row[0] for row in batch]).delete()
+            copied += len(batch)
+            last_pk = batch[-1][0]
+        duration = time.monotonic() - start
+
+        self.stdout.write('Copied %d rows in %.2f seconds.' % (
+            copied, duration))
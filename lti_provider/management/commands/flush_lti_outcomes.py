@@ -0,0 +1,68 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command to send the queued scores to the
+consumers.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lti_provider.outcomes import OutcomeWorker
+
+
+class Command(BaseCommand):
+    """
+    Sends the due scores with the OutcomeWorker. Without --loop all due
+    scores are sent once, e.g. by cron. With --loop the command keeps
+    running as worker and waits --interval seconds if no score is due.
+    """
+    help = 'Sends the queued LTI scores to the consumers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='keep sending new scores')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='seconds to wait if no score is due')
+
+    def handle(self, *args, **options):
+        if options['interval'] <= 0:
+            raise CommandError('--interval has to be positive')
+        worker = OutcomeWorker()
+        totals = dict.fromkeys(('sent', 'coalesced', 'retried', 'failed'), 0)
+        try:
+            while True:
+                counts = worker.flush()
+                for name, n in counts.items():
+                    totals[name] += n
+                if any(counts.values()):
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            worker.close()
+        self.stdout.write('Sent %(sent)d, coalesced %(coalesced)d, retried '
+                          '%(retried)d and failed %(failed)d scores.' % totals)
@@ -0,0 +1,213 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command to benchmark the views of the
+lti_provider-App.
+"""
+
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.test.utils import (setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+
+from lti_provider.benchmarks import (NONCE_STORES, PHASES, SCENARIOS,
+                                     LaunchBenchmark, NonceBenchmark,
+                                     PageViewBenchmark)
+from lti_provider.cache import tool_config_cache
+from lti_provider.models import Consumer
+from lti_provider.views import tool_config
+
+
+class Command(BaseCommand):
+    """
+    Calls the views in process and reports the requests per second of each
+    variant of a scenario. The launch scenario runs in a test database and
+    fails if a launch exceeds its query budget. The nonces scenario fills
+    the tables of the nonce stores in a test database and compares them.
+    The page_view scenario compares the page views of a logged in user with
+    and without the user cache.
+    """
+    help = 'Benchmarks the views of the LTI provider.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario',
+                            choices=['tool_config', 'launch', 'nonces',
+                                     'page_view'],
+                            help='the scenario to run')
+        parser.add_argument('--requests', type=int, default=1000,
+                            help='number of requests per variant')
+        parser.add_argument('--launches', type=int, default=200,
+                            help='number of launches per launch scenario')
+        parser.add_argument('--views', type=int, default=1000,
+                            help='number of page views per variant')
+        parser.add_argument('--rows', type=int, default=10000000,
+                            help='number of recorded nonces of the nonces '
+                                 'scenario')
+        parser.add_argument('--nonces', type=int, default=10000,
+                            help='number of measured nonces per store')
+        parser.add_argument('--host', default='localhost',
+                            help='host of the tool_config requests, has to '
+                                 'be allowed')
+
+    def handle(self, *args, **options):
+        getattr(self, 'benchmark_' + options['scenario'])(options)
+
+    def report(self, name, n, duration):
+        """
+        Writes the requests per second of a variant.
+        """
+        self.stdout.write('%-24s %8d requests %10.0f requests/s' % (
+            name, n, n / duration if duration > 0 else 0.0))
+
+    def benchmark_tool_config(self, options):
+        """
+        Compares uncached requests (the behaviour without the cache), cached
+        requests and conditional requests answered with 304.
+        """
+        n = options['requests']
+        factory = RequestFactory(HTTP_HOST=options['host'])
+
+        start = time.perf_counter()
+        for i in range(n):
+            tool_config_cache.clear()
+            tool_config(factory.get('/config.xml'))
+        self.report('uncached', n, time.perf_counter() - start)
+
+        tool_config_cache.clear()
+        response = tool_config(factory.get('/config.xml'))
+        start = time.perf_counter()
+        for i in range(n):
+            tool_config(factory.get('/config.xml'))
+        self.report('cached', n, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(n):
+            tool_config(factory.get('/config.xml',
+                                    HTTP_IF_NONE_MATCH=response['ETag']))
+        self.report('not modified', n, time.perf_counter() - start)
+
+    def benchmark_launch(self, options):
+        """
+        Runs the launch scenarios in a test database and reports launches
+        per second, queries per launch and the mean time of each phase.
+        """
+        n = options['launches']
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            admin = get_user_model().objects.create(
+                username='lti_benchmark_admin')
+            consumer = Consumer.objects.create(
+                key='benchmarkkey0123456789',
+                secret='benchmarksecret0123456789',
+                user=admin)
+            benchmark = LaunchBenchmark(consumer)
+            results = [benchmark.run(scenario, n) for scenario in SCENARIOS]
+            phases = [benchmark.run_phases(scenario, n)
+                      for scenario in SCENARIOS]
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write('%-16s %10s %10s %8s' % (
+            'scenario', 'launches/s', 'queries', 'budget'))
+        for r in results:
+            self.stdout.write('%-16s %10.0f %10.1f %8d' % (
+                r['scenario'], r['launches_per_second'], r['queries'],
+                r['budget']))
+        self.stdout.write('')
+        self.stdout.write('%-16s' % 'ms per phase' + ''.join(
+            '%14s' % phase for phase in PHASES))
+        for scenario, p in zip(SCENARIOS, phases):
+            self.stdout.write('%-16s' % scenario + ''.join(
+                '%14.3f' % (p[phase] * 1000) for phase in PHASES))
+
+        exceeded = [r['scenario'] for r in results
+                    if r['max_queries'] > r['budget']]
+        if exceeded:
+            raise CommandError('query budget exceeded: %s' % (
+                ', '.join(exceeded)))
+
+    def benchmark_nonces(self, options):
+        """
+        Fills the tables of the nonce stores with --rows requests and
+        reports the cost of recording a new nonce and of rejecting a replay
+        and the size of the tables including their indexes.
+        """
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            admin = get_user_model().objects.create(
+                username='lti_benchmark_admin')
+            consumer = Consumer.objects.create(
+                key='benchmarkkey0123456789',
+                secret='benchmarksecret0123456789',
+                user=admin)
+            benchmark = NonceBenchmark(consumer)
+            start = time.perf_counter()
+            benchmark.fill(options['rows'])
+            self.stdout.write('filled %d rows in %.0f seconds' % (
+                options['rows'], time.perf_counter() - start))
+            results = [benchmark.run(name, options['nonces'])
+                       for name, store, model in NONCE_STORES]
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write('%-10s %12s %10s %10s %10s %10s' % (
+            'store', 'rows', 'insert us', 'replay us', 'MiB',
+            'bytes/row'))
+        for r in results:
+            size = r['bytes']
+            self.stdout.write('%-10s %12d %10.1f %10.1f %10s %10s' % (
+                r['store'], r['rows'], r['insert_us'], r['replay_us'],
+                '%.1f' % (size / 2 ** 20) if size else 'n/a',
+                '%.1f' % (size / r['rows']) if size else 'n/a'))
+
+    def benchmark_page_view(self, options):
+        """
+        Runs page views of a logged in user in a test database without and
+        with USER_CACHING and reports page views per second and queries per
+        page view.
+        """
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            user = get_user_model().objects.create(
+                username='lti_benchmark_user')
+            benchmark = PageViewBenchmark(user)
+            results = [benchmark.run(cached, options['views'])
+                       for cached in (False, True)]
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write('%-10s %10s %10s' % (
+            'variant', 'views/s', 'queries'))
+        for r in results:
+            self.stdout.write('%-10s %10.0f %10.1f' % (
+                r['variant'], r['views_per_second'], r['queries']))
+        self.stdout.write('%.1f queries saved per page view' % (
+            results[0]['queries'] - results[1]['queries']))
@@ -0,0 +1,330 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command to import and export consumers
+as CSV or JSON Lines.
+"""
+
+import csv
+import json
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from oauthlib.common import generate_token
+from oauthlib.oauth1.rfc5849.utils import UNICODE_ASCII_CHARACTER_SET
+
+from lti_provider.field_validators import validate_oauth_chars, \
+                                          validate_oauth_length
+from lti_provider.models import Consumer
+from lti_provider.signals import invalidate_consumer_cache
+
+User = get_user_model()
+
+FIELDS = ('key', 'secret', 'user')
+
+FORMATS = ('csv', 'jsonl')
+
+# length of generated keys and secrets, the maximum of validate_oauth_length
+GENERATED_LENGTH = 30
+
+
+def guess_format(path, default='csv'):
+    """
+    Returns the format of a file by its extension.
+
+    Keyword arguments:
+        - path -- the path of the file or '-'
+        - default -- returned for unknown extensions
+    """
+    if path.endswith(('.jsonl', '.json')):
+        return 'jsonl'
+    if path.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_rows(stream, fmt):
+    """
+    Yields the line number and the row (a dict or an error message) of each
+    record of a stream.
+
+    Keyword arguments:
+        - stream -- the opened file
+        - fmt -- 'csv' or 'jsonl'
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_num, 'invalid JSON: %s' % e
+            continue
+        if not isinstance(row, dict):
+            yield line_num, 'not an object'
+            continue
+        yield line_num, row
+
+
+class RowWriter(object):
+    """
+    Writes rows with the FIELDS as CSV or JSON Lines to a stream.
+    """
+
+    def __init__(self, stream, fmt):
+        """
+        Keyword arguments:
+            - stream -- the opened file
+            - fmt -- 'csv' or 'jsonl'
+        """
+        self.stream = stream
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.writer = csv.writer(stream)
+            self.writer.writerow(FIELDS)
+
+    def write(self, row):
+        """
+        Writes a tuple of the FIELDS.
+        """
+        if self.fmt == 'csv':
+            self.writer.writerow(row)
+        else:
+            self.stream.write(json.dumps(dict(zip(FIELDS, row))) + '\n')
+
+
+class Command(BaseCommand):
+    """
+    Imports and exports consumers as CSV (with a header line) or JSON Lines
+    with the fields key, secret and user (the username of the user
+    responsible for the consumer). Missing keys and secrets are generated
+    on import. The rows are read, validated and written chunk by chunk, so
+    files of any size are processed in constant memory. Rows which can not
+    be imported are reported with their line number and skipped.
+    """
+    help = 'Imports or exports LTI consumers as CSV or JSON Lines.'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        parser_import = subparsers.add_parser(
+            'import', help='create consumers from a file')
+        parser_import.add_argument('path', help='the file or - for stdin')
+        parser_import.add_argument(
+            '--user', help='username used for rows without user')
+        parser_import.add_argument(
+            '--errors', help='file of the error report (default: stderr)')
+        parser_import.add_argument(
+            '--output', help='file the created consumers are written to, '
+                             'e.g. to pass on the generated secrets')
+        parser_export = subparsers.add_parser(
+            'export', help='write the consumers to a file')
+        parser_export.add_argument(
+            '--output', default='-', help='the file or - for stdout')
+        parser_export.add_argument(
+            '--without-secrets', action='store_true',
+            help='leave the secrets empty')
+        for subparser in (parser_import, parser_export):
+            subparser.add_argument('--format', choices=FORMATS,
+                                   help='default: by the file extension')
+            subparser.add_argument(
+                '--batch-size', type=int, default=1000,
+                help='number of consumers per chunk')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size has to be at least 1')
+        if options['action'] == 'import':
+            self.import_consumers(options)
+        else:
+            self.export_consumers(options)
+
+    def import_consumers(self, options):
+        """
+        Creates the consumers of a file chunk by chunk.
+        """
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+        stream = sys.stdin if path == '-' else open(path, newline='')
+        report = self.stderr if options['errors'] is None else \
+            open(options['errors'], 'w')
+        output = None if options['output'] is None else \
+            open(options['output'], 'w', newline='')
+        writer = None if output is None else \
+            RowWriter(output, guess_format(options['output'], fmt))
+        self.created = self.failed = 0
+        try:
+            chunk = []
+            for line_num, row in read_rows(stream, fmt):
+                chunk.append((line_num, row))
+                if len(chunk) >= options['batch_size']:
+                    self.import_chunk(chunk, options['user'], report, writer)
+                    chunk = []
+            if chunk:
+                self.import_chunk(chunk, options['user'], report, writer)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if report is not self.stderr:
+                report.close()
+            if output is not None:
+                output.close()
+        self.stdout.write('Created %d consumers, %d rows failed.' % (
+            self.created, self.failed))
+
+    def import_chunk(self, chunk, default_user, report, writer=None):
+        """
+        Validates the rows of a chunk and creates their consumers in one
+        transaction.
+
+        Keyword arguments:
+            - chunk -- list of line numbers and rows
+            - default_user -- username used for rows without user
+            - report -- stream of the error report
+            - writer -- RowWriter of the created consumers or None
+        """
+        rows = []
+        for line_num, row in chunk:
+            if isinstance(row, str):
+                self.report(report, line_num, row)
+                continue
+            try:
+                rows.append((line_num, self.clean_row(row, default_user)))
+            except ValidationError as e:
+                self.report(report, line_num, '; '.join(e.messages))
+
+        usernames = set(row['user'] for _, row in rows)
+        users = dict(User.objects.filter(
+            **{'%s__in' % User.USERNAME_FIELD: usernames}).values_list(
+                User.USERNAME_FIELD, 'pk'))
+        keys = set(row['key'] for _, row in rows)
+        secrets = set(row['secret'] for _, row in rows)
+        taken_keys = set(Consumer.objects.filter(
+            key__in=keys).values_list('key', flat=True))
+        taken_secrets = set(Consumer.objects.filter(
+            secret__in=secrets).values_list('secret', flat=True))
+
+        consumers = []
+        for line_num, row in rows:
+            if row['user'] not in users:
+                error = 'unknown user %s' % row['user']
+            elif row['key'] in taken_keys:
+                error = 'key %s exists already' % row['key']
+            elif row['secret'] in taken_secrets:
+                error = 'secret of key %s exists already' % row['key']
+            else:
+                taken_keys.add(row['key'])
+                taken_secrets.add(row['secret'])
+                consumers.append((line_num, row, Consumer(
+                    key=row['key'], secret=row['secret'],
+                    user_id=users[row['user']])))
+                continue
+            self.report(report, line_num, error)
+
+        if not consumers:
+            return
+        try:
+            with transaction.atomic():
+                Consumer.objects.bulk_create(
+                    [consumer for _, _, consumer in consumers])
+            created = [row for _, row, _ in consumers]
+        except IntegrityError:
+            # a concurrent change: insert row by row to find the conflicts
+            created = []
+            for line_num, row, consumer in consumers:
+                try:
+                    with transaction.atomic():
+                        consumer.save(force_insert=True)
+                    created.append(row)
+                except IntegrityError as e:
+                    self.report(report, line_num, str(e))
+        self.created += len(created)
+        if writer is not None:
+            for row in created:
+                writer.write((row['key'], row['secret'], row['user']))
+        # bulk_create sends no post_save
+        invalidate_consumer_cache(sender=Consumer)
+
+    def clean_row(self, row, default_user):
+        """
+        Returns the key, secret and user of a row and generates a missing
+        key or secret.
+
+        Keyword arguments:
+            - row -- dict of a row
+            - default_user -- username used for rows without user
+        """
+        cleaned = {}
+        errors = []
+        for field in ('key', 'secret'):
+            value = str(row.get(field) or '').strip()
+            if not value:
+                value = generate_token(GENERATED_LENGTH,
+                                       UNICODE_ASCII_CHARACTER_SET)
+            try:
+                validate_oauth_chars(value)
+                validate_oauth_length(value)
+            except ValidationError as e:
+                errors.extend('%s: %s' % (field, message)
+                              for message in e.messages)
+            cleaned[field] = value
+        cleaned['user'] = str(row.get('user') or default_user or '').strip()
+        if not cleaned['user']:
+            errors.append('user: missing')
+        if errors:
+            raise ValidationError(errors)
+        return cleaned
+
+    def report(self, report, line_num, error):
+        """
+        Writes the error of a row to the error report.
+        """
+        self.failed += 1
+        report.write('line %d: %s\n' % (line_num, error))
+
+    def export_consumers(self, options):
+        """
+        Writes all consumers to a file, reading them chunk by chunk.
+        """
+        path = options['output']
+        fmt = options['format'] or guess_format(path)
+        stream = self.stdout if path == '-' else \
+            open(path, 'w', newline='')
+        try:
+            writer = RowWriter(stream, fmt)
+            rows = Consumer.objects.order_by('pk').values_list(
+                'key', 'secret', 'user__%s' % User.USERNAME_FIELD)
+            for key, secret, user in rows.iterator(
+                    chunk_size=options['batch_size']):
+                if options['without_secrets']:
+                    secret = ''
+                writer.write((key, secret, user))
+        finally:
+            if stream is not self.stdout:
+                stream.close()
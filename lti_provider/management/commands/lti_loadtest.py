@@ -0,0 +1,321 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command which acts as a simulated LMS
+and fires concurrent signed launches at the lti_provider-App.
+"""
+
+import math
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import Error as DatabaseError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, setup_databases,
+                               setup_test_environment, teardown_databases,
+                               teardown_test_environment)
+from django.urls import reverse
+
+from lti_provider.benchmarks import signed_launch_data
+from lti_provider.models import Consumer
+from lti_provider.utils import reverse_from_settings
+
+KEY_PREFIX = 'loadtest'
+
+# prefix of the outcome class of a database error
+DB_ERROR_PREFIX = 'db:'
+
+_worker = threading.local()
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0-100) of sorted values.
+    """
+    if not values:
+        return 0.0
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def post_http(url, data):
+    """
+    Posts a launch to a running server and returns a tuple of the status
+    code, the redirect location, the seconds and the error class. Used by
+    the thread and the process pool.
+    """
+    session = getattr(_worker, 'session', None)
+    if session is None:
+        session = _worker.session = requests.Session()
+    start = time.perf_counter()
+    try:
+        response = session.post(url, data=data, allow_redirects=False)
+    except requests.RequestException as e:
+        return None, None, time.perf_counter() - start, type(e).__name__
+    return (response.status_code, response.headers.get('Location'),
+            time.perf_counter() - start, None)
+
+
+def post_in_process(path, data):
+    """
+    Posts a launch through the test client of the current thread and returns
+    a tuple of the status code, the redirect location, the seconds, the error
+    class and the number of queries. Database errors are prefixed with
+    DB_ERROR_PREFIX.
+    """
+    client = getattr(_worker, 'client', None)
+    if client is None:
+        client = _worker.client = Client()
+    start = time.perf_counter()
+    with CaptureQueriesContext(connection) as queries:
+        try:
+            response = client.post(path, data)
+        except DatabaseError as e:
+            return (None, None, time.perf_counter() - start,
+                    DB_ERROR_PREFIX + type(e).__name__, len(queries))
+        except Exception as e:
+            return (None, None, time.perf_counter() - start,
+                    type(e).__name__, len(queries))
+    return (response.status_code, response.get('Location'),
+            time.perf_counter() - start, None, len(queries))
+
+
+def run_in_threads(function, args, concurrency):
+    """
+    Calls function with each tuple of args in concurrency threads and
+    returns the results in the order of args. Each thread closes its
+    database connections when it is done, so the test database could be
+    dropped afterwards.
+
+    Keyword arguments:
+        - function -- the called function
+        - args -- list of argument tuples
+        - concurrency -- number of threads
+    """
+    results = [None] * len(args)
+    tasks = iter(enumerate(args))
+    lock = threading.Lock()
+
+    def work():
+        try:
+            while True:
+                with lock:
+                    task = next(tasks, None)
+                if task is None:
+                    return
+                results[task[0]] = function(*task[1])
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Command(BaseCommand):
+    """
+    Creates consumers, signs launches of their users and sends them with a
+    thread or process pool to a running server (--url) or to the test client
+    in a test database. It reports the throughput, the latency percentiles,
+    the outcomes by class and the queries per launch (in process only).
+    """
+    help = 'Fires concurrent signed LTI launches as a simulated LMS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url',
+                            help='launch URL of a running server, e.g. '
+                                 'http://127.0.0.1:8000/lti/launch; the '
+                                 'test client is used if it is missing')
+        parser.add_argument('--launches', type=int, default=1000,
+                            help='number of launches')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='number of concurrent launches')
+        parser.add_argument('--pool', choices=['thread', 'process'],
+                            default='thread',
+                            help='pool sending the launches, process '
+                                 'requires --url')
+        parser.add_argument('--consumers', type=int, default=5,
+                            help='number of simulated consumers')
+        parser.add_argument('--users', type=int, default=100,
+                            help='number of users per consumer')
+        parser.add_argument('--replay-ratio', type=float, default=0.0,
+                            help='share of launches resending the data of '
+                                 'an earlier launch')
+        parser.add_argument('--same-user', action='store_true',
+                            help='all launches are first launches of one '
+                                 'user to reproduce the provisioning race')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='seed of the random generator')
+
+    def handle(self, *args, **options):
+        if options['pool'] == 'process' and not options['url']:
+            raise CommandError('--pool process requires --url')
+        if options['launches'] < 1 or options['concurrency'] < 1 or \
+                options['consumers'] < 1 or options['users'] < 1:
+            raise CommandError('--launches, --concurrency, --consumers and '
+                               '--users have to be at least 1')
+        self.random = random.Random(options['seed'])
+        if options['url']:
+            self.run_http(options)
+        else:
+            self.run_in_process(options)
+
+    def create_consumers(self, n):
+        """
+        Returns n consumers, created if they do not exist.
+        """
+        admin, created = get_user_model().objects.get_or_create(
+            username=KEY_PREFIX + '_admin')
+        consumers = []
+        for i in range(n):
+            consumer, created = Consumer.objects.get_or_create(
+                key='%skey%012d' % (KEY_PREFIX, i),
+                defaults={'secret': '%ssecret%012d' % (KEY_PREFIX, i),
+                          'user': admin})
+            consumers.append(consumer)
+        return consumers
+
+    def launches(self, consumers, launch_url, options):
+        """
+        Returns a list of tuples of a replay flag and the signed POST data
+        of each launch. With --same-user all launches come from the first
+        consumer, as a user is only the same one of the same consumer.
+        """
+        run = '%d' % time.time_ns()
+        launches = []
+        for i in range(options['launches']):
+            if launches and self.random.random() < options['replay_ratio']:
+                launches.append((True, self.random.choice(launches)[1]))
+                continue
+            if options['same_user']:
+                consumer = consumers[0]
+                uid = 'race-' + run
+            else:
+                consumer = self.random.choice(consumers)
+                uid = 'user-%d' % self.random.randrange(options['users'])
+            launches.append((False, signed_launch_data(
+                consumer, launch_url, user_id=uid,
+                lis_person_contact_email_primary=uid + '@example.com')))
+        return launches
+
+    def run_http(self, options):
+        """
+        Sends the launches to a running server. Its database has to be the
+        configured one, so the consumers are created there.
+        """
+        consumers = self.create_consumers(options['consumers'])
+        launches = self.launches(consumers, options['url'], options)
+        executor_class = ThreadPoolExecutor
+        if options['pool'] == 'process':
+            executor_class = ProcessPoolExecutor
+        start = time.perf_counter()
+        with executor_class(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(
+                post_http, [options['url']] * len(launches),
+                [data for replay, data in launches]))
+        duration = time.perf_counter() - start
+        self.report(launches, [r + (None,) for r in results], duration)
+
+    def run_in_process(self, options):
+        """
+        Sends the launches to the test client in a test database.
+        """
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            consumers = self.create_consumers(options['consumers'])
+            path = reverse('lti_provider.views.lti_launch')
+            launches = self.launches(consumers, 'http://testserver' + path,
+                                     options)
+            start = time.perf_counter()
+            results = run_in_threads(
+                post_in_process,
+                [(path, data) for replay, data in launches],
+                options['concurrency'])
+            duration = time.perf_counter() - start
+            self.report(launches, results, duration)
+        finally:
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def classify(self, replay, status, location, error):
+        """
+        Returns the outcome class of a launch.
+        """
+        if error:
+            return error
+        if status == 302:
+            if location and location.endswith(self.failed_url):
+                return 'replay_rejected' if replay else 'rejected'
+            return 'success'
+        return 'http_%s' % status
+
+    def report(self, launches, results, duration):
+        """
+        Writes the throughput, latency percentiles, outcomes, database
+        errors and queries.
+        """
+        self.failed_url = reverse_from_settings(
+            settings.LTI_PROVIDER['FAILED_VIEW'])
+        latencies = sorted(r[2] for r in results)
+        outcomes = {}
+        db_errors = {}
+        for (replay, data), r in zip(launches, results):
+            if r[3] and r[3].startswith(DB_ERROR_PREFIX):
+                name = r[3][len(DB_ERROR_PREFIX):]
+                db_errors[name] = db_errors.get(name, 0) + 1
+                continue
+            name = self.classify(replay, r[0], r[1], r[3])
+            outcomes[name] = outcomes.get(name, 0) + 1
+        n = len(results)
+        self.stdout.write('launches     %d in %.2f s (%.1f launches/s)' % (
+            n, duration, n / duration if duration > 0 else 0.0))
+        self.stdout.write('latency ms   p50 %.1f  p95 %.1f  p99 %.1f  '
+                          'max %.1f' % tuple(
+                              1000 * v for v in (
+                                  percentile(latencies, 50),
+                                  percentile(latencies, 95),
+                                  percentile(latencies, 99),
+                                  latencies[-1])))
+        for name in sorted(outcomes):
+            self.stdout.write('outcome      %-20s %d' % (name,
+                                                         outcomes[name]))
+        for name in sorted(db_errors):
+            self.stdout.write('db error     %-20s %d' % (name,
+                                                         db_errors[name]))
+        queries = [r[4] for r in results if r[4] is not None]
+        if queries:
+            self.stdout.write('queries      %.1f per launch (max %d)' % (
+                sum(queries) / len(queries), max(queries)))
+        else:
+            self.stdout.write('queries      not measured for --url')
+
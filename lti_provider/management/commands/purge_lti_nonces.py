@@ -0,0 +1,97 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command to delete expired timestamps and
+nonces.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lti_provider.models import NonceDigest, TimestampAndNonce
+from lti_provider.nonces import CompactNonceStore
+from lti_provider.routers import nonce_database
+from lti_provider.validators import LTIValidator
+
+
+class Command(BaseCommand):
+    """
+    Deletes all timestamps and nonces which are older than the accepted
+    timestamp window in batches. Each batch is a short delete by primary
+    key, so the command could run under cron without long locks. The
+    digests of the CompactNonceStore are deleted the same way, oldest
+    bucket first.
+    """
+    help = 'Deletes expired LTI timestamps and nonces in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of rows deleted per batch')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='seconds to wait between batches')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size has to be at least 1')
+        cutoff = int(time.time()) - LTIValidator().timestamp_lifetime
+        nonces = TimestampAndNonce.objects.using(nonce_database())
+        expired = nonces.filter(timestamp__lt=cutoff)
+
+        start = time.monotonic()
+        deleted = self.delete_in_batches(nonces, expired, batch_size,
+                                         options['sleep'])
+        cutoff_bucket = cutoff // CompactNonceStore().bucket_seconds
+        digests = NonceDigest.objects.using(nonce_database())
+        deleted += self.delete_in_batches(
+            digests, digests.filter(bucket__lt=cutoff_bucket).order_by(
+                'bucket', 'pk'), batch_size, options['sleep'])
+        duration = time.monotonic() - start
+
+        rate = deleted / duration if duration > 0 else 0.0
+        self.stdout.write('Deleted %d rows in %.2f seconds (%.0f rows/s).' % (
+            deleted, duration, rate))
+
+    def delete_in_batches(self, rows, expired, batch_size, sleep):
+        """
+        Deletes the expired rows in batches of at most batch_size primary
+        keys and returns their number.
+
+        Keyword arguments:
+            - rows -- queryset of all rows of the model
+            - expired -- queryset of the expired rows
+            - batch_size -- number of rows deleted per batch
+            - sleep -- seconds to wait between batches
+        """
+        deleted = 0
+        while True:
+            pks = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            n, _ = rows.filter(pk__in=pks).delete()
+            deleted += n
+            if len(pks) < batch_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+        return deleted
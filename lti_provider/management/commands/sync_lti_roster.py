@@ -0,0 +1,63 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides a management command to synchronize the roster of a
+course with the users.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lti_provider.models import Consumer
+from lti_provider.roster import RosterError, RosterSync
+
+
+class Command(BaseCommand):
+    """
+    Reads the membership of a course from the membership service of a
+    consumer and creates or updates the users of its active members. The
+    URL is the custom_context_memberships_url or the ext_ims_lis_memberships
+    URL sent by the consumer with a launch.
+    """
+    help = 'Creates or updates the users of the roster of a course.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('consumer', help='key of the consumer')
+        parser.add_argument('url', help='URL of the membership service')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='number of members processed per chunk')
+
+    def handle(self, *args, **options):
+        try:
+            consumer = Consumer.objects.get(key=options['consumer'])
+        except Consumer.DoesNotExist:
+            raise CommandError('unknown consumer %s' % options['consumer'])
+        batch_size = options['batch_size']
+        if batch_size is not None and batch_size < 1:
+            raise CommandError('--batch-size has to be at least 1')
+
+        try:
+            counts = RosterSync(consumer, batch_size).sync(options['url'])
+        except RosterError as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            '%(created)d created, %(linked)d linked, %(updated)d updated, '
+            '%(unchanged)d unchanged, %(skipped)d skipped' % counts)
@@ -0,0 +1,265 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module measures the launch of the lti_provider-App if the METRICS entry
+of the LTI_PROVIDER setting is true. The phases and outcomes of the launches
+are sent as the signals launch_phase and launch_outcome and aggregated into
+in-process histograms and counters, which the metrics view renders in the
+Prometheus text format. If METRICS is disabled nothing is measured or sent.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+from django.dispatch import receiver
+
+from lti_provider.cache import consumer_cache
+from lti_provider.hooks import DURATION_BUCKETS, hook_stats
+from lti_provider.prevalidation import prevalidation_stats
+from lti_provider.signals import launch_outcome, launch_phase
+from lti_provider.utils import get_setting
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+OUTCOMES = ('success', 'invalid_request', 'bad_signature', 'replay',
+            'unknown_consumer', 'missing_parameter', 'inactive_user',
+            'bad_config', 'rate_limited', 'shed')
+
+
+def enabled():
+    """
+    Returns true if METRICS is enabled.
+    """
+    return get_setting('METRICS', False)
+
+
+class Histogram(object):
+    """
+    A histogram of durations with the buckets of BUCKETS.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Adds a duration in seconds.
+        """
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """
+    Holds the histograms of the phases and the counters of the outcomes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Removes all measurements.
+        """
+        with self._lock:
+            self.phases = {}
+            self.outcomes = dict((outcome, 0) for outcome in OUTCOMES)
+
+    def observe(self, phase, duration):
+        """
+        Adds the duration of a phase.
+        """
+        with self._lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram()
+            histogram.observe(duration)
+
+    def count(self, outcome):
+        """
+        Counts an outcome.
+        """
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def render(self):
+        """
+        Returns the measurements in the Prometheus text format.
+        """
+        lines = [
+            '# HELP lti_provider_launch_phase_seconds Duration of the '
+            'phases of a launch.',
+            '# TYPE lti_provider_launch_phase_seconds histogram',
+        ]
+        with self._lock:
+            for phase in sorted(self.phases):
+                histogram = self.phases[phase]
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += n
+                    lines.append(
+                        'lti_provider_launch_phase_seconds_bucket'
+                        '{phase="%s",le="%s"} %d' % (phase, bound, cumulative))
+                lines.append('lti_provider_launch_phase_seconds_sum'
+                             '{phase="%s"} %f' % (phase, histogram.sum))
+                lines.append('lti_provider_launch_phase_seconds_count'
+                             '{phase="%s"} %d' % (phase, histogram.count))
+            lines.extend([
+                '# HELP lti_provider_launch_outcomes_total Launches by '
+                'outcome.',
+                '# TYPE lti_provider_launch_outcomes_total counter',
+            ])
+            for outcome in sorted(self.outcomes):
+                lines.append('lti_provider_launch_outcomes_total'
+                             '{outcome="%s"} %d' % (
+                                 outcome, self.outcomes[outcome]))
+        stats = consumer_cache.stats()
+        lines.extend([
+            '# HELP lti_provider_consumer_cache_total Lookups of the '
+            'consumer cache.',
+            '# TYPE lti_provider_consumer_cache_total counter',
+            'lti_provider_consumer_cache_total{result="hit"} %d' % (
+                stats['hits']),
+            'lti_provider_consumer_cache_total{result="miss"} %d' % (
+                stats['misses']),
+            '# HELP lti_provider_prevalidation_rejections_total Launches '
+            'rejected before the signature was verified.',
+            '# TYPE lti_provider_prevalidation_rejections_total counter',
+        ])
+        rejections = prevalidation_stats.snapshot()
+        for reason in sorted(rejections):
+            lines.append('lti_provider_prevalidation_rejections_total'
+                         '{reason="%s"} %d' % (reason, rejections[reason]))
+        lines.extend(render_hook_stats(hook_stats.snapshot()))
+        return '\n'.join(lines) + '\n'
+
+
+def render_hook_stats(stats):
+    """
+    Returns the lines of the hook counters, the hooks waiting in or running
+    on the thread pool and the histogram of the hook durations in the
+    Prometheus text format.
+
+    Keyword arguments:
+        - stats -- a snapshot of the HookStats
+    """
+    lines = [
+        '# HELP lti_provider_hook_calls_total Executions of the hook.',
+        '# TYPE lti_provider_hook_calls_total counter',
+        'lti_provider_hook_calls_total %d' % stats['calls'],
+        '# HELP lti_provider_hook_failures_total Executions of the hook '
+        'which raised an exception.',
+        '# TYPE lti_provider_hook_failures_total counter',
+        'lti_provider_hook_failures_total %d' % stats['failures'],
+        '# HELP lti_provider_hook_inline_overflow_total Hooks run inline '
+        'because the thread pool was saturated.',
+        '# TYPE lti_provider_hook_inline_overflow_total counter',
+        'lti_provider_hook_inline_overflow_total %d' % stats['rejected'],
+        '# HELP lti_provider_hook_queue_depth Hooks waiting in or running '
+        'on the thread pool.',
+        '# TYPE lti_provider_hook_queue_depth gauge',
+        'lti_provider_hook_queue_depth %d' % stats['queued'],
+        '# HELP lti_provider_hook_seconds Duration of the hook.',
+        '# TYPE lti_provider_hook_seconds histogram',
+    ]
+    cumulative = 0
+    for bound, n in zip(DURATION_BUCKETS + ('+Inf',), stats['buckets']):
+        cumulative += n
+        lines.append('lti_provider_hook_seconds_bucket{le="%s"} %d' % (
+            bound, cumulative))
+    lines.append('lti_provider_hook_seconds_sum %f' % stats['total_time'])
+    lines.append('lti_provider_hook_seconds_count %d' % stats['calls'])
+    return lines
+
+
+registry = Registry()
+
+
+class PhaseTimer(object):
+    """
+    A context manager which sends launch_phase with the duration of its
+    block.
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        launch_phase.send(sender=PhaseTimer, phase=self.phase,
+                          duration=time.perf_counter() - self.start)
+        return False
+
+
+_null_timer = nullcontext()
+
+
+def measure(phase):
+    """
+    Returns a context manager measuring a phase of a launch. It does nothing
+    if METRICS is disabled.
+
+    Keyword arguments:
+        - phase -- name of the phase
+    """
+    if not enabled():
+        return _null_timer
+    return PhaseTimer(phase)
+
+
+def outcome(name):
+    """
+    Sends launch_outcome if METRICS is enabled.
+
+    Keyword arguments:
+        - name -- one of OUTCOMES
+    """
+    if enabled():
+        launch_outcome.send(sender=None, outcome=name)
+
+
+@receiver(launch_phase)
+def record_phase(sender, phase, duration, **kwargs):
+    """
+    Adds a measured phase to the histograms.
+    """
+    registry.observe(phase, duration)
+
+
+@receiver(launch_outcome)
+def record_outcome(sender, outcome, **kwargs):
+    """
+    Adds an outcome to the counters.
+    """
+    registry.count(outcome)
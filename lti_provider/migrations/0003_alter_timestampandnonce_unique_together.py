@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:38
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti_provider', '0002_auto_20170914_1603'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='timestampandnonce',
+            unique_together={('consumer', 'timestamp', 'nonce')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti_provider', '0003_alter_timestampandnonce_unique_together'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='timestampandnonce',
+            name='timestamp',
+            field=models.IntegerField(db_index=True, verbose_name='Timestamp'),
+        ),
+    ]
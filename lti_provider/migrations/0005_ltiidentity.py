@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lti_provider', '0004_alter_timestampandnonce_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LTIIdentity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid_hash', models.CharField(max_length=40, verbose_name='User ID hash')),
+                ('consumer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lti_provider.consumer', verbose_name='Consumer')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lti_identities', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'LTI identity',
+                'verbose_name_plural': 'LTI identities',
+                'unique_together': {('consumer', 'uid_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lti_provider', '0005_ltiidentity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LTIResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_link_id', models.CharField(max_length=255, verbose_name='Resource link ID')),
+                ('sourcedid', models.TextField(verbose_name='Result sourcedid')),
+                ('service_url', models.TextField(verbose_name='Outcome service URL')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Updated')),
+                ('consumer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lti_provider.consumer', verbose_name='Consumer')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lti_results', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'LTI result',
+                'verbose_name_plural': 'LTI results',
+                'unique_together': {('consumer', 'user', 'resource_link_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='LTIScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(verbose_name='Score')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('coalesced', 'Coalesced'), ('failed', 'Failed')], default='pending', max_length=10, verbose_name='Status')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next attempt')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('sent', models.DateTimeField(blank=True, null=True, verbose_name='Sent')),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scores', to='lti_provider.ltiresult', verbose_name='Result')),
+            ],
+            options={
+                'verbose_name': 'LTI score',
+                'verbose_name_plural': 'LTI scores',
+                'indexes': [models.Index(fields=['status', 'next_attempt'], name='lti_provide_status_8dbb26_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti_provider', '0006_ltiresult_ltiscore'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NonceDigest',
+            fields=[
+                ('digest', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='Digest')),
+                ('bucket', models.IntegerField(db_index=True, verbose_name='Bucket')),
+            ],
+            options={
+                'verbose_name': 'Nonce digest',
+                'verbose_name_plural': 'Nonce digests',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti_provider', '0007_noncedigest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='timestampandnonce',
+            name='consumer',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='lti_provider.consumer', verbose_name='Consumer'),
+        ),
+    ]
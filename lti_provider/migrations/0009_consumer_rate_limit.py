@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:22
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti_provider', '0008_timestampandnonce_consumer_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='consumer',
+            name='rate_burst',
+            field=models.PositiveIntegerField(blank=True, help_text='Launches at once, empty for the default.', null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Rate burst'),
+        ),
+        migrations.AddField(
+            model_name='consumer',
+            name='rate_limit',
+            field=models.FloatField(blank=True, help_text='Launches per second, empty for the default.', null=True, validators=[django.core.validators.MinValueValidator(0.001)], verbose_name='Rate limit'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti_provider', '0009_consumer_rate_limit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Platform',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('issuer', models.CharField(max_length=255, verbose_name='Issuer')),
+                ('client_id', models.CharField(max_length=255, verbose_name='Client ID')),
+                ('deployment_id', models.CharField(blank=True, max_length=255, verbose_name='Deployment ID')),
+                ('auth_login_url', models.URLField(max_length=500, verbose_name='Auth login URL')),
+                ('key_set_url', models.URLField(max_length=500, verbose_name='Key set URL')),
+                ('consumer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='platforms', to='lti_provider.consumer', verbose_name='Consumer')),
+            ],
+            options={
+                'verbose_name': 'Platform',
+                'verbose_name_plural': 'Platforms',
+                'unique_together': {('issuer', 'client_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti_provider', '0010_platform'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ltiidentity',
+            name='role_groups',
+            field=models.CharField(blank=True, default='', max_length=255, verbose_name='Role groups'),
+        ),
+    ]
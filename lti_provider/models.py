@@ -23,8 +23,10 @@
 This module provides all Django-Database-Models of the lti_provider-App.
 """
 
+from django.core.validators import MinValueValidator
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from lti_provider.field_validators import validate_oauth_chars, \
                                           validate_oauth_length
@@ -38,6 +40,8 @@ class Consumer(models.Model):
         - key -- a key to identify a consumer
         - secret -- the key of the consumer
         - user -- a user responsible for a consumer
+        - rate_limit -- launches per second or None for RATE_LIMIT
+        - rate_burst -- launches at once or None for RATE_BURST
     """
     key = models.CharField(max_length=128, unique=True,
                            verbose_name=_('Key'),
@@ -50,6 +54,14 @@ class Consumer(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE,
                              verbose_name=_('User'))
+    rate_limit = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(0.001)],
+        verbose_name=_('Rate limit'),
+        help_text=_('Launches per second, empty for the default.'))
+    rate_burst = models.PositiveIntegerField(
+        null=True, blank=True, validators=[MinValueValidator(1)],
+        verbose_name=_('Rate burst'),
+        help_text=_('Launches at once, empty for the default.'))
 
     def __str__(self):
         """
@@ -72,11 +84,14 @@ class TimestampAndNonce(models.Model):
         - timestamp -- time of the request as int
         - nonce -- a string related to this timestamp only
     """
+    # without a constraint, as the rows may be stored in another database
     consumer = models.ForeignKey(Consumer,
                                  on_delete=models.CASCADE,
+                                 db_constraint=False,
                                  verbose_name=_('Consumer'))
 
-    timestamp = models.IntegerField(verbose_name=_('Timestamp'))
+    timestamp = models.IntegerField(db_index=True,
+                                    verbose_name=_('Timestamp'))
     nonce = models.CharField(max_length=128, verbose_name=_('Nonce'))
 
     def __str__(self):
@@ -86,6 +101,200 @@ class TimestampAndNonce(models.Model):
         return str(self.timestamp)
 
     class Meta:
-        unique_together = ('timestamp', 'nonce')
+        unique_together = ('consumer', 'timestamp', 'nonce')
         verbose_name = _('Timestamp and Nonce')
         verbose_name_plural = _('Timestamps and Nonces')
+
+
+class NonceDigest(models.Model):
+    """
+    This model is the compact alternative to TimestampAndNonce used by the
+    CompactNonceStore. A request is identified by a 64 bit digest of its
+    consumer, timestamp and nonce and expires with the bucket of its
+    timestamp.
+
+    Fields:
+        - digest -- signed 64 bit digest of consumer, timestamp and nonce
+        - bucket -- timestamp divided by the bucket width
+    """
+    digest = models.BigIntegerField(primary_key=True,
+                                    verbose_name=_('Digest'))
+    bucket = models.IntegerField(db_index=True, verbose_name=_('Bucket'))
+
+    def __str__(self):
+        """
+        unicode representation
+        """
+        return str(self.digest)
+
+    class Meta:
+        verbose_name = _('Nonce digest')
+        verbose_name_plural = _('Nonce digests')
+
+
+class LTIIdentity(models.Model):
+    """
+    This model maps the user of a consumer to a local user.
+
+    Fields:
+        - consumer -- the consumer of the user
+        - uid_hash -- sha1 hex digest of the user_id sent by the consumer
+        - user -- the local user
+        - role_groups -- IDs of the groups mapped to the roles of the last
+          launch
+    """
+    consumer = models.ForeignKey(Consumer,
+                                 on_delete=models.CASCADE,
+                                 verbose_name=_('Consumer'))
+    uid_hash = models.CharField(max_length=40, verbose_name=_('User ID hash'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE,
+                             related_name='lti_identities',
+                             verbose_name=_('User'))
+    role_groups = models.CharField(max_length=255, blank=True, default='',
+                                   verbose_name=_('Role groups'))
+
+    def __str__(self):
+        """
+        unicode representation
+        """
+        return str(self.uid_hash)
+
+    class Meta:
+        unique_together = ('consumer', 'uid_hash')
+        verbose_name = _('LTI identity')
+        verbose_name_plural = _('LTI identities')
+
+
+class LTIResult(models.Model):
+    """
+    This model stores where the score of a user for a resource link is sent
+    to, as recorded at the last launch.
+
+    Fields:
+        - consumer -- the consumer of the launch
+        - user -- the local user
+        - resource_link_id -- the resource link of the launch
+        - sourcedid -- the lis_result_sourcedid sent by the consumer
+        - service_url -- the lis_outcome_service_url sent by the consumer
+        - updated -- time of the last change
+    """
+    consumer = models.ForeignKey(Consumer,
+                                 on_delete=models.CASCADE,
+                                 verbose_name=_('Consumer'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE,
+                             related_name='lti_results',
+                             verbose_name=_('User'))
+    resource_link_id = models.CharField(max_length=255,
+                                        verbose_name=_('Resource link ID'))
+    sourcedid = models.TextField(verbose_name=_('Result sourcedid'))
+    service_url = models.TextField(verbose_name=_('Outcome service URL'))
+    updated = models.DateTimeField(auto_now=True, verbose_name=_('Updated'))
+
+    def __str__(self):
+        """
+        unicode representation
+        """
+        return str(self.resource_link_id)
+
+    class Meta:
+        unique_together = ('consumer', 'user', 'resource_link_id')
+        verbose_name = _('LTI result')
+        verbose_name_plural = _('LTI results')
+
+
+class LTIScore(models.Model):
+    """
+    This model queues the scores which are sent to the consumers by the
+    outcome worker.
+
+    Fields:
+        - result -- the result the score is sent for
+        - score -- the score between 0.0 and 1.0
+        - status -- pending, sending, sent, coalesced or failed
+        - attempts -- number of failed attempts to send the score
+        - next_attempt -- time the score is sent (again)
+        - error -- the last error
+        - created -- time the score was queued
+        - sent -- time the score was sent
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    COALESCED = 'coalesced'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (SENDING, _('Sending')),
+        (SENT, _('Sent')),
+        (COALESCED, _('Coalesced')),
+        (FAILED, _('Failed')),
+    )
+
+    result = models.ForeignKey(LTIResult,
+                               on_delete=models.CASCADE,
+                               related_name='scores',
+                               verbose_name=_('Result'))
+    score = models.FloatField(verbose_name=_('Score'))
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, verbose_name=_('Status'))
+    attempts = models.PositiveSmallIntegerField(default=0,
+                                                verbose_name=_('Attempts'))
+    next_attempt = models.DateTimeField(default=timezone.now,
+                                        verbose_name=_('Next attempt'))
+    error = models.TextField(blank=True, verbose_name=_('Error'))
+    created = models.DateTimeField(auto_now_add=True,
+                                   verbose_name=_('Created'))
+    sent = models.DateTimeField(null=True, blank=True,
+                                verbose_name=_('Sent'))
+
+    def __str__(self):
+        """
+        unicode representation
+        """
+        return '%s %s' % (self.score, self.status)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+        verbose_name = _('LTI score')
+        verbose_name_plural = _('LTI scores')
+
+
+class Platform(models.Model):
+    """
+    This model registers a LTI 1.3 platform. The users of its launches are
+    identified and provisioned like the users of the linked consumer.
+
+    Fields:
+        - issuer -- the iss claim of the platform
+        - client_id -- the client ID of the tool at the platform
+        - deployment_id -- the accepted deployment or empty for all
+        - auth_login_url -- the OIDC authorization endpoint
+        - key_set_url -- the URL of the JWKS of the platform
+        - consumer -- the consumer whose identities the launches use
+    """
+    issuer = models.CharField(max_length=255, verbose_name=_('Issuer'))
+    client_id = models.CharField(max_length=255,
+                                 verbose_name=_('Client ID'))
+    deployment_id = models.CharField(max_length=255, blank=True,
+                                     verbose_name=_('Deployment ID'))
+    auth_login_url = models.URLField(max_length=500,
+                                     verbose_name=_('Auth login URL'))
+    key_set_url = models.URLField(max_length=500,
+                                  verbose_name=_('Key set URL'))
+    consumer = models.ForeignKey(Consumer,
+                                 on_delete=models.CASCADE,
+                                 related_name='platforms',
+                                 verbose_name=_('Consumer'))
+
+    def __str__(self):
+        """
+        unicode representation
+        """
+        return '%s (%s)' % (self.issuer, self.client_id)
+
+    class Meta:
+        unique_together = ('issuer', 'client_id')
+        verbose_name = _('Platform')
+        verbose_name_plural = _('Platforms')
@@ -0,0 +1,229 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the stores used by the validators of the
+lti_provider-App to record the nonces of the requests. The store is
+configured with the NONCE_BACKEND entry of the LTI_PROVIDER setting.
+"""
+
+import time
+from functools import lru_cache
+from hashlib import blake2b
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+
+from lti_provider.models import NonceDigest, TimestampAndNonce
+from lti_provider.routers import nonce_database
+from lti_provider.utils import get_by_py_path, get_setting
+
+DEFAULT_NONCE_BACKEND = 'lti_provider.nonces.ModelNonceStore'
+
+
+class BaseNonceStore(object):
+    """
+    The base class of all nonce stores.
+    """
+
+    def add(self, consumer, timestamp, nonce, lifetime):
+        """
+        Records a timestamp and nonce of a consumer. Returns true if they
+        were not recorded before and false if the request is a replay.
+
+        Keyword arguments:
+            - consumer -- the consumer of the request
+            - timestamp -- the timestamp of the request
+            - nonce -- the nonce of the request
+            - lifetime -- seconds a timestamp is accepted by the validator
+        """
+        raise NotImplementedError
+
+    async def aadd(self, consumer, timestamp, nonce, lifetime):
+        """
+        Async version of add. Stores without a native implementation run
+        add in a thread.
+        """
+        return await sync_to_async(self.add)(consumer, timestamp, nonce,
+                                             lifetime)
+
+
+class ModelNonceStore(BaseNonceStore):
+    """
+    Records the nonces in the TimestampAndNonce model. A nonce is recorded
+    with a single INSERT and a replay is detected by the unique constraint
+    on consumer, timestamp and nonce, so concurrent requests can not both
+    pass.
+    """
+
+    def add(self, consumer, timestamp, nonce, lifetime):
+        return insert_once(TimestampAndNonce(
+            consumer_id=consumer.pk,
+            timestamp=timestamp,
+            nonce=nonce))
+
+    async def aadd(self, consumer, timestamp, nonce, lifetime):
+        return await ainsert_once(TimestampAndNonce,
+                                  consumer_id=consumer.pk,
+                                  timestamp=timestamp,
+                                  nonce=nonce)
+
+
+class CompactNonceStore(BaseNonceStore):
+    """
+    Records the nonces in the NonceDigest model: a 64 bit digest of the
+    consumer, timestamp and nonce as primary key and the bucket of the
+    timestamp (NONCE_BUCKET_SECONDS, default: 60). The rows and the index are
+    a fraction of TimestampAndNonce and expire by bucket. Two different
+    requests are rejected as replay only if their digests collide, which
+    is negligible for the requests of a timestamp window.
+    """
+
+    @property
+    def bucket_seconds(self):
+        """
+        Returns the width of a bucket in seconds.
+        """
+        return get_setting('NONCE_BUCKET_SECONDS', 60)
+
+    def add(self, consumer, timestamp, nonce, lifetime):
+        return insert_once(NonceDigest(
+            digest=nonce_digest(consumer.pk, timestamp, nonce),
+            bucket=int(timestamp) // self.bucket_seconds))
+
+    async def aadd(self, consumer, timestamp, nonce, lifetime):
+        return await ainsert_once(
+            NonceDigest,
+            defaults={'bucket': int(timestamp) // self.bucket_seconds},
+            digest=nonce_digest(consumer.pk, timestamp, nonce))
+
+
+def nonce_digest(consumer_pk, timestamp, nonce):
+    """
+    Returns the signed 64 bit digest of the consumer, timestamp and nonce of
+    a request.
+
+    Keyword arguments:
+        - consumer_pk -- primary key of the consumer
+        - timestamp -- the timestamp of the request
+        - nonce -- the nonce of the request
+    """
+    value = '%s:%s:%s' % (consumer_pk, int(timestamp), nonce)
+    return int.from_bytes(blake2b(value.encode('utf-8'),
+                                  digest_size=8).digest(),
+                          'big', signed=True)
+
+
+def insert_once(obj):
+    """
+    Inserts a row into the nonce database and returns false if it violates
+    a unique constraint.
+
+    Keyword arguments:
+        - obj -- the unsaved model instance
+    """
+    using = nonce_database()
+    try:
+        if transaction.get_connection(using).in_atomic_block:
+            # a savepoint keeps a surrounding transaction usable
+            with transaction.atomic(using=using):
+                obj.save(force_insert=True, using=using)
+        else:
+            obj.save(force_insert=True, using=using)
+    except IntegrityError:
+        return False
+    return True
+
+
+async def ainsert_once(model, defaults=None, **fields):
+    """
+    Async version of insert_once with the async ORM. get_or_create handles
+    a concurrent insert in a savepoint of its own, so a replay does not
+    break a surrounding transaction.
+
+    Keyword arguments:
+        - model -- the model of the row
+        - defaults -- fields which are not part of the unique constraint
+        - fields -- the fields of the unique constraint
+    """
+    obj, created = await model.objects.using(
+        nonce_database()).aget_or_create(defaults=defaults, **fields)
+    return created
+
+
+class CacheNonceStore(BaseNonceStore):
+    """
+    Records the nonces in the Django cache configured by the NONCE_CACHE
+    entry of the LTI_PROVIDER setting (default: 'default'). The cache has to
+    be shared by all processes, e.g. memcached or redis, and has to support
+    an atomic add. An entry expires when its timestamp is no longer accepted
+    by the validator.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        Keyword arguments:
+            - clock -- callable returning the current unix time
+        """
+        self._clock = clock
+
+    @property
+    def cache(self):
+        """
+        Returns the configured cache.
+        """
+        return caches[get_setting('NONCE_CACHE', 'default')]
+
+    def add(self, consumer, timestamp, nonce, lifetime):
+        return self.cache.add(*self._entry(consumer, timestamp, nonce,
+                                           lifetime))
+
+    async def aadd(self, consumer, timestamp, nonce, lifetime):
+        return await self.cache.aadd(*self._entry(consumer, timestamp, nonce,
+                                                  lifetime))
+
+    def _entry(self, consumer, timestamp, nonce, lifetime):
+        """
+        Returns the key, value and timeout of the cache entry of a nonce.
+        """
+        key = 'lti_provider:nonce:%s:%s:%s' % (consumer.pk, timestamp, nonce)
+        timeout = int(timestamp) + lifetime - int(self._clock())
+        return key, 1, max(timeout, 1)
+
+
+@lru_cache(maxsize=None)
+def _load_nonce_store(py_path):
+    """
+    Imports and instantiates a nonce store once per path.
+
+    Keyword arguments:
+        py_path -- class of the nonce store
+    """
+    return get_by_py_path(py_path)()
+
+
+def get_nonce_store():
+    """
+    Returns the nonce store configured by NONCE_BACKEND.
+    """
+    return _load_nonce_store(
+        get_setting('NONCE_BACKEND', DEFAULT_NONCE_BACKEND))
@@ -0,0 +1,347 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the outcome service (grade passback) of the
+lti_provider-App. The launch records where the score of a user for a
+resource link is sent to (LTIResult), the scores are queued as LTIScore and
+sent by the OutcomeWorker, e.g. with the management command
+flush_lti_outcomes.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.db import connection, transaction
+from django.utils import timezone
+from lti import OutcomeRequest, OutcomeResponse
+from lti.outcome_request import REPLACE_REQUEST
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+from requests_oauthlib.oauth1_auth import SIGNATURE_TYPE_AUTH_HEADER
+
+from lti_provider.models import LTIResult, LTIScore
+from lti_provider.utils import get_setting
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+# seconds a claimed score is not sent by another worker
+SENDING_LEASE = 300
+
+
+def record_result(consumer, user, launch_params):
+    """
+    Records the lis_result_sourcedid and lis_outcome_service_url of a launch
+    and returns the LTIResult or None if the launch did not send them.
+
+    Keyword arguments:
+        - consumer -- the consumer of the launch
+        - user -- the user of the launch
+        - launch_params -- the launch parameters
+    """
+    values = result_values(launch_params)
+    if values is None:
+        return None
+    result, created = LTIResult.objects.get_or_create(
+        consumer=consumer, user=user,
+        resource_link_id=launch_params.get('resource_link_id'),
+        defaults=values)
+    if not created and update_result(result, values):
+        result.save(update_fields=['sourcedid', 'service_url', 'updated'])
+    return result
+
+
+async def arecord_result(consumer, user, launch_params):
+    """
+    Async version of record_result.
+
+    Keyword arguments:
+        - consumer -- the consumer of the launch
+        - user -- the user of the launch
+        - launch_params -- the launch parameters
+    """
+    values = result_values(launch_params)
+    if values is None:
+        return None
+    result, created = await LTIResult.objects.aget_or_create(
+        consumer=consumer, user=user,
+        resource_link_id=launch_params.get('resource_link_id'),
+        defaults=values)
+    if not created and update_result(result, values):
+        await result.asave(update_fields=['sourcedid', 'service_url',
+                                          'updated'])
+    return result
+
+
+def result_values(launch_params):
+    """
+    Returns a dictionary of the sourcedid and the service_url of a launch or
+    None if one of them or the resource_link_id is missing.
+    """
+    values = {
+        'sourcedid': launch_params.get('lis_result_sourcedid'),
+        'service_url': launch_params.get('lis_outcome_service_url'),
+    }
+    if not all(values.values()) or \
+            not launch_params.get('resource_link_id'):
+        return None
+    return values
+
+
+def update_result(result, values):
+    """
+    Sets the values of a result and returns true if they changed.
+    """
+    changed = False
+    for field, value in values.items():
+        if getattr(result, field) != value:
+            setattr(result, field, value)
+            changed = True
+    return changed
+
+
+def check_score(score):
+    """
+    Returns the score as float or raises a ValueError if it is not between
+    0.0 and 1.0 as required by the LTI.
+    """
+    score = float(score)
+    if not 0.0 <= score <= 1.0:
+        raise ValueError('score %s is not between 0.0 and 1.0' % score)
+    return score
+
+
+def submit_score(result, score):
+    """
+    Queues a score for a result and returns the LTIScore.
+
+    Keyword arguments:
+        - result -- the LTIResult
+        - score -- the score between 0.0 and 1.0
+    """
+    return LTIScore.objects.create(result=result, score=check_score(score))
+
+
+def submit_scores(scores, batch_size=1000):
+    """
+    Queues many scores, e.g. of a regrade, with bulk inserts and returns
+    their number.
+
+    Keyword arguments:
+        - scores -- iterable of tuples of a LTIResult and a score
+        - batch_size -- rows per insert
+    """
+    objs = [LTIScore(result=result, score=check_score(score))
+            for result, score in scores]
+    LTIScore.objects.bulk_create(objs, batch_size=batch_size)
+    return len(objs)
+
+
+class OutcomeWorker(object):
+    """
+    Sends the queued scores with replaceResult requests. Only the latest
+    pending score of a result is sent, older ones are marked as coalesced.
+    The requests are sent by a pool of OUTCOMES_THREADS threads (default: 8)
+    over pooled keep-alive connections, at most OUTCOMES_CONCURRENCY
+    (default: 2) at a time to the same consumer. Network errors, HTTP 429
+    and 5xx responses are retried after OUTCOMES_BACKOFF seconds (default:
+    30), doubled after each attempt, until OUTCOMES_MAX_ATTEMPTS (default:
+    5) attempts failed. Other errors and rejections by the consumer are
+    final. The database is only accessed by the thread calling flush.
+    """
+
+    def __init__(self, session=None):
+        """
+        Keyword arguments:
+            - session -- the requests.Session to send with, a pooled one is
+              created if it is missing
+        """
+        self.threads = get_setting('OUTCOMES_THREADS', 8)
+        self.concurrency = get_setting('OUTCOMES_CONCURRENCY', 2)
+        self.backoff = get_setting('OUTCOMES_BACKOFF', 30)
+        self.max_attempts = get_setting('OUTCOMES_MAX_ATTEMPTS', 5)
+        self.timeout = get_setting('OUTCOMES_TIMEOUT', 10)
+        self.batch_size = get_setting('OUTCOMES_BATCH_SIZE', 500)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.threads,
+                                  pool_maxsize=self.threads)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._lock = threading.Lock()
+        self._limits = {}
+
+    def close(self):
+        """
+        Stops the threads and closes the connections.
+        """
+        self._executor.shutdown()
+        self.session.close()
+
+    def flush(self, now=None):
+        """
+        Sends the due scores of one batch and returns a dictionary of the
+        number of sent, coalesced, retried and failed scores.
+
+        Keyword arguments:
+            - now -- the current time, default: timezone.now()
+        """
+        now = now or timezone.now()
+        counts = dict.fromkeys(('sent', 'coalesced', 'retried', 'failed'), 0)
+        scores, counts['coalesced'] = self.claim(now)
+        futures = [self._executor.submit(self.send, score)
+                   for score in scores]
+        for score, future in zip(scores, futures):
+            try:
+                status, error = future.result()
+            except Exception as e:
+                logger.exception('sending score %s failed', score.pk)
+                status, error = LTIScore.PENDING, type(e).__name__
+            if status == LTIScore.SENT:
+                score.status, score.sent, score.error = status, now, ''
+                counts['sent'] += 1
+                continue
+            score.attempts += 1
+            score.error = error
+            if status == LTIScore.PENDING and \
+                    score.attempts < self.max_attempts:
+                score.status = LTIScore.PENDING
+                score.next_attempt = now + timedelta(
+                    seconds=self.backoff * 2 ** (score.attempts - 1))
+                counts['retried'] += 1
+            else:
+                score.status = LTIScore.FAILED
+                counts['failed'] += 1
+            logger.warning('sending score %s failed: %s', score.pk, error)
+        LTIScore.objects.bulk_update(
+            scores, ['status', 'attempts', 'next_attempt', 'error', 'sent'])
+        return counts
+
+    def candidates(self, now):
+        """
+        Returns a list of the due scores of one batch, in insertion order.
+        """
+        due = LTIScore.objects.filter(
+            status__in=(LTIScore.PENDING, LTIScore.SENDING),
+            next_attempt__lte=now).order_by('pk')
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        return list(due.select_related('result__consumer')[
+            :self.batch_size])
+
+    def claim(self, now):
+        """
+        Returns a tuple of the latest due score of each result, which are
+        marked as sending, and the number of older pending scores of these
+        results, which are marked as coalesced. Scores of a worker which
+        stopped while sending are due again after SENDING_LEASE seconds.
+
+        A score is claimed with an update conditional on the status and
+        due time it was read with, so on databases without SELECT ... SKIP
+        LOCKED a score read by several workers is only sent by the one
+        whose update matched it.
+        """
+        with transaction.atomic():
+            batch = self.candidates(now)
+            latest = {}
+            for score in batch:
+                latest[score.result_id] = score
+            lease = now + timedelta(seconds=SENDING_LEASE)
+            claimed = []
+            for score in latest.values():
+                if LTIScore.objects.filter(
+                        pk=score.pk, status=score.status,
+                        next_attempt=score.next_attempt).update(
+                            status=LTIScore.SENDING, next_attempt=lease):
+                    score.status, score.next_attempt = \
+                        LTIScore.SENDING, lease
+                    claimed.append(score)
+            latest = dict((score.result_id, score) for score in claimed)
+            older = set(score.pk for score in batch
+                        if score.result_id in latest and
+                        score.pk < latest[score.result_id].pk)
+            waiting = LTIScore.objects.filter(
+                result_id__in=list(latest), status=LTIScore.PENDING)
+            for pk, result_id in waiting.values_list('pk', 'result_id'):
+                if pk < latest[result_id].pk:
+                    older.add(pk)
+            coalesced = LTIScore.objects.filter(
+                pk__in=older,
+                status__in=(LTIScore.PENDING, LTIScore.SENDING)).update(
+                    status=LTIScore.COALESCED)
+        return claimed, coalesced
+
+    def limit(self, consumer):
+        """
+        Returns the semaphore limiting the concurrent requests to a consumer.
+        """
+        with self._lock:
+            semaphore = self._limits.get(consumer.pk)
+            if semaphore is None:
+                semaphore = self._limits[consumer.pk] = \
+                    threading.BoundedSemaphore(self.concurrency)
+            return semaphore
+
+    def send(self, score):
+        """
+        Sends a score and returns a tuple of the new status (sent, pending
+        to retry or failed) and the error.
+
+        Keyword arguments:
+            - score -- the LTIScore with its result and consumer
+        """
+        result = score.result
+        consumer = result.consumer
+        request = OutcomeRequest({
+            'operation': REPLACE_REQUEST,
+            'score': score.score,
+            'lis_result_sourcedid': result.sourcedid,
+            'message_identifier': str(score.pk),
+        })
+        auth = OAuth1(consumer.key, consumer.secret,
+                      signature_type=SIGNATURE_TYPE_AUTH_HEADER,
+                      force_include_body=True)
+        with self.limit(consumer):
+            try:
+                response = self.session.post(
+                    result.service_url, data=request.generate_request_xml(),
+                    auth=auth, headers={'Content-Type': 'application/xml'},
+                    timeout=self.timeout)
+            except requests.RequestException as e:
+                return LTIScore.PENDING, type(e).__name__
+        if response.status_code == 429 or response.status_code >= 500:
+            return LTIScore.PENDING, 'HTTP %d' % response.status_code
+        if response.status_code >= 400:
+            return LTIScore.FAILED, 'HTTP %d' % response.status_code
+        outcome = OutcomeResponse.from_post_response(response,
+                                                     response.content)
+        if outcome.is_success() or outcome.is_processing():
+            return LTIScore.SENT, ''
+        if outcome.code_major is None:
+            return LTIScore.PENDING, 'invalid response'
+        return LTIScore.FAILED, '%s: %s' % (outcome.code_major,
+                                            outcome.description)
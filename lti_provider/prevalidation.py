@@ -0,0 +1,168 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the pre-validation of a launch of the lti_provider-App.
+It rejects malformed launches and launches of unknown consumers before the
+tool provider is created and the signature is verified, which needs the
+database. Launches of keys which are known to be unknown still compute a
+signature with the dummy secret, like the oauthlib does for unknown
+consumers, so the response time does not tell whether a key exists.
+"""
+
+import binascii
+import hashlib
+import hmac
+import logging
+import threading
+
+from oauthlib.oauth1.rfc5849 import (SIGNATURE_HMAC_SHA1,
+                                     SIGNATURE_HMAC_SHA256, signature,
+                                     utils)
+
+from lti_provider.cache import consumer_cache
+from lti_provider.utils import get_setting
+from lti_provider.validators import DUMMY_CLIENT_SECRET, LTIValidator
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+# parameters a launch (basic-lti-launch-request) has to send in its body
+REQUIRED_PARAMETERS = (
+    'oauth_consumer_key', 'oauth_nonce', 'oauth_signature',
+    'oauth_signature_method', 'oauth_timestamp', 'lti_message_type',
+    'lti_version', 'resource_link_id',
+)
+
+# signature methods the pre-validation accepts, other methods of the
+# oauthlib like HMAC-SHA512 are still verified if it is disabled
+SIGNATURE_METHODS = (SIGNATURE_HMAC_SHA1, SIGNATURE_HMAC_SHA256)
+
+REJECTIONS = ('missing_parameter', 'signature_method', 'timestamp', 'nonce',
+              'client_key', 'unknown_consumer')
+
+
+def enabled():
+    """
+    Returns true if PREVALIDATION is enabled (default: false).
+    """
+    return get_setting('PREVALIDATION', False)
+
+
+class PrevalidationStats(object):
+    """
+    Counts the launches rejected by the pre-validation by reason.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Sets all counters to zero.
+        """
+        with self._lock:
+            self.rejections = dict((reason, 0) for reason in REJECTIONS)
+
+    def record(self, reason):
+        """
+        Counts a rejected launch.
+
+        Keyword arguments:
+            - reason -- one of REJECTIONS
+        """
+        with self._lock:
+            self.rejections[reason] += 1
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the counters.
+        """
+        with self._lock:
+            return dict(self.rejections)
+
+
+prevalidation_stats = PrevalidationStats()
+
+
+def prevalidate(request):
+    """
+    Returns the reason (one of REJECTIONS) why a launch is rejected or None
+    if it passes the pre-validation. Only the body of the POST request is
+    checked, because the LTI sends the OAuth parameters there.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    reason = _check(request)
+    if reason is not None:
+        logger.debug('launch rejected by the pre-validation: %s', reason)
+        prevalidation_stats.record(reason)
+    return reason
+
+
+def _check(request):
+    """
+    Implements prevalidate without counting the rejection.
+    """
+    params = request.POST
+    for name in REQUIRED_PARAMETERS:
+        if len(params.getlist(name)) != 1 or not params[name]:
+            return 'missing_parameter'
+    validator = LTIValidator()
+    if params['oauth_signature_method'] not in SIGNATURE_METHODS:
+        return 'signature_method'
+    if not validator.check_timestamp(params['oauth_timestamp']):
+        return 'timestamp'
+    if not validator.check_nonce(params['oauth_nonce']):
+        return 'nonce'
+    client_key = params['oauth_consumer_key']
+    if not validator.check_client_key(client_key):
+        return 'client_key'
+    if consumer_cache.is_unknown(client_key):
+        verify_with_dummy_secret(request)
+        return 'unknown_consumer'
+    return None
+
+
+def verify_with_dummy_secret(request):
+    """
+    Verifies the signature of a launch with the dummy secret like the
+    oauthlib does for unknown consumers and returns the result.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    params = [(name, value) for name, values in request.POST.lists()
+              for value in values if name != 'oauth_signature']
+    uri = signature.base_string_uri(request.build_absolute_uri())
+    base_string = signature.signature_base_string(
+        request.method, uri, signature.normalize_parameters(params))
+    digestmod = hashlib.sha1
+    if request.POST['oauth_signature_method'] == SIGNATURE_HMAC_SHA256:
+        digestmod = hashlib.sha256
+    key = utils.escape(DUMMY_CLIENT_SECRET) + '&'
+    digest = hmac.new(key.encode('utf-8'), base_string.encode('utf-8'),
+                      digestmod).digest()
+    return hmac.compare_digest(
+        binascii.b2a_base64(digest)[:-1].decode('utf-8'),
+        request.POST['oauth_signature'])
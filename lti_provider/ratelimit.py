@@ -0,0 +1,239 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the admission control of the launches of the
+lti_provider-App. If RATE_LIMITING is enabled, the launches of each
+consumer key are limited by a token bucket before the signature is
+verified. The buckets are stored in the cache named by RATE_LIMIT_CACHE and
+in the process if the cache fails. MAX_CONCURRENT_LAUNCHES sheds the
+launches of a process beyond this number of concurrent launches.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from lti_provider.utils import get_setting
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+# maximum number of buckets kept in the process if the cache fails
+LOCAL_BUCKETS = 10000
+
+# seconds a bucket is locked at most, e.g. if a process died holding it
+LOCK_TIMEOUT = 1
+
+# seconds a launch waits for the lock of a bucket
+LOCK_WAIT = 0.1
+
+
+def enabled():
+    """
+    Returns true if RATE_LIMITING is enabled (default: false).
+    """
+    return get_setting('RATE_LIMITING', False)
+
+
+def consumer_limits(consumer):
+    """
+    Returns the rate (launches per second) and the burst of a consumer: its
+    own rate_limit and rate_burst or the RATE_LIMIT (default: 10) and
+    RATE_BURST (default: 20) settings. A rate_limit of a consumer which is
+    not positive is replaced by RATE_LIMIT, which has to be positive.
+
+    Keyword arguments:
+        - consumer -- the consumer or None for unknown keys
+    """
+    rate = getattr(consumer, 'rate_limit', None)
+    burst = getattr(consumer, 'rate_burst', None)
+    if rate is None or rate <= 0:
+        rate = get_setting('RATE_LIMIT', 10)
+        if rate <= 0:
+            raise ImproperlyConfigured('RATE_LIMIT has to be positive')
+    if burst is None:
+        burst = get_setting('RATE_BURST', 20)
+    return float(rate), max(int(burst), 1)
+
+
+def bucket_key(key):
+    """
+    Returns the cache key of the bucket of a consumer key, which is hashed,
+    so long keys or characters memcached does not accept are no problem.
+    """
+    return 'lti_provider:ratelimit:%s' % blake2b(
+        key.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class TokenBucketLimiter(object):
+    """
+    Limits the launches per key by a token bucket. A bucket holds up to
+    burst tokens and is refilled by rate tokens per second; each launch
+    takes a token. The bucket is stored as a tuple of the tokens and the
+    time of the last launch. It is read and written while holding a lock
+    taken with the atomic add of the cache, so concurrent launches of all
+    processes sharing the cache take each token once. A launch which does
+    not get the lock within LOCK_WAIT seconds is rejected like a launch
+    finding the bucket empty.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        Keyword arguments:
+            - clock -- callable returning the current time in seconds,
+                       which has to be the same for all processes
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._local = OrderedDict()
+
+    @property
+    def cache(self):
+        """
+        Returns the cache of the buckets (RATE_LIMIT_CACHE, default:
+        'default').
+        """
+        return caches[get_setting('RATE_LIMIT_CACHE', 'default')]
+
+    def acquire(self, key, rate, burst):
+        """
+        Takes a token of a key and returns 0 or the seconds until a token is
+        available if the bucket is empty.
+
+        Keyword arguments:
+            - key -- the consumer key
+            - rate -- tokens added per second
+            - burst -- maximum number of tokens
+        """
+        cache_key = bucket_key(key)
+        try:
+            cache = self.cache
+            if not self._lock_bucket(cache, cache_key + ':lock'):
+                logger.debug('bucket of %s is locked', key)
+                return 1 / rate
+            try:
+                now = self._clock()
+                state, retry_after = self._take(cache.get(cache_key), now,
+                                                rate, burst)
+                if retry_after == 0:
+                    cache.set(cache_key, state,
+                              math.ceil(burst / rate) + 1)
+                return retry_after
+            finally:
+                cache.delete(cache_key + ':lock')
+        except Exception:
+            logger.warning('rate limit cache failed, limiting in process',
+                           exc_info=True)
+        with self._lock:
+            state, retry_after = self._take(self._local.get(key),
+                                            self._clock(), rate, burst)
+            self._local[key] = state
+            self._local.move_to_end(key)
+            while len(self._local) > LOCAL_BUCKETS:
+                self._local.popitem(last=False)
+        return retry_after
+
+    async def aacquire(self, key, rate, burst):
+        """
+        Async version of acquire, which runs it in a thread.
+        """
+        return await sync_to_async(self.acquire)(key, rate, burst)
+
+    def _lock_bucket(self, cache, lock_key):
+        """
+        Returns true if the lock of a bucket was taken within LOCK_WAIT
+        seconds.
+        """
+        deadline = time.monotonic() + LOCK_WAIT
+        while not cache.add(lock_key, 1, LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def _take(self, state, now, rate, burst):
+        """
+        Returns the new state of a bucket and the seconds to wait.
+        """
+        if state is None:
+            tokens = burst
+        else:
+            tokens = min(burst, state[0] + (now - state[1]) * rate)
+        if tokens >= 1:
+            return (tokens - 1, now), 0
+        return state, (1 - tokens) / rate
+
+    def clear(self):
+        """
+        Removes the buckets of the process.
+        """
+        with self._lock:
+            self._local.clear()
+
+
+rate_limiter = TokenBucketLimiter()
+
+
+class LaunchSlots(object):
+    """
+    Counts the concurrent launches of the process. A launch is shed if
+    MAX_CONCURRENT_LAUNCHES (default: None, no limit) are running already.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+
+    def acquire(self):
+        """
+        Returns true and counts the launch if a slot is free.
+        """
+        limit = get_setting('MAX_CONCURRENT_LAUNCHES')
+        with self._lock:
+            if limit is not None and self.active >= limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        """
+        Frees the slot of a finished launch.
+        """
+        with self._lock:
+            self.active -= 1
+
+
+launch_slots = LaunchSlots()
+
+
+def retry_after_header(seconds):
+    """
+    Returns the value of a Retry-After header in whole seconds, at least 1.
+    """
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,203 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module compiles the PARAMETERS_TO_VIEW setting of the lti_provider-App
+into a table which selects the redirect of a launch.
+"""
+
+import logging
+from functools import lru_cache
+
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import (NoReverseMatch, get_resolver, get_script_prefix,
+                         get_urlconf, reverse)
+
+from lti_provider.utils import get_setting
+
+# Get an instance of a logger
+logger = logging.getLogger('LTI.lti_provider')
+
+
+class RedirectTable(object):
+    """
+    The compiled PARAMETERS_TO_VIEW setting. The routes are indexed by
+    each of their parameter names, so a launch only checks the routes of
+    the configured parameters it sends instead of walking every route.
+    """
+
+    def __init__(self, parameters_to_view):
+        """
+        Validates and compiles the routes.
+
+        Keyword arguments:
+            - parameters_to_view -- the PARAMETERS_TO_VIEW setting
+        """
+        if not isinstance(parameters_to_view, (list, tuple)):
+            raise ImproperlyConfigured(
+                'PARAMETERS_TO_VIEW has to be a list of tuples')
+        self.routes = []
+        self.index = {}
+        self.unconditional = []
+        self.parameter_names = set()
+        for i, route in enumerate(parameters_to_view):
+            if not isinstance(route, (list, tuple)) or len(route) != 2:
+                raise ImproperlyConfigured(
+                    'PARAMETERS_TO_VIEW[%d] has to be a tuple of parameter '
+                    'names and a view name' % i)
+            names, view = route
+            if isinstance(names, str) or \
+                    not isinstance(names, (list, tuple)) or \
+                    not all(isinstance(n, str) and n for n in names):
+                raise ImproperlyConfigured(
+                    'PARAMETERS_TO_VIEW[%d] has to start with a tuple of '
+                    'parameter names' % i)
+            if not isinstance(view, str) or not view:
+                raise ImproperlyConfigured(
+                    'PARAMETERS_TO_VIEW[%d] has to end with a view name' % i)
+            names = tuple(names)
+            self.routes.append((names, view))
+            for name in set(names):
+                self.index.setdefault(name, []).append(i)
+            if not names:
+                self.unconditional.append(i)
+            self.parameter_names.update(names)
+
+    def matching_routes(self, present):
+        """
+        Returns the indexes of the routes whose parameters are all present
+        in the order of the setting.
+
+        Keyword arguments:
+            - present -- set of the configured parameter names sent
+        """
+        candidates = set(self.unconditional)
+        for name in present:
+            candidates.update(self.index.get(name, ()))
+        return sorted(i for i in candidates
+                      if present.issuperset(self.routes[i][0]))
+
+    def resolve(self, tool_provider):
+        """
+        Returns the URL of the first route whose parameters are sent with
+        the request or None if there is none.
+
+        Keyword arguments:
+            - tool_provider -- the LTI tool provider instance
+        """
+        values = {}
+        for param, value in tool_provider.launch_params.items():
+            name = param[len('custom_'):]
+            if value and param.startswith('custom_') and \
+                    name in self.parameter_names:
+                values[name] = value
+        for i in self.matching_routes(frozenset(values)):
+            names, view = self.routes[i]
+            kwargs = tuple((n, values[n]) for n in names)
+            try:
+                return cached_reverse(view, kwargs, get_urlconf(),
+                                      get_script_prefix())
+            except NoReverseMatch:
+                logger.warning('could not reverse %s with %s', view, kwargs)
+        return None
+
+    def check(self):
+        """
+        Returns a list of error messages for routes whose view name is
+        unknown or does not take exactly the configured parameters.
+        """
+        errors = []
+        for i, (names, view) in enumerate(self.routes):
+            resolver = get_resolver()
+            *namespaces, name = view.split(':')
+            try:
+                for namespace in namespaces:
+                    resolver = resolver.namespace_dict[namespace][1]
+            except KeyError:
+                errors.append('PARAMETERS_TO_VIEW[%d]: unknown namespace in '
+                              '%s' % (i, view))
+                continue
+            possibilities = resolver.reverse_dict.getlist(name)
+            if not possibilities:
+                errors.append('PARAMETERS_TO_VIEW[%d]: unknown view %s' % (
+                    i, view))
+                continue
+            if not takes_parameters(possibilities, names):
+                errors.append('PARAMETERS_TO_VIEW[%d]: %s does not take the '
+                              'parameters %s' % (i, view, ', '.join(names)))
+        return errors
+
+
+def takes_parameters(possibilities, names):
+    """
+    Returns true if one of the URL patterns of a view could be reversed with
+    exactly the given keyword arguments.
+
+    Keyword arguments:
+        - possibilities -- entries of the reverse_dict of a URL resolver
+        - names -- the names of the keyword arguments
+    """
+    for bits, pattern, defaults, converters in possibilities:
+        for result, params in bits:
+            if not set(params).symmetric_difference(names).difference(
+                    defaults):
+                return True
+    return False
+
+
+@lru_cache(maxsize=1024)
+def cached_reverse(view, kwargs, urlconf, prefix):
+    """
+    Returns the reversed URL of a view. The results are reused for equal
+    parameter values; the URL configuration and the script prefix are part
+    of the key.
+
+    Keyword arguments:
+        - view -- the name of the view
+        - kwargs -- tuple of (name, value) pairs of parameters
+        - urlconf -- the current URL configuration
+        - prefix -- the current script prefix
+    """
+    return reverse(view, urlconf=urlconf, kwargs=dict(kwargs))
+
+
+_redirect_table = None
+
+
+def get_redirect_table():
+    """
+    Returns the compiled PARAMETERS_TO_VIEW setting.
+    """
+    global _redirect_table
+    if _redirect_table is None:
+        _redirect_table = RedirectTable(
+            get_setting('PARAMETERS_TO_VIEW', []))
+    return _redirect_table
+
+
+def reset_redirect_table():
+    """
+    Drops the compiled setting and the reversed URLs, e.g. if the settings
+    changed.
+    """
+    global _redirect_table
+    _redirect_table = None
+    cached_reverse.cache_clear()
@@ -0,0 +1,275 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module synchronizes the roster of a course with the users of the
+lti_provider-App before the students launch. The membership of a course is
+read page by page from the membership service of the consumer and the users
+are created or updated in chunks with the identity rules of the
+LTIAuthBackend, so their first launch only looks them up.
+"""
+
+import requests
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from requests_oauthlib import OAuth1
+from requests_oauthlib.oauth1_auth import SIGNATURE_TYPE_AUTH_HEADER
+
+from lti_provider import usercache
+from lti_provider.backends import LTIAuthBackend, get_launch_user, \
+    get_username, new_user_defaults
+from lti_provider.models import LTIIdentity
+from lti_provider.utils import get_setting
+
+User = get_user_model()
+
+MEDIA_TYPES = ', '.join((
+    'application/vnd.ims.lti-nrps.v2.membershipcontainer+json',
+    'application/vnd.ims.lis.v2.membershipcontainer+json',
+))
+
+# pairs of a launch parameter and the attribute of a member in the LTI 1.1
+# and in the LTI Advantage (NRPS) format
+MEMBER_PARAMETERS = (
+    ('user_id', 'userId', 'user_id'),
+    ('lis_person_contact_email_primary', 'email', 'email'),
+    ('lis_person_name_given', 'givenName', 'given_name'),
+    ('lis_person_name_family', 'familyName', 'family_name'),
+)
+
+
+class RosterError(Exception):
+    """
+    Raised if the membership service can not be read.
+    """
+
+
+def parse_page(data):
+    """
+    Returns the active members of a page as launch parameters and the URL
+    of the next page in the LTI 1.1 format or None.
+
+    Keyword arguments:
+        - data -- the decoded page
+    """
+    if not isinstance(data, dict):
+        raise RosterError('malformed page')
+    try:
+        if 'members' in data:
+            members = [
+                (dict((p, member.get(name))
+                      for p, _, name in MEMBER_PARAMETERS),
+                 member.get('status'))
+                for member in data['members']]
+            next_page = None
+        else:
+            subject = data.get('pageOf', {}).get('membershipSubject', {})
+            members = [
+                (dict((p, membership.get('member', {}).get(name))
+                      for p, name, _ in MEMBER_PARAMETERS),
+                 membership.get('status'))
+                for membership in subject.get('membership', [])]
+            next_page = data.get('nextPage')
+    except (AttributeError, TypeError):
+        raise RosterError('malformed page')
+    params = []
+    for values, status in members:
+        # the LTI 1.1 status is a URI like liss:Active
+        if status and status.rsplit(':', 1)[-1].lower() != 'active':
+            continue
+        params.append(dict((p, str(value)) for p, value in values.items()
+                           if value))
+    return params, next_page
+
+
+class RosterSync(object):
+    """
+    Reads the membership of a course from the membership service of a
+    consumer and creates or updates its users. Requests are signed with
+    the key and the secret of the consumer.
+    """
+
+    def __init__(self, consumer, batch_size=None, session=None):
+        """
+        Keyword arguments:
+            - consumer -- the consumer of the course
+            - batch_size -- number of members per chunk (default:
+              ROSTER_BATCH_SIZE or 500)
+            - session -- the requests.Session to read with
+        """
+        self.consumer = consumer
+        self.session = session or requests.Session()
+        self.batch_size = batch_size or get_setting('ROSTER_BATCH_SIZE', 500)
+        self.timeout = get_setting('ROSTER_TIMEOUT', 30)
+        self.backend = LTIAuthBackend()
+        self.counts = dict.fromkeys(
+            ('created', 'linked', 'updated', 'unchanged', 'skipped'), 0)
+
+    def members(self, url):
+        """
+        Yields the members of all pages as launch parameters. A page is
+        requested after the members of the previous one are consumed.
+
+        Keyword arguments:
+            - url -- the URL of the membership service
+        """
+        auth = OAuth1(self.consumer.key, self.consumer.secret,
+                      signature_type=SIGNATURE_TYPE_AUTH_HEADER)
+        while url:
+            try:
+                response = self.session.get(
+                    url, auth=auth, timeout=self.timeout,
+                    headers={'Accept': MEDIA_TYPES})
+                response.raise_for_status()
+                members, next_page = parse_page(response.json())
+            except (requests.RequestException, ValueError,
+                    RosterError) as e:
+                raise RosterError('reading %s failed: %s' % (url, e))
+            yield from members
+            url = next_page or response.links.get('next', {}).get('url')
+
+    def sync(self, url):
+        """
+        Creates or updates the users of all members chunk by chunk and
+        returns the counts of created,
+        linked (existing users without identity), updated, unchanged and
+        skipped members.
+
+        Keyword arguments:
+            - url -- the URL of the membership service
+        """
+        chunk = {}
+        for params in self.members(url):
+            try:
+                uid_hash, profile = get_launch_user(params)
+            except KeyError:
+                self.counts['skipped'] += 1
+                continue
+            chunk[uid_hash] = profile
+            if len(chunk) >= self.batch_size:
+                self.sync_chunk(chunk)
+                chunk = {}
+        if chunk:
+            self.sync_chunk(chunk)
+        return self.counts
+
+    def sync_chunk(self, chunk):
+        """
+        Updates the users of the identities of a chunk with bulk_update and
+        creates the missing users and identities with bulk_create.
+
+        Keyword arguments:
+            - chunk -- dictionary of uid_hash and profile
+        """
+        identities = list(LTIIdentity.objects.select_related('user').filter(
+            consumer=self.consumer, uid_hash__in=list(chunk)))
+        changed = self.update_users([
+            (identity.user, chunk.pop(identity.uid_hash))
+            for identity in identities])
+        self.counts['updated'] += changed
+        self.counts['unchanged'] += len(identities) - changed
+        if chunk:
+            try:
+                self.create_users(chunk)
+            except IntegrityError:
+                # a concurrent launch created some of them, like a launch
+                self.provision_each(chunk)
+
+    def update_users(self, users):
+        """
+        Applies the profiles to their users with one bulk_update and returns
+        the number of changed users.
+
+        Keyword arguments:
+            - users -- list of tuples of a user and its profile
+        """
+        changed_users = []
+        changed_fields = set()
+        for user, profile in users:
+            changed = self.backend.update_profile(user, profile)
+            if changed:
+                changed_users.append(user)
+                changed_fields.update(changed)
+        if changed_users:
+            User.objects.bulk_update(changed_users, sorted(changed_fields))
+            # bulk_update sends no post_save
+            if usercache.enabled():
+                usercache.user_cache.invalidate_many(
+                    user.pk for user in changed_users)
+        return len(changed_users)
+
+    def create_users(self, chunk):
+        """
+        Creates the users and identities of the members of a chunk without
+        identity in one transaction. Users created before the identities
+        existed are linked by their username and updated like a launch.
+
+        Keyword arguments:
+            - chunk -- dictionary of uid_hash and profile
+        """
+        usernames = dict((get_username(uid_hash, profile), uid_hash)
+                         for uid_hash, profile in chunk.items())
+        with transaction.atomic():
+            existing = list(User.objects.filter(
+                username__in=list(usernames)))
+            self.update_users([
+                (user, chunk[usernames[user.username]])
+                for user in existing])
+            existing = set(user.username for user in existing)
+            new_users = [
+                User(username=username,
+                     **new_user_defaults(chunk[usernames[username]]))
+                for username in usernames if username not in existing]
+            User.objects.bulk_create(new_users)
+            users = User.objects.filter(username__in=list(usernames))
+            LTIIdentity.objects.bulk_create([
+                LTIIdentity(consumer=self.consumer,
+                            uid_hash=usernames[user.username], user=user)
+                for user in users])
+        self.counts['created'] += len(new_users)
+        self.counts['linked'] += len(existing)
+        new_usernames = set(user.username for user in new_users)
+        for user in users:
+            if user.username in new_usernames:
+                self.backend.run_hook(user)
+
+    def provision_each(self, chunk):
+        """
+        Creates or updates the users of a chunk one by one like launches.
+
+        Keyword arguments:
+            - chunk -- dictionary of uid_hash and profile
+        """
+        for uid_hash, profile in chunk.items():
+            try:
+                identity = LTIIdentity.objects.select_related('user').get(
+                    consumer=self.consumer, uid_hash=uid_hash)
+            except LTIIdentity.DoesNotExist:
+                user, created = self.backend.provision_user(
+                    self.consumer, uid_hash, profile)
+                self.counts['created' if created else 'linked'] += 1
+                if created:
+                    self.backend.run_hook(user)
+                continue
+            changed = self.backend.update_profile(identity.user, profile)
+            if changed:
+                identity.user.save(update_fields=changed)
+            self.counts['updated' if changed else 'unchanged'] += 1
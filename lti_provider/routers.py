@@ -0,0 +1,161 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the database routing of the lti_provider-App. The
+optional DATABASE entry of the LTI_PROVIDER setting selects the database
+alias of the nonce tables (NONCES) and a replica the consumers are read from
+(REPLICA). The nonce stores and the consumer cache use these aliases
+explicitly; LTIRouter applies them to all other queries, e.g. of the admin,
+if it is added to DATABASE_ROUTERS.
+"""
+
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, router
+
+from lti_provider.utils import get_setting
+
+NONCE_MODELS = ('lti_provider.timestampandnonce', 'lti_provider.noncedigest')
+
+CONSUMER_MODEL = 'lti_provider.consumer'
+
+# cache key marking a recent change of a consumer for all processes
+CONSUMER_WRITTEN_KEY = 'lti_provider:consumer_written'
+
+
+def get_database_setting(name, default=None):
+    """
+    Returns an entry of the DATABASE entry of the LTI_PROVIDER setting.
+
+    Keyword arguments:
+        - name -- the name of the entry
+        - default -- returned if the entry is missing
+    """
+    return (get_setting('DATABASE') or {}).get(name, default)
+
+
+class ConsumerWrites(object):
+    """
+    Remembers that a consumer changed, so consumers are read from the
+    primary database instead of the replica for REPLICA_LAG seconds
+    (default: 5). The change is marked in this process and in the default
+    cache, which reaches the other processes if it is shared.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        Keyword arguments:
+            - clock -- callable returning the current time in seconds
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._until = None
+
+    @property
+    def lag(self):
+        """
+        Returns the seconds after a change consumers are read from the
+        primary database.
+        """
+        return get_database_setting('REPLICA_LAG', 5)
+
+    def mark(self):
+        """
+        Marks a change of a consumer.
+        """
+        lag = self.lag
+        with self._lock:
+            self._until = self._clock() + lag
+        caches['default'].set(CONSUMER_WRITTEN_KEY, 1, lag)
+
+    def recent(self):
+        """
+        Returns true if a consumer changed within the last REPLICA_LAG
+        seconds.
+        """
+        with self._lock:
+            if self._until is not None and self._clock() < self._until:
+                return True
+        return caches['default'].get(CONSUMER_WRITTEN_KEY) is not None
+
+    def reset(self):
+        """
+        Forgets the change of this process.
+        """
+        with self._lock:
+            self._until = None
+
+
+consumer_writes = ConsumerWrites()
+
+
+def nonce_database():
+    """
+    Returns the database alias of the nonce tables.
+    """
+    return get_database_setting('NONCES', DEFAULT_DB_ALIAS)
+
+
+def consumer_read_database():
+    """
+    Returns the database alias the consumers are read from: the replica if
+    one is configured and no consumer changed recently and the database
+    consumers are written to otherwise.
+    """
+    replica = get_database_setting('REPLICA')
+    if replica is not None and not consumer_writes.recent():
+        return replica
+    from lti_provider.models import Consumer
+    return router.db_for_write(Consumer)
+
+
+class LTIRouter(object):
+    """
+    Routes the queries of the nonce tables to the NONCES database and the
+    reads of consumers to the REPLICA database as configured by the
+    DATABASE entry of the LTI_PROVIDER setting. All other models are left
+    to the next router. The tables have to be migrated in every database
+    they are routed to.
+    """
+
+    def db_for_read(self, model, **hints):
+        label = model._meta.label_lower
+        if label in NONCE_MODELS:
+            return nonce_database()
+        if label == CONSUMER_MODEL and \
+                get_database_setting('REPLICA') is not None and \
+                not consumer_writes.recent():
+            return get_database_setting('REPLICA')
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label_lower in NONCE_MODELS:
+            return nonce_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        labels = set((obj1._meta.label_lower, obj2._meta.label_lower))
+        if labels & set(NONCE_MODELS) and CONSUMER_MODEL in labels:
+            return True
+        return None
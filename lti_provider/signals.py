@@ -0,0 +1,118 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the signals and the signal handlers of the
+lti_provider-App.
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.signals import (request_finished, request_started,
+                                 setting_changed)
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from lti_provider import hooks, usercache
+from lti_provider.cache import (consumer_cache, mark_consumers_changed,
+                                 tool_config_cache)
+from lti_provider.groups import group_cache
+from lti_provider.models import Consumer
+from lti_provider.redirects import reset_redirect_table
+from lti_provider.routers import consumer_writes, get_database_setting
+
+# sent with the arguments phase and duration (seconds) if METRICS is enabled
+launch_phase = Signal()
+
+# sent with the argument outcome if METRICS is enabled
+launch_outcome = Signal()
+
+
+@receiver(post_save, sender=Consumer)
+@receiver(post_delete, sender=Consumer)
+def invalidate_consumer_cache(sender, **kwargs):
+    """
+    Clears the consumer cache of this process if a consumer changes. The
+    whole cache is cleared because the key of a consumer may have changed.
+    The shared generation is replaced, so the other processes forget their
+    unknown keys. The change is marked, so consumers are read from the
+    primary database until the replica caught up.
+    """
+    consumer_cache.clear()
+    mark_consumers_changed()
+    if get_database_setting('REPLICA') is not None:
+        consumer_writes.mark()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_group_cache(sender, **kwargs):
+    """
+    Clears the group cache of this process if a group changes, e.g. if a
+    mapped group is renamed or deleted.
+    """
+    group_cache.clear()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_cache(sender, instance, **kwargs):
+    """
+    Replaces the cached version of a user if it changes and USER_CACHING
+    is enabled.
+    """
+    if usercache.enabled():
+        usercache.user_cache.invalidate(instance.pk)
+
+
+@receiver(request_started)
+def start_user_memo(sender, **kwargs):
+    """
+    Starts the memo of the users loaded by a request if USER_CACHING is
+    enabled.
+    """
+    if usercache.enabled():
+        usercache.start_request()
+
+
+@receiver(request_finished)
+def finish_user_memo(sender, **kwargs):
+    """
+    Drops the memo of the users loaded by a request if USER_CACHING is
+    enabled.
+    """
+    if usercache.enabled():
+        usercache.finish_request()
+
+
+@receiver(setting_changed)
+def reset_compiled_settings(sender, setting, **kwargs):
+    """
+    Drops the compiled PARAMETERS_TO_VIEW, the cached tool configurations,
+    the resolved hook and the group IDs if the settings they depend on
+    change, e.g. in tests.
+    """
+    if setting in ('LTI_PROVIDER', 'ROOT_URLCONF'):
+        reset_redirect_table()
+        tool_config_cache.clear()
+    if setting == 'LTI_PROVIDER':
+        hooks.reset()
+        group_cache.clear()
@@ -20,10 +20,2458 @@
 # SOFTWARE.
 
 """
-This module offers tests for lti_provider. Currently there are no
-tests.
+This module offers tests for lti_provider.
 """
 
-from django.test import TestCase
+import base64
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import parse_qs, parse_qsl, urlparse
+from unittest import mock, skipUnless
 
-# Create your tests here.
+try:
+    import jwt
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from jwt.algorithms import RSAAlgorithm
+except ImportError:
+    jwt = None
+
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, SESSION_KEY,
+                                 get_user_model)
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, connection
+from django.http import HttpResponse
+from django.test import (Client, RequestFactory, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+from django.utils import timezone
+from lti import OutcomeRequest, OutcomeResponse
+from lti.contrib.django import DjangoToolProvider
+from oauthlib import oauth1
+from oauthlib.oauth1.rfc5849 import (SIGNATURE_HMAC_SHA512,
+                                     SIGNATURE_TYPE_BODY)
+
+from lti_provider import hooks, metrics, prevalidation, ratelimit, usercache
+from lti_provider.backends import LTIAuthBackend
+from lti_provider.benchmarks import (QUERY_BUDGETS, SCENARIOS, LaunchBenchmark,
+                                     PageViewBenchmark, signed_launch_data)
+from lti_provider.cache import ConsumerCache, consumer_cache
+from lti_provider.context import (LAUNCH_CONTEXT_SESSION_KEY, LaunchContext,
+                                  get_launch_context)
+from lti_provider.groups import group_cache, normalize_role
+from lti_provider.jwks import KeySetCache, key_set_cache
+from lti_provider.lti13 import CLAIM
+from lti_provider.models import (Consumer, LTIIdentity, LTIResult, LTIScore,
+                                 NonceDigest, Platform, TimestampAndNonce)
+from lti_provider.nonces import (CacheNonceStore, CompactNonceStore,
+                                 ModelNonceStore, nonce_digest)
+from lti_provider.outcomes import OutcomeWorker, submit_score, submit_scores
+from lti_provider.redirects import RedirectTable
+from lti_provider.roster import RosterError, RosterSync, parse_page
+from lti_provider.routers import ConsumerWrites, LTIRouter, consumer_writes
+from lti_provider.tokens import TokenError, load_jwk, verify_token
+from lti_provider.validators import LTIValidator
+
+User = get_user_model()
+
+LTI_PROVIDER = {
+    'TITLE': 'LTI test',
+    'DESCRIPTION': 'LTI provider under test',
+    'DEFAULT_VIEW': ('lti_test_index',),
+    'FAILED_VIEW': ('lti_test_failed',),
+    'PARAMETERS_TO_VIEW': [
+        (('page',), 'lti_test_page'),
+    ],
+}
+
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'lti_provider.middleware.LaunchContextMiddleware',
+]
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+def destination(request, **kwargs):
+    """
+    A view used as destination of the redirects.
+    """
+    return HttpResponse('destination')
+
+
+def show_context(request):
+    """
+    A view which returns the context and roles of request.lti.
+    """
+    return HttpResponse('%s %s' % (request.lti.context_id,
+                                   ','.join(request.lti.roles)))
+
+
+urlpatterns = [
+    path('lti/', include('lti_provider.urls')),
+    path('', destination, name='lti_test_index'),
+    path('context', show_context, name='lti_test_context'),
+    path('failed', destination, name='lti_test_failed'),
+    path('page/<page>', destination, name='lti_test_page'),
+    path('page/<page>/<int:section>', destination,
+         name='lti_test_section'),
+]
+
+
+hooked_users = []
+
+
+def record_hook(user):
+    """
+    A HOOK_AFTER_USER_CREATION which records the users.
+    """
+    hooked_users.append(user.pk)
+
+
+def record_hook_pk(user_pk):
+    """
+    A HOOK_QUEUE_ADAPTER which records the primary keys of the users.
+    """
+    hooked_users.append(user_pk)
+
+
+def failing_hook(user):
+    """
+    A HOOK_AFTER_USER_CREATION which fails.
+    """
+    raise RuntimeError('hook failed')
+
+
+def create_consumer(key='consumerkey0123456789',
+                    secret='consumersecret0123456789'):
+    """
+    Creates a consumer and the user responsible for it.
+    """
+    user = User.objects.create(username='admin_' + key)
+    return Consumer.objects.create(key=key, secret=secret, user=user)
+
+
+def launch_data(consumer, launch_url='http://testserver/lti/launch', **params):
+    """
+    Returns the POST data of a launch request signed by the consumer.
+    """
+    return signed_launch_data(consumer, launch_url, **params)
+
+
+def tool_provider_for(consumer, **params):
+    """
+    Returns the tool provider of a signed launch request.
+    """
+    request = RequestFactory().post('/lti/launch',
+                                    launch_data(consumer, **params))
+    return DjangoToolProvider.from_django_request(request=request)
+
+
+class NonceStoreConformanceMixin(object):
+    """
+    Tests every nonce store has to pass. Subclasses set store_class.
+    """
+    store_class = None
+
+    def setUp(self):
+        self.store = self.store_class()
+        self.consumer = create_consumer()
+        self.timestamp = '1500000000'
+
+    def test_new_nonce_is_accepted(self):
+        self.assertTrue(
+            self.store.add(self.consumer, self.timestamp, 'nonce1', 600))
+
+    def test_replay_is_rejected(self):
+        self.store.add(self.consumer, self.timestamp, 'nonce1', 600)
+        self.assertFalse(
+            self.store.add(self.consumer, self.timestamp, 'nonce1', 600))
+
+    def test_other_nonce_is_accepted(self):
+        self.store.add(self.consumer, self.timestamp, 'nonce1', 600)
+        self.assertTrue(
+            self.store.add(self.consumer, self.timestamp, 'nonce2', 600))
+
+    def test_other_timestamp_is_accepted(self):
+        self.store.add(self.consumer, self.timestamp, 'nonce1', 600)
+        self.assertTrue(
+            self.store.add(self.consumer, '1500000001', 'nonce1', 600))
+
+    def test_same_nonce_of_other_consumer_is_accepted(self):
+        other = create_consumer(key='otherkey0123456789ab',
+                                secret='othersecret0123456789')
+        self.store.add(self.consumer, self.timestamp, 'nonce1', 600)
+        self.assertTrue(self.store.add(other, self.timestamp, 'nonce1', 600))
+
+    async def test_async_replay_is_rejected(self):
+        self.assertTrue(await self.store.aadd(self.consumer, self.timestamp,
+                                              'nonce1', 600))
+        self.assertFalse(await self.store.aadd(self.consumer, self.timestamp,
+                                               'nonce1', 600))
+        self.assertTrue(await self.store.aadd(self.consumer, self.timestamp,
+                                              'nonce2', 600))
+
+    def test_validator_rejects_replay(self):
+        path = self.store_class.__module__ + '.' + self.store_class.__name__
+        validator = LTIValidator()
+        with self.settings(LTI_PROVIDER={'NONCE_BACKEND': path}):
+            timestamp = str(int(time.time()))
+            self.assertTrue(validator.validate_timestamp_and_nonce(
+                self.consumer.key, timestamp, 'nonce1', None))
+            self.assertFalse(validator.validate_timestamp_and_nonce(
+                self.consumer.key, timestamp, 'nonce1', None))
+
+    def test_validator_rejects_unknown_consumer(self):
+        path = self.store_class.__module__ + '.' + self.store_class.__name__
+        validator = LTIValidator()
+        with self.settings(LTI_PROVIDER={'NONCE_BACKEND': path}):
+            self.assertFalse(validator.validate_timestamp_and_nonce(
+                'unknownkey0123456789', str(int(time.time())), 'nonce1',
+                None))
+
+
+class ModelNonceStoreTest(NonceStoreConformanceMixin, TestCase):
+    store_class = ModelNonceStore
+
+    def test_replay_keeps_transaction_usable(self):
+        self.store.add(self.consumer, self.timestamp, 'nonce1', 600)
+        self.store.add(self.consumer, self.timestamp, 'nonce1', 600)
+        self.assertEqual(TimestampAndNonce.objects.count(), 1)
+
+
+class CompactNonceStoreTest(NonceStoreConformanceMixin, TestCase):
+    store_class = CompactNonceStore
+
+    def test_row_is_bucketed_digest(self):
+        self.store.add(self.consumer, self.timestamp, 'nonce1', 600)
+        row = NonceDigest.objects.get()
+        self.assertEqual(row.bucket, 1500000000 // 60)
+        self.assertEqual(row.digest, nonce_digest(self.consumer.pk,
+                                                  self.timestamp, 'nonce1'))
+        self.assertTrue(-2 ** 63 <= row.digest < 2 ** 63)
+
+    def test_purge_deletes_expired_buckets_only(self):
+        now = int(time.time())
+        for i in range(3):
+            self.store.add(self.consumer, str(now - 1000 - 120 * i),
+                           'nonce%d' % i, 600)
+        self.store.add(self.consumer, str(now), 'current', 600)
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('purge_lti_nonces', batch_size=2, stdout=out)
+        self.assertEqual(list(NonceDigest.objects.values_list(
+            'bucket', flat=True)), [now // 60])
+        self.assertIn('Deleted 3 rows', out.getvalue())
+        deletes = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('DELETE') and
+                   'noncedigest' in query['sql']]
+        self.assertEqual(len(deletes), 2)
+        self.assertFalse(any('bucket' in sql for sql in deletes))
+
+    def test_copy_keeps_replays_rejected(self):
+        now = int(time.time())
+        ModelNonceStore().add(self.consumer, str(now), 'nonce1', 600)
+        ModelNonceStore().add(self.consumer, str(now - 1000), 'nonce2', 600)
+        out = StringIO()
+        call_command('copy_lti_nonces', stdout=out)
+        call_command('copy_lti_nonces', stdout=out)
+        self.assertEqual(NonceDigest.objects.count(), 1)
+        self.assertFalse(self.store.add(self.consumer, str(now), 'nonce1',
+                                        600))
+        call_command('copy_lti_nonces', all=True, delete=True, stdout=out)
+        self.assertEqual(NonceDigest.objects.count(), 2)
+        self.assertFalse(TimestampAndNonce.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheNonceStoreTest(NonceStoreConformanceMixin, TestCase):
+    store_class = CacheNonceStore
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.store = CacheNonceStore(clock=lambda: 1500000000)
+
+    def test_entry_expires_with_timestamp_window(self):
+        cache = mock.Mock()
+        with mock.patch.object(CacheNonceStore, 'cache',
+                               new_callable=mock.PropertyMock,
+                               return_value=cache):
+            self.store.add(self.consumer, '1500000100', 'nonce1', 600)
+        cache.add.assert_called_once_with(
+            'lti_provider:nonce:%s:1500000100:nonce1' % self.consumer.pk,
+            1, 700)
+
+
+class TimestampWindowTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        self.validator = LTIValidator()
+
+    def test_stale_timestamp_is_rejected_without_queries(self):
+        stale = str(int(time.time()) - 601)
+        with self.assertNumQueries(0):
+            self.assertFalse(self.validator.validate_timestamp_and_nonce(
+                self.consumer.key, stale, 'nonce1', None))
+
+    def test_future_timestamp_is_rejected(self):
+        future = str(int(time.time()) + 601)
+        self.assertFalse(self.validator.validate_timestamp_and_nonce(
+            self.consumer.key, future, 'nonce1', None))
+
+    @override_settings(LTI_PROVIDER={'TIMESTAMP_LIFETIME': 1000})
+    def test_window_is_configurable(self):
+        old = str(int(time.time()) - 900)
+        self.assertTrue(self.validator.validate_timestamp_and_nonce(
+            self.consumer.key, old, 'nonce1', None))
+
+    def test_purge_deletes_expired_rows_only(self):
+        now = int(time.time())
+        for i in range(5):
+            TimestampAndNonce.objects.create(
+                consumer=self.consumer, timestamp=now - 1000, nonce=str(i))
+        TimestampAndNonce.objects.create(
+            consumer=self.consumer, timestamp=now, nonce='current')
+        out = StringIO()
+        call_command('purge_lti_nonces', batch_size=2, stdout=out)
+        self.assertEqual(
+            list(TimestampAndNonce.objects.values_list('nonce', flat=True)),
+            ['current'])
+        self.assertIn('Deleted 5 rows', out.getvalue())
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER)
+class ConsumerCacheTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        self.now = 1000.0
+        self.cache = ConsumerCache(clock=lambda: self.now)
+
+    def test_consumer_is_cached(self):
+        self.assertEqual(self.cache.get(self.consumer.key), self.consumer)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get(self.consumer.key),
+                             self.consumer)
+        self.assertEqual(self.cache.stats(), {
+            'hits': 1, 'misses': 1, 'size': 1, 'unknown': 0})
+
+    def test_entries_expire(self):
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                             CONSUMER_CACHE_TTL=10)):
+            self.cache.get(self.consumer.key)
+            self.now += 9
+            with self.assertNumQueries(0):
+                self.cache.get(self.consumer.key)
+            self.now += 2
+            with self.assertNumQueries(1):
+                self.cache.get(self.consumer.key)
+
+    def test_disabled_by_ttl(self):
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                             CONSUMER_CACHE_TTL=0)):
+            self.cache.get(self.consumer.key)
+            with self.assertNumQueries(1):
+                self.cache.get(self.consumer.key)
+
+    def test_size_is_bounded(self):
+        keys = [self.consumer.key] + [
+            create_consumer('consumerkey%d' % n,
+                            'consumersecret%d' % n).key for n in (1, 2)]
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                             CONSUMER_CACHE_SIZE=2)):
+            for key in keys:
+                self.cache.get(key)
+            self.assertEqual(self.cache.stats()['size'], 2)
+            # the least recently used consumer was evicted
+            with self.assertNumQueries(1):
+                self.cache.get(keys[0])
+
+    def test_unknown_key(self):
+        self.assertIsNone(self.cache.get('unknownkey0123456789'))
+        self.assertTrue(self.cache.is_unknown('unknownkey0123456789'))
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.cache.get('unknownkey0123456789'))
+        self.assertFalse(self.cache.is_unknown(self.consumer.key))
+        self.now += 301
+        self.assertFalse(self.cache.is_unknown('unknownkey0123456789'))
+
+    def test_saved_and_deleted_consumers_are_dropped(self):
+        consumer_cache.get(self.consumer.key)
+        self.consumer.secret = 'changedsecret0123456789'
+        self.consumer.save()
+        self.assertEqual(consumer_cache.get(self.consumer.key).secret,
+                         'changedsecret0123456789')
+        self.consumer.delete()
+        self.assertIsNone(consumer_cache.get(self.consumer.key))
+
+    def test_warm_launch_reads_no_consumer(self):
+        self.client.post('/lti/launch', launch_data(self.consumer))
+        self.client.logout()
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post('/lti/launch',
+                                        launch_data(self.consumer))
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        table = Consumer._meta.db_table
+        self.assertEqual([q['sql'] for q in captured.captured_queries
+                          if 'FROM "%s"' % table in q['sql']], [])
+
+
+class LTIIdentityTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        self.backend = LTIAuthBackend()
+
+    def authenticate(self, **params):
+        return self.backend.authenticate(
+            None, tool_provider=tool_provider_for(self.consumer, **params))
+
+    def test_changed_email_keeps_user(self):
+        user = self.authenticate()
+        other = self.authenticate(
+            lis_person_contact_email_primary='jane.doe@example.com')
+        self.assertEqual(user, other)
+        self.assertEqual(LTIIdentity.objects.get().user, user)
+
+    def test_returning_user_is_resolved_with_one_query(self):
+        user = self.authenticate()
+        tool_provider = tool_provider_for(self.consumer)
+        # savepoint, nonce insert, release and identity lookup
+        with self.assertNumQueries(4):
+            self.assertEqual(
+                self.backend.authenticate(None, tool_provider=tool_provider),
+                user)
+
+    def test_bad_signature_records_no_nonce(self):
+        tool_provider = tool_provider_for(self.consumer)
+        tool_provider.launch_params['user_id'] = '43'
+        with self.assertRaises(PermissionDenied):
+            self.backend.authenticate(None, tool_provider=tool_provider)
+        self.assertFalse(TimestampAndNonce.objects.exists())
+
+    def test_legacy_user_gets_identity(self):
+        legacy = User.objects.create(
+            username='jane@example.com_' + sha1(b'42').hexdigest())
+        self.assertEqual(self.authenticate(), legacy)
+        self.assertEqual(LTIIdentity.objects.get().user, legacy)
+
+    def test_backfill_creates_identities(self):
+        legacy = User.objects.create(
+            username='jane@example.com_' + sha1(b'42').hexdigest())
+        User.objects.create(username='someone_else')
+        call_command('backfill_lti_identities', self.consumer.key,
+                     batch_size=1, stdout=StringIO())
+        identity = LTIIdentity.objects.get()
+        self.assertEqual(identity.user, legacy)
+        self.assertEqual(identity.uid_hash, sha1(b'42').hexdigest())
+        self.assertEqual(self.authenticate(), legacy)
+
+    def test_backfill_refuses_several_consumers(self):
+        User.objects.create(
+            username='jane@example.com_' + sha1(b'42').hexdigest())
+        create_consumer('otherkey0123456789', 'othersecret0123456789')
+        with self.assertRaises(CommandError):
+            call_command('backfill_lti_identities', self.consumer.key,
+                         stdout=StringIO())
+        self.assertFalse(LTIIdentity.objects.exists())
+
+    def test_backfill_skips_ambiguous_users(self):
+        uid_hash = sha1(b'42').hexdigest()
+        User.objects.create(username='jane@example.com_' + uid_hash)
+        User.objects.create(username='jane.doe@example.com_' + uid_hash)
+        linked = User.objects.create(
+            username='joe@example.com_' + sha1(b'43').hexdigest())
+        LTIIdentity.objects.create(consumer=self.consumer,
+                                   uid_hash=sha1(b'43').hexdigest(),
+                                   user=linked)
+        User.objects.create(
+            username='joe.doe@example.com_' + sha1(b'43').hexdigest())
+        out = StringIO()
+        call_command('backfill_lti_identities', self.consumer.key,
+                     stdout=out)
+        self.assertIn('Processed 0 users, skipped 3', out.getvalue())
+        self.assertEqual(LTIIdentity.objects.get().user, linked)
+        # the launch links the user of the current email address
+        self.assertEqual(self.authenticate().username,
+                         'jane@example.com_' + uid_hash)
+
+    def test_unchanged_profile_is_not_written(self):
+        self.authenticate()
+        tool_provider = tool_provider_for(self.consumer)
+        with self.assertNumQueries(4):
+            self.backend.authenticate(None, tool_provider=tool_provider)
+
+    def test_changed_profile_is_synced(self):
+        user = self.authenticate()
+        self.authenticate(lis_person_name_family='Roe',
+                          lis_person_contact_email_primary='jane@roe.com')
+        user.refresh_from_db()
+        self.assertEqual(user.last_name, 'Roe')
+        self.assertEqual(user.email, 'jane@roe.com')
+        self.assertEqual(user.first_name, 'Jane')
+
+    def test_concurrent_provisioning_uses_existing_rows(self):
+        winner = User.objects.create(username='winner')
+
+        def lose_race(consumer, uid_hash, profile):
+            LTIIdentity.objects.create(
+                consumer=consumer, uid_hash=uid_hash, user=winner)
+            raise IntegrityError
+
+        with mock.patch.object(self.backend, 'provision_user',
+                               side_effect=lose_race):
+            self.assertEqual(self.authenticate(), winner)
+        self.assertEqual(User.objects.count(), 2)
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER)
+class AsyncLaunchTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+
+    async def launch(self, **params):
+        url = 'http://testserver/lti/launch/async'
+        return await self.async_client.post(
+            '/lti/launch/async',
+            launch_data(self.consumer, launch_url=url, **params))
+
+    async def test_launch_logs_in_and_redirects(self):
+        response = await self.launch(custom_page='intro')
+        self.assertRedirects(response, '/page/intro',
+                             fetch_redirect_response=False)
+        identity = await LTIIdentity.objects.select_related('user').aget()
+        self.assertEqual(identity.user.email, 'jane@example.com')
+
+    async def test_returning_user_is_resolved(self):
+        await self.launch()
+        response = await self.launch(lis_person_name_given='Janet')
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        self.assertEqual(await User.objects.filter(
+            first_name='Janet').acount(), 1)
+
+    async def test_replay_is_rejected(self):
+        url = 'http://testserver/lti/launch/async'
+        data = launch_data(self.consumer, launch_url=url)
+        await self.async_client.post('/lti/launch/async', data)
+        response = await self.async_client.post('/lti/launch/async', data)
+        self.assertRedirects(response, '/failed',
+                             fetch_redirect_response=False)
+
+    async def test_bad_signature_is_rejected(self):
+        url = 'http://testserver/lti/launch/async'
+        data = launch_data(self.consumer, launch_url=url)
+        data['user_id'] = '43'
+        response = await self.async_client.post('/lti/launch/async', data)
+        self.assertRedirects(response, '/failed',
+                             fetch_redirect_response=False)
+        self.assertFalse(await LTIIdentity.objects.aexists())
+        # the nonce is recorded only after the signature was verified
+        self.assertFalse(await TimestampAndNonce.objects.aexists())
+
+    async def test_missing_or_malformed_timestamp_is_rejected(self):
+        url = 'http://testserver/lti/launch/async'
+        for timestamp in (None, 'abc', ''):
+            data = launch_data(self.consumer, launch_url=url)
+            if timestamp is None:
+                del data['oauth_timestamp']
+            else:
+                data['oauth_timestamp'] = timestamp
+            response = await self.async_client.post('/lti/launch/async',
+                                                    data)
+            self.assertRedirects(response, '/failed',
+                                 fetch_redirect_response=False)
+        self.assertFalse(await LTIIdentity.objects.aexists())
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests')
+class RedirectTableTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        self.table = RedirectTable([
+            (('page', 'section'), 'lti_test_section'),
+            (('page',), 'lti_test_page'),
+            (('other',), 'lti_test_index'),
+        ])
+
+    def resolve(self, **params):
+        return self.table.resolve(tool_provider_for(self.consumer, **params))
+
+    def test_first_matching_route_wins(self):
+        self.assertEqual(self.resolve(custom_page='a', custom_section='2'),
+                         '/page/a/2')
+        self.assertEqual(self.resolve(custom_page='a'), '/page/a')
+
+    def test_failed_reverse_falls_through(self):
+        with self.assertLogs('LTI.lti_provider', 'WARNING'):
+            self.assertEqual(
+                self.resolve(custom_page='a', custom_section='x'), '/page/a')
+
+    def test_no_match(self):
+        self.assertIsNone(self.resolve(custom_section='2'))
+        self.assertIsNone(self.resolve(custom_page=''))
+
+    def test_only_routes_of_sent_parameters_are_checked(self):
+        names = ['p%d' % i for i in range(20)]
+        table = RedirectTable(
+            [((name, 'page'), 'lti_test_section') for name in names] +
+            [(('page',), 'lti_test_page'), ((), 'lti_test_index')])
+        present = frozenset(names + ['page'])
+        self.assertEqual(table.matching_routes(present), list(range(22)))
+        self.assertEqual(table.matching_routes(frozenset(['p3', 'page'])),
+                         [3, 20, 21])
+        self.assertEqual(table.matching_routes(frozenset(['p3'])), [21])
+
+    def test_invalid_setting_raises(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RedirectTable([('page', 'lti_test_page')])
+        with self.assertRaises(ImproperlyConfigured):
+            RedirectTable([(('page',),)])
+
+    def test_check_reports_wrong_routes(self):
+        table = RedirectTable([
+            (('page',), 'lti_test_page'),
+            (('page',), 'lti_test_unknown'),
+            (('section',), 'lti_test_page'),
+        ])
+        errors = table.check()
+        self.assertEqual(len(errors), 2)
+        self.assertIn('PARAMETERS_TO_VIEW[1]', errors[0])
+        self.assertIn('PARAMETERS_TO_VIEW[2]', errors[1])
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER)
+class ToolConfigTest(TestCase):
+
+    def test_config_has_cache_headers(self):
+        response = self.client.get('/lti/config.xml')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'http://testserver/lti/launch', response.content)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+    def test_conditional_request_is_not_modified(self):
+        etag = self.client.get('/lti/config.xml')['ETag']
+        with mock.patch('lti_provider.cache.ToolConfig') as tool_config:
+            response = self.client.get('/lti/config.xml',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        tool_config.assert_not_called()
+
+    def test_settings_change_invalidates(self):
+        etag = self.client.get('/lti/config.xml')['ETag']
+        settings = dict(LTI_PROVIDER, TITLE='Changed')
+        with self.settings(LTI_PROVIDER=settings):
+            response = self.client.get('/lti/config.xml',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Changed', response.content)
+
+
+class HookTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        hooked_users.clear()
+        hooks.hook_stats.reset()
+
+    def authenticate(self, hook='lti_provider.tests.record_hook', **kwargs):
+        lti_settings = dict(HOOK_AFTER_USER_CREATION=hook, **kwargs)
+        with self.settings(LTI_PROVIDER=lti_settings):
+            return LTIAuthBackend().authenticate(
+                None, tool_provider=tool_provider_for(self.consumer))
+
+    def test_inline(self):
+        user = self.authenticate()
+        self.assertEqual(hooked_users, [user.pk])
+        self.assertEqual(hooks.hook_stats.snapshot()['calls'], 1)
+
+    def test_inline_failure_is_raised(self):
+        with self.assertRaises(RuntimeError):
+            self.authenticate(hook='lti_provider.tests.failing_hook')
+
+    def test_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            user = self.authenticate(HOOK_MODE='on_commit')
+            self.assertEqual(hooked_users, [])
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(hooked_users, [user.pk])
+
+    def test_on_commit_failure_is_isolated(self):
+        with self.assertLogs('LTI.lti_provider', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.authenticate(hook='lti_provider.tests.failing_hook',
+                                  HOOK_MODE='on_commit')
+        self.assertEqual(hooks.hook_stats.snapshot()['failures'], 1)
+
+    def test_thread(self):
+        lti_settings = {
+            'HOOK_AFTER_USER_CREATION': 'lti_provider.tests.record_hook',
+            'HOOK_MODE': 'thread',
+            'HOOK_THREADS': 1,
+        }
+        with self.settings(LTI_PROVIDER=lti_settings):
+            with self.captureOnCommitCallbacks(execute=True):
+                user = LTIAuthBackend().authenticate(
+                    None, tool_provider=tool_provider_for(self.consumer))
+            executor, pending = hooks._get_executor()
+            executor.shutdown(wait=True)
+        self.assertEqual(hooked_users, [user.pk])
+
+    def test_stats_are_exported(self):
+        started, release = threading.Event(), threading.Event()
+
+        def blocking_hook(user):
+            started.set()
+            release.wait(5)
+
+        user = User.objects.create(username='hooked')
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER, HOOK_THREADS=1,
+                                             HOOK_QUEUE_SIZE=0)):
+            hooks._submit(blocking_hook, user)
+            self.assertTrue(started.wait(5))
+            # the pool is saturated, so the hook runs inline
+            hooks._submit(record_hook, user)
+            text = metrics.registry.render()
+            release.set()
+            executor, pending = hooks._get_executor()
+            executor.shutdown(wait=True)
+        self.assertIn('lti_provider_hook_inline_overflow_total 1\n', text)
+        self.assertIn('lti_provider_hook_queue_depth 1\n', text)
+        self.assertIn('lti_provider_hook_seconds_bucket{le="+Inf"} 1\n',
+                      text)
+        self.assertIn('lti_provider_hook_seconds_count 1\n', text)
+        stats = hooks.hook_stats.snapshot()
+        self.assertEqual((stats['calls'], stats['queued']), (2, 0))
+
+    def test_queue(self):
+        adapter = 'lti_provider.tests.record_hook_pk'
+        with self.captureOnCommitCallbacks(execute=True):
+            user = self.authenticate(HOOK_MODE='queue',
+                                     HOOK_QUEUE_ADAPTER=adapter)
+        self.assertEqual(hooked_users, [user.pk])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.authenticate(HOOK_MODE='later')
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER)
+class LaunchQueryBudgetTest(TransactionTestCase):
+
+    def test_scenarios_stay_within_query_budget(self):
+        benchmark = LaunchBenchmark(create_consumer())
+        for scenario in SCENARIOS:
+            with self.subTest(scenario=scenario):
+                result = benchmark.run(scenario, 3)
+                self.assertLessEqual(result['max_queries'],
+                                     QUERY_BUDGETS[scenario])
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER)
+class LoadTestCommandTest(TransactionTestCase):
+
+    def run_command(self, **options):
+        out = StringIO()
+        command = 'lti_provider.management.commands.lti_loadtest.'
+        # the launches run in the database of the test instead of a new one
+        with mock.patch(command + 'setup_test_environment'), \
+                mock.patch(command + 'teardown_test_environment'), \
+                mock.patch(command + 'setup_databases'), \
+                mock.patch(command + 'teardown_databases') as teardown:
+            call_command('lti_loadtest', stdout=out, seed=1, **options)
+        teardown.assert_called_once()
+        return out.getvalue()
+
+    def test_in_process(self):
+        output = self.run_command(launches=6, concurrency=1, consumers=2,
+                                  users=3)
+        self.assertIn('launches     6 in', output)
+        self.assertIn('outcome      success              6', output)
+        self.assertIn('queries', output)
+
+    def test_same_user_launches_from_one_consumer(self):
+        output = self.run_command(launches=6, concurrency=1, consumers=3,
+                                  same_user=True)
+        self.assertIn('outcome      success              6', output)
+        self.assertEqual(LTIIdentity.objects.count(), 1)
+
+    def test_database_errors_are_reported_separately(self):
+        command = 'lti_provider.management.commands.lti_loadtest.'
+        with mock.patch(command + 'Client.post',
+                        side_effect=OperationalError('locked')):
+            output = self.run_command(launches=2, concurrency=2)
+        self.assertIn('db error     OperationalError     2', output)
+        self.assertNotIn('outcome', output)
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=dict(LTI_PROVIDER, METRICS=True,
+                                     PREVALIDATION=True))
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        metrics.registry.reset()
+
+    def launch(self, data):
+        return self.client.post('/lti/launch', data)
+
+    def test_outcomes_are_counted(self):
+        data = launch_data(self.consumer)
+        self.launch(data)
+        self.launch(data)
+        tampered = launch_data(self.consumer)
+        tampered['user_id'] = '43'
+        self.launch(tampered)
+        unknown = Consumer(key='unknownkey0123456789',
+                           secret='unknownsecret0123456789')
+        self.launch(launch_data(unknown))
+        outcomes = metrics.registry.outcomes
+        self.assertEqual(outcomes['success'], 1)
+        self.assertEqual(outcomes['replay'], 1)
+        self.assertEqual(outcomes['bad_signature'], 1)
+        self.assertEqual(outcomes['unknown_consumer'], 1)
+
+    def test_inactive_user_is_counted(self):
+        self.launch(launch_data(self.consumer))
+        User.objects.filter(email='jane@example.com').update(is_active=False)
+        self.launch(launch_data(self.consumer))
+        self.assertEqual(metrics.registry.outcomes['inactive_user'], 1)
+
+    def test_phases_are_measured(self):
+        self.launch(launch_data(self.consumer))
+        self.assertEqual(
+            set(metrics.registry.phases),
+            {'launch', 'logout', 'prevalidate', 'parse', 'verify', 'nonce',
+             'resolve_user', 'lookup', 'provision', 'login', 'redirect'})
+        self.assertEqual(metrics.registry.phases['provision'].count, 1)
+        self.launch(launch_data(self.consumer))
+        self.assertEqual(metrics.registry.phases['nonce'].count, 2)
+        self.assertEqual(metrics.registry.phases['lookup'].count, 2)
+        self.assertEqual(metrics.registry.phases['provision'].count, 1)
+        response = self.client.get('/lti/metrics')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('lti_provider_launch_phase_seconds_count'
+                      '{phase="verify"} 2', content)
+        self.assertIn('lti_provider_launch_outcomes_total'
+                      '{outcome="success"} 2', content)
+
+    def test_disabled(self):
+        with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+            self.launch(launch_data(self.consumer))
+            self.assertEqual(self.client.get('/lti/metrics').status_code,
+                             404)
+        self.assertEqual(metrics.registry.phases, {})
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=dict(LTI_PROVIDER, PREVALIDATION=True))
+class PrevalidationTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        prevalidation.prevalidation_stats.reset()
+
+    def assertRejected(self, data, reason):
+        with self.assertNumQueries(0):
+            response = self.client.post('/lti/launch', data)
+        self.assertRedirects(response, '/failed',
+                             fetch_redirect_response=False)
+        self.assertEqual(
+            prevalidation.prevalidation_stats.snapshot()[reason], 1)
+
+    def test_missing_parameter(self):
+        data = launch_data(self.consumer)
+        del data['resource_link_id']
+        self.assertRejected(data, 'missing_parameter')
+
+    def test_unsupported_signature_method(self):
+        data = launch_data(self.consumer)
+        data['oauth_signature_method'] = 'RSA-SHA1'
+        self.assertRejected(data, 'signature_method')
+
+    def test_hmac_sha512_without_prevalidation(self):
+        client = oauth1.Client(self.consumer.key,
+                               client_secret=self.consumer.secret,
+                               signature_method=SIGNATURE_HMAC_SHA512,
+                               signature_type=SIGNATURE_TYPE_BODY)
+        data = launch_data(self.consumer)
+        for name in list(data):
+            if name.startswith('oauth_'):
+                del data[name]
+        uri, headers, body = client.sign(
+            'http://testserver/lti/launch', 'POST', body=data,
+            headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertRejected(dict(parse_qsl(body)), 'signature_method')
+        with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+            response = self.client.post(
+                '/lti/launch', body,
+                content_type='application/x-www-form-urlencoded')
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    def test_timestamp_out_of_window(self):
+        data = launch_data(self.consumer)
+        data['oauth_timestamp'] = str(int(time.time()) - 3600)
+        self.assertRejected(data, 'timestamp')
+
+    def test_nonce_length(self):
+        data = launch_data(self.consumer)
+        data['oauth_nonce'] = 'abc'
+        self.assertRejected(data, 'nonce')
+
+    def test_unknown_key_is_rejected_with_dummy_signature(self):
+        unknown = Consumer(key='unknownkey0123456789',
+                           secret='unknownsecret0123456789')
+        self.client.post('/lti/launch', launch_data(unknown))
+        with mock.patch('lti_provider.prevalidation.verify_with_dummy_secret',
+                        wraps=prevalidation.verify_with_dummy_secret) as v:
+            self.assertRejected(launch_data(unknown), 'unknown_consumer')
+        v.assert_called_once()
+
+    def test_created_consumer_is_accepted(self):
+        unknown = Consumer(key='unknownkey0123456789',
+                           secret='unknownsecret0123456789',
+                           user=self.consumer.user)
+        self.client.post('/lti/launch', launch_data(unknown))
+        unknown.save()
+        response = self.client.post('/lti/launch', launch_data(unknown))
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    def test_valid_launch_passes(self):
+        request = RequestFactory().post('/lti/launch',
+                                        launch_data(self.consumer))
+        self.assertIsNone(prevalidation.prevalidate(request))
+
+    def test_unknown_keys_are_bounded(self):
+        cache = ConsumerCache()
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                             UNKNOWN_KEY_CACHE_SIZE=2)):
+            for key in ('unknown1', 'unknown2', 'unknown3'):
+                self.assertIsNone(cache.get(key))
+            self.assertFalse(cache.is_unknown('unknown1'))
+            self.assertTrue(cache.is_unknown('unknown3'))
+            self.assertFalse(cache.is_unknown(self.consumer.key))
+
+    def test_disabled_by_default(self):
+        data = launch_data(self.consumer)
+        del data['resource_link_id']
+        with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+            self.client.post('/lti/launch', data)
+        self.assertEqual(
+            sum(prevalidation.prevalidation_stats.snapshot().values()), 0)
+
+    def test_consumer_created_by_other_process_is_accepted(self):
+        unknown = Consumer(key='unknownkey0123456789',
+                           secret='unknownsecret0123456789',
+                           user=self.consumer.user)
+        self.client.post('/lti/launch', launch_data(unknown))
+        self.assertTrue(consumer_cache.is_unknown(unknown.key))
+        # another process saves the consumer, so the signal handler of
+        # this process only sees the changed generation in the cache
+        with mock.patch('lti_provider.signals.consumer_cache'):
+            unknown.save()
+        self.assertFalse(consumer_cache.is_unknown(unknown.key))
+        response = self.client.post('/lti/launch', launch_data(unknown))
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=dict(LTI_PROVIDER, REUSE_SESSION=True))
+class SessionReuseTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+
+    def launch(self, user_id='42', path='/lti/launch', **params):
+        return self.client.post(path, launch_data(
+            self.consumer, launch_url='http://testserver' + path,
+            user_id=user_id,
+            lis_person_contact_email_primary=user_id + '@example.com',
+            **params))
+
+    def session_user(self):
+        return int(self.client.session[SESSION_KEY])
+
+    def test_same_user_keeps_session(self):
+        self.launch()
+        key = self.client.session.session_key
+        session = self.client.session
+        session['marker'] = 'kept'
+        session.save()
+        response = self.launch()
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        self.assertEqual(self.client.session.session_key, key)
+        self.assertEqual(self.client.session['marker'], 'kept')
+
+    def test_same_user_rotates_session_without_setting(self):
+        self.launch()
+        key = self.client.session.session_key
+        with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+            self.launch()
+        self.assertNotEqual(self.client.session.session_key, key)
+
+    def test_other_user_gets_new_session(self):
+        self.launch('attacker')
+        attacker = self.session_user()
+        key = self.client.session.session_key
+        session = self.client.session
+        session['marker'] = 'planted'
+        session.save()
+        self.launch('victim')
+        self.assertNotEqual(self.client.session.session_key, key)
+        self.assertNotEqual(self.session_user(), attacker)
+        self.assertNotIn('marker', self.client.session)
+        self.assertFalse(SessionStore().exists(key))
+
+    def test_fixated_session_is_not_logged_in(self):
+        self.launch('attacker')
+        key = self.client.session.session_key
+        self.launch('victim')
+        victim = self.session_user()
+        fixated = SessionStore(session_key=key)
+        self.assertNotEqual(fixated.get(SESSION_KEY), str(victim))
+
+    def test_password_session_is_rotated(self):
+        self.launch()
+        user = User.objects.get(pk=self.session_user())
+        self.client.force_login(
+            user, backend='django.contrib.auth.backends.ModelBackend')
+        key = self.client.session.session_key
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY],
+                         'django.contrib.auth.backends.ModelBackend')
+        self.launch()
+        self.assertNotEqual(self.client.session.session_key, key)
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY],
+                         'lti_provider.backends.LTIAuthBackend')
+
+    def test_failed_launch_logs_out(self):
+        self.launch()
+        data = launch_data(self.consumer)
+        data['user_id'] = 'tampered'
+        response = self.client.post('/lti/launch', data)
+        self.assertRedirects(response, '/failed',
+                             fetch_redirect_response=False)
+        self.assertNotIn(SESSION_KEY, self.client.session)
+
+    def test_async_same_user_keeps_session(self):
+        self.launch(path='/lti/launch/async')
+        key = self.client.session.session_key
+        self.launch(path='/lti/launch/async')
+        self.assertEqual(self.client.session.session_key, key)
+        self.launch('other', path='/lti/launch/async')
+        self.assertNotEqual(self.client.session.session_key, key)
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER, MIDDLEWARE=MIDDLEWARE)
+class LaunchContextTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+
+    def test_from_tool_provider(self):
+        context = LaunchContext.from_tool_provider(tool_provider_for(
+            self.consumer, roles='Instructor,urn:lti:role:ims/lis/Mentor',
+            context_id='course-1', lis_result_sourcedid='result-1',
+            custom_page='intro'))
+        self.assertEqual(context.consumer_key, self.consumer.key)
+        self.assertEqual(context.user_id, '42')
+        self.assertEqual(context.roles,
+                         ('Instructor', 'urn:lti:role:ims/lis/Mentor'))
+        self.assertEqual(context.context_id, 'course-1')
+        self.assertEqual(context.resource_link_id, '1')
+        self.assertEqual(context.result_sourcedid, 'result-1')
+        self.assertIsNone(context.outcome_service_url)
+        self.assertEqual(context.custom, {'page': 'intro'})
+        self.assertEqual(LaunchContext.deserialize(context.serialize()),
+                         context)
+        with self.assertRaises(AttributeError):
+            context.other = 1
+
+    def test_empty_and_old_versions(self):
+        self.assertFalse(LaunchContext.deserialize(None))
+        self.assertFalse(LaunchContext.deserialize([0, 'key']))
+        self.assertEqual(LaunchContext().roles, ())
+
+    def test_launch_stores_context(self):
+        self.client.post('/lti/launch', launch_data(
+            self.consumer, context_id='course-1', roles='Learner'))
+        response = self.client.get('/context')
+        self.assertEqual(response.content, b'course-1 Learner')
+        request = RequestFactory().get('/')
+        request.session = self.client.session
+        self.assertEqual(get_launch_context(request).context_id, 'course-1')
+
+    def test_failed_launch_drops_context(self):
+        self.client.post('/lti/launch', launch_data(
+            self.consumer, context_id='course-1'))
+        data = launch_data(self.consumer)
+        data['user_id'] = 'tampered'
+        self.client.post('/lti/launch', data)
+        self.assertNotIn(LAUNCH_CONTEXT_SESSION_KEY, self.client.session)
+        self.assertEqual(self.client.get('/context').content, b'None ')
+
+    def test_reused_session_updates_context(self):
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                             REUSE_SESSION=True)):
+            self.client.post('/lti/launch', launch_data(
+                self.consumer, context_id='course-1'))
+            key = self.client.session.session_key
+            self.client.post('/lti/launch', launch_data(
+                self.consumer, context_id='course-2'))
+        self.assertEqual(self.client.session.session_key, key)
+        self.assertEqual(self.client.get('/context').content, b'course-2 ')
+
+    def test_context_is_loaded_lazily(self):
+        with mock.patch('lti_provider.middleware.get_launch_context') as get:
+            self.client.get('/')
+        get.assert_not_called()
+
+
+class OutcomeStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers replaceResult requests for the OutcomeStub.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status, code_major = self.server.stub.receive(self, body)
+        request = OutcomeRequest()
+        request.process_xml(body)
+        content = OutcomeResponse(
+            code_major=code_major, severity='status', description='stub',
+            message_identifier='1', operation='replaceResult',
+            message_ref_identifier=request.message_identifier,
+        ).generate_response_xml()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class OutcomeStub(object):
+    """
+    A local outcome service of a consumer which records the scores and
+    answers with the queued responses or success.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.responses = []
+        self.scores = []
+        self.connections = set()
+        self.active = {}
+        self.max_active = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          OutcomeStubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%d/outcomes' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01},
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def receive(self, handler, body):
+        key = re.search(r'oauth_consumer_key="([^"]+)"',
+                        handler.headers['Authorization']).group(1)
+        request = OutcomeRequest()
+        request.process_xml(body)
+        with self._lock:
+            self.connections.add(handler.client_address)
+            self.active[key] = self.active.get(key, 0) + 1
+            self.max_active[key] = max(self.max_active.get(key, 0),
+                                       self.active[key])
+            self.scores.append((str(request.lis_result_sourcedid),
+                                request.score))
+            response = self.responses.pop(0) if self.responses else \
+                (200, 'success')
+        time.sleep(self.delay)
+        with self._lock:
+            self.active[key] -= 1
+        return response
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER)
+class OutcomesTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        self.user = User.objects.create(username='student')
+        self.stub = OutcomeStub()
+        self.addCleanup(self.stub.stop)
+        self.result = self.create_result('1')
+
+    def create_result(self, resource_link_id):
+        return LTIResult.objects.create(
+            consumer=self.consumer, user=self.user,
+            resource_link_id=resource_link_id,
+            sourcedid='sourcedid-' + resource_link_id,
+            service_url=self.stub.url)
+
+    def worker(self, **settings):
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER, **settings)):
+            worker = OutcomeWorker()
+        self.addCleanup(worker.close)
+        return worker
+
+    def test_launch_records_result(self):
+        self.client.post('/lti/launch', launch_data(
+            self.consumer, lis_result_sourcedid='abc',
+            lis_outcome_service_url=self.stub.url))
+        result = LTIResult.objects.get(resource_link_id='1',
+                                       user__email='jane@example.com')
+        self.assertEqual(result.sourcedid, 'abc')
+        self.client.post('/lti/launch', launch_data(
+            self.consumer, lis_result_sourcedid='def',
+            lis_outcome_service_url=self.stub.url))
+        result.refresh_from_db()
+        self.assertEqual(result.sourcedid, 'def')
+        self.client.post('/lti/launch', launch_data(self.consumer,
+                                                    resource_link_id='2'))
+        self.assertFalse(LTIResult.objects.filter(
+            resource_link_id='2').exists())
+
+    def test_latest_score_is_sent(self):
+        for score in (0.2, 0.5, 0.9):
+            submit_score(self.result, score)
+        counts = self.worker().flush()
+        self.assertEqual(counts, {'sent': 1, 'coalesced': 2, 'retried': 0,
+                                  'failed': 0})
+        self.assertEqual(self.stub.scores, [('sourcedid-1', '0.9')])
+        self.assertEqual(
+            list(LTIScore.objects.order_by('pk').values_list(
+                'status', flat=True)),
+            [LTIScore.COALESCED, LTIScore.COALESCED, LTIScore.SENT])
+
+    def test_score_is_claimed_once(self):
+        submit_score(self.result, 0.5)
+        first, second = self.worker(), self.worker()
+        now = timezone.now()
+        stale = second.candidates(now)
+        self.assertEqual(len(first.claim(now)[0]), 1)
+        with mock.patch.object(second, 'candidates', return_value=stale):
+            self.assertEqual(second.claim(now), ([], 0))
+        self.assertEqual(first.flush(now + timedelta(seconds=1))['sent'], 0)
+
+    def test_retry_with_backoff(self):
+        self.stub.responses = [(500, 'failure')]
+        score = submit_score(self.result, 0.5)
+        worker = self.worker()
+        now = timezone.now()
+        with self.assertLogs('LTI.lti_provider', 'WARNING'):
+            self.assertEqual(worker.flush(now)['retried'], 1)
+        score.refresh_from_db()
+        self.assertEqual((score.status, score.attempts, score.error),
+                         (LTIScore.PENDING, 1, 'HTTP 500'))
+        self.assertEqual(score.next_attempt, now + timedelta(seconds=30))
+        self.assertEqual(worker.flush(now)['sent'], 0)
+        self.assertEqual(worker.flush(now + timedelta(seconds=30))['sent'],
+                         1)
+        self.assertEqual(len(self.stub.scores), 2)
+
+    def test_newer_score_replaces_retry(self):
+        self.stub.responses = [(503, 'failure')]
+        submit_score(self.result, 0.5)
+        worker = self.worker()
+        with self.assertLogs('LTI.lti_provider', 'WARNING'):
+            worker.flush()
+        submit_score(self.result, 0.7)
+        self.assertEqual(worker.flush()['coalesced'], 1)
+        self.assertEqual(self.stub.scores[-1], ('sourcedid-1', '0.7'))
+
+    def test_rejection_is_final(self):
+        self.stub.responses = [(200, 'failure')]
+        score = submit_score(self.result, 0.5)
+        with self.assertLogs('LTI.lti_provider', 'WARNING'):
+            self.assertEqual(self.worker().flush()['failed'], 1)
+        score.refresh_from_db()
+        self.assertEqual(score.status, LTIScore.FAILED)
+        self.assertEqual(score.error, 'failure: stub')
+
+    def test_max_attempts(self):
+        self.stub.responses = [(500, 'failure')]
+        score = submit_score(self.result, 0.5)
+        worker = self.worker(OUTCOMES_MAX_ATTEMPTS=1)
+        with self.assertLogs('LTI.lti_provider', 'WARNING'):
+            self.assertEqual(worker.flush()['failed'], 1)
+        score.refresh_from_db()
+        self.assertEqual(score.status, LTIScore.FAILED)
+
+    def test_unreachable_consumer_is_retried(self):
+        self.stub.stop()
+        submit_score(self.result, 0.5)
+        worker = self.worker(OUTCOMES_TIMEOUT=1)
+        with self.assertLogs('LTI.lti_provider', 'WARNING') as logs:
+            self.assertEqual(worker.flush()['retried'], 1)
+        self.assertIn('ConnectionError', logs.output[0])
+
+    def test_concurrency_per_consumer(self):
+        self.stub.delay = 0.05
+        results = [self.result] + [self.create_result(str(i))
+                                   for i in range(2, 9)]
+        submit_scores((result, 1.0) for result in results)
+        counts = self.worker(OUTCOMES_THREADS=8,
+                             OUTCOMES_CONCURRENCY=2).flush()
+        self.assertEqual(counts['sent'], 8)
+        self.assertLessEqual(self.stub.max_active[self.consumer.key], 2)
+
+    def test_connections_are_reused(self):
+        results = [self.result] + [self.create_result(str(i))
+                                   for i in range(2, 6)]
+        submit_scores((result, 1.0) for result in results)
+        self.assertEqual(self.worker(OUTCOMES_THREADS=1).flush()['sent'], 5)
+        self.assertEqual(len(self.stub.connections), 1)
+
+    def test_score_range(self):
+        with self.assertRaises(ValueError):
+            submit_score(self.result, 1.5)
+        with self.assertRaises(ValueError):
+            submit_scores([(self.result, -0.1)])
+
+    def test_command(self):
+        submit_score(self.result, 0.5)
+        out = StringIO()
+        call_command('flush_lti_outcomes', stdout=out)
+        self.assertIn('Sent 1, coalesced 0, retried 0 and failed 0',
+                      out.getvalue())
+
+
+class ConsumersCommandTest(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create(username='admin')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(os.path.join(self.tmp.name, path)) as f:
+            return f.read()
+
+    def import_file(self, path, **options):
+        out = StringIO()
+        err = StringIO()
+        call_command('lti_consumers', 'import', path, stdout=out,
+                     stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_csv(self):
+        path = self.write('consumers.csv', '\n'.join([
+            'key,secret,user',
+            'tenantkey000000000001,tenantsecret00000000001,admin',
+            ',,',
+            'short,tenantsecret00000000003,admin',
+            'tenantkey00000000000$,tenantsecret00000000004,admin',
+            'tenantkey000000000005,tenantsecret00000000005,nobody',
+            'tenantkey000000000001,tenantsecret00000000006,admin',
+        ]))
+        out, err = self.import_file(
+            path, user='admin',
+            output=os.path.join(self.tmp.name, 'created.csv'))
+        self.assertIn('Created 2 consumers, 4 rows failed.', out)
+        self.assertEqual(err.splitlines(), [
+            'line 4: key: 5 characters are too few. Min length: 20',
+            'line 5: key: tenantkey00000000000$ contains unsave characters.',
+            'line 6: unknown user nobody',
+            'line 7: key tenantkey000000000001 exists already',
+        ])
+        generated = Consumer.objects.exclude(key='tenantkey000000000001')
+        generated = generated.get()
+        self.assertEqual(len(generated.key), 30)
+        self.assertEqual(generated.user, self.admin)
+        self.assertIn('%s,%s,admin' % (generated.key, generated.secret),
+                      self.read('created.csv'))
+
+    def test_import_jsonl_in_chunks(self):
+        lines = [json.dumps({'key': 'tenantkey%012d' % i, 'user': 'admin'})
+                 for i in range(5)]
+        lines.insert(2, '{not json')
+        lines.append(json.dumps({'key': 'tenantkey%012d' % 0}))
+        path = self.write('consumers.jsonl', '\n'.join(lines))
+        errors = os.path.join(self.tmp.name, 'errors.txt')
+        out, _ = self.import_file(path, batch_size=2, errors=errors,
+                                  user='admin')
+        self.assertIn('Created 5 consumers, 2 rows failed.', out)
+        report = self.read('errors.txt').splitlines()
+        self.assertTrue(report[0].startswith('line 3: invalid JSON'))
+        self.assertEqual(report[1],
+                         'line 7: key tenantkey000000000000 exists already')
+
+    def test_import_queries_per_chunk(self):
+        def rows(n, offset):
+            return '\n'.join(['key,secret,user'] + [
+                'tenantkey%012d,,admin' % (offset + i) for i in range(n)])
+        small = self.write('small.csv', rows(5, 0))
+        large = self.write('large.csv', rows(150, 5))
+        with self.assertNumQueries(6):
+            self.import_file(small)
+        with self.assertNumQueries(6):
+            self.import_file(large)
+        self.assertEqual(Consumer.objects.count(), 155)
+
+    def test_export_and_import(self):
+        create_consumer()
+        for fmt in ('csv', 'jsonl'):
+            out = StringIO()
+            call_command('lti_consumers', 'export', format=fmt, stdout=out)
+            path = self.write('export.' + fmt, out.getvalue())
+            Consumer.objects.all().delete()
+            self.assertIn('Created 1 consumers',
+                          self.import_file(path)[0])
+            consumer = Consumer.objects.get()
+            self.assertEqual((consumer.key, consumer.secret),
+                             ('consumerkey0123456789',
+                              'consumersecret0123456789'))
+
+    def test_export_without_secrets(self):
+        create_consumer()
+        out = StringIO()
+        call_command('lti_consumers', 'export', format='jsonl',
+                     without_secrets=True, stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), {
+            'key': 'consumerkey0123456789', 'secret': '',
+            'user': 'admin_consumerkey0123456789'})
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests', CACHES=LOCMEM_CACHES,
+                   LTI_PROVIDER=dict(LTI_PROVIDER, RATE_LIMITING=True,
+                                     RATE_LIMIT=1, RATE_BURST=2))
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        caches['default'].clear()
+        ratelimit.rate_limiter.clear()
+        self.now = 1500000000.0
+        patcher = mock.patch.object(ratelimit.rate_limiter, '_clock',
+                                    lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def launch(self, consumer=None, path='/lti/launch'):
+        return self.client.post(path, launch_data(
+            consumer or self.consumer, launch_url='http://testserver' + path))
+
+    def assertLimited(self, response, retry_after):
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], retry_after)
+
+    def test_token_bucket(self):
+        limiter = ratelimit.rate_limiter
+        self.assertEqual(limiter.acquire('key', 2, 2), 0)
+        self.assertEqual(limiter.acquire('key', 2, 2), 0)
+        self.assertEqual(limiter.acquire('key', 2, 2), 0.5)
+        self.now += 0.25
+        self.assertEqual(limiter.acquire('key', 2, 2), 0.25)
+        self.now += 0.25
+        self.assertEqual(limiter.acquire('key', 2, 2), 0)
+        self.now += 60
+        self.assertEqual(limiter.acquire('key', 2, 2), 0)
+        self.assertEqual(limiter.acquire('key', 2, 2), 0)
+        self.assertEqual(limiter.acquire('other', 2, 2), 0)
+
+    def test_bucket_key_is_hashed(self):
+        limiter = ratelimit.rate_limiter
+        key = 'a key with spaces ' + 'x' * 300
+        self.assertEqual(limiter.acquire(key, 1, 1), 0)
+        self.assertEqual(limiter.acquire(key, 1, 1), 1)
+        self.assertTrue(ratelimit.bucket_key(key).isascii())
+        self.assertLess(len(ratelimit.bucket_key(key)), 250)
+
+    def test_rate_has_to_be_positive(self):
+        self.consumer.rate_limit = 0
+        self.assertEqual(ratelimit.consumer_limits(self.consumer), (1.0, 2))
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER, RATE_LIMIT=0)), \
+                self.assertRaises(ImproperlyConfigured):
+            ratelimit.consumer_limits(None)
+
+    def test_locked_bucket_is_limited(self):
+        cache = caches['default']
+        cache.add(ratelimit.bucket_key('key') + ':lock', 1)
+        with mock.patch.object(ratelimit, 'LOCK_WAIT', 0.01):
+            self.assertEqual(ratelimit.rate_limiter.acquire('key', 2, 2),
+                             0.5)
+        cache.delete(ratelimit.bucket_key('key') + ':lock')
+        self.assertEqual(ratelimit.rate_limiter.acquire('key', 2, 2), 0)
+
+    def test_concurrent_launches_are_counted_once(self):
+        barrier = threading.Barrier(16)
+        cache = caches['default']
+
+        class SlowCache(object):
+            """
+            Switches threads between the cache operations.
+            """
+
+            def __getattr__(self, name):
+                def call(*args, **kwargs):
+                    time.sleep(0.001)
+                    return getattr(cache, name)(*args, **kwargs)
+                return call
+
+        def acquire(i):
+            barrier.wait()
+            return ratelimit.rate_limiter.acquire('key', 1, 5)
+
+        with mock.patch.object(ratelimit.TokenBucketLimiter, 'cache',
+                               new_callable=mock.PropertyMock,
+                               return_value=SlowCache()), \
+                ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(acquire, range(16)))
+        self.assertEqual(results.count(0), 5)
+
+    def test_launch_is_limited_before_verification(self):
+        self.launch()
+        self.launch()
+        data = launch_data(self.consumer)
+        data['user_id'] = '43'
+        self.client.logout()
+        with self.assertNumQueries(0):
+            response = self.client.post('/lti/launch', data)
+        self.assertLimited(response, '1')
+        self.now += 1
+        self.assertEqual(self.launch().status_code, 302)
+
+    def test_limits_of_consumer(self):
+        self.consumer.rate_limit = 0.1
+        self.consumer.rate_burst = 1
+        self.consumer.save()
+        other = create_consumer(key='otherconsumerkey0123456789',
+                                secret='otherconsumersecret012345')
+        self.launch()
+        self.assertLimited(self.launch(), '10')
+        self.assertEqual(self.launch(other).status_code, 302)
+        self.assertEqual(self.launch(other).status_code, 302)
+        self.assertLimited(self.launch(other), '1')
+
+    def test_async_launch_is_limited(self):
+        self.launch(path='/lti/launch/async')
+        self.launch(path='/lti/launch/async')
+        self.assertLimited(self.launch(path='/lti/launch/async'), '1')
+
+    def test_cache_failure_limits_in_process(self):
+        cache = mock.Mock()
+        cache.add.side_effect = ConnectionError('cache down')
+        with mock.patch.object(ratelimit.TokenBucketLimiter, 'cache',
+                               new_callable=mock.PropertyMock,
+                               return_value=cache), \
+                self.assertLogs('LTI.lti_provider', 'WARNING'):
+            self.launch()
+            self.launch()
+            self.assertLimited(self.launch(), '1')
+
+    def test_disabled(self):
+        with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+            for i in range(3):
+                self.assertEqual(self.launch().status_code, 302)
+
+    def test_concurrent_launches_are_shed(self):
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                             MAX_CONCURRENT_LAUNCHES=1)):
+            self.assertTrue(ratelimit.launch_slots.acquire())
+            try:
+                with self.assertNumQueries(0):
+                    response = self.launch()
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response['Retry-After'], '1')
+            finally:
+                ratelimit.launch_slots.release()
+            self.assertEqual(self.launch().status_code, 302)
+        self.assertEqual(ratelimit.launch_slots.active, 0)
+
+
+@skipUnless('lti' in settings.DATABASES,
+            'needs a second database with the alias lti')
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   CACHES=LOCMEM_CACHES)
+class DatabaseRoutingTest(TestCase):
+    databases = {'default', 'lti'} & set(settings.DATABASES)
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        caches['default'].clear()
+        consumer_writes.reset()
+
+    def tearDown(self):
+        consumer_writes.reset()
+
+    def configure(self, **database):
+        return self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                               DATABASE=database))
+
+    def replicate(self, consumer):
+        """
+        Copies the consumer to the replica and forgets the change.
+        """
+        user = User.objects.using('lti').create(
+            pk=consumer.user_id, username=consumer.user.username)
+        Consumer.objects.using('lti').create(pk=consumer.pk,
+                                             key=consumer.key,
+                                             secret=consumer.secret,
+                                             user=user)
+        caches['default'].clear()
+        consumer_writes.reset()
+
+    def test_nonces_are_written_to_nonce_database(self):
+        data = launch_data(self.consumer)
+        with self.configure(NONCES='lti'):
+            self.client.post('/lti/launch', data)
+            self.assertEqual(
+                TimestampAndNonce.objects.using('lti').count(), 1)
+            self.assertFalse(TimestampAndNonce.objects.exists())
+            self.client.logout()
+            response = self.client.post('/lti/launch', data)
+        self.assertRedirects(response, '/failed',
+                             fetch_redirect_response=False)
+
+    def test_compact_store_and_purge_use_nonce_database(self):
+        now = int(time.time())
+        with self.configure(NONCES='lti'):
+            store = CompactNonceStore()
+            self.assertTrue(store.add(self.consumer, str(now), 'n1', 600))
+            self.assertFalse(store.add(self.consumer, str(now), 'n1', 600))
+            store.add(self.consumer, str(now - 1000), 'n2', 600)
+            call_command('purge_lti_nonces', stdout=StringIO())
+            self.assertEqual(NonceDigest.objects.using('lti').count(), 1)
+        self.assertFalse(NonceDigest.objects.exists())
+
+    def test_consumers_are_read_from_replica(self):
+        with self.configure(REPLICA='lti'):
+            self.replicate(self.consumer)
+            Consumer.objects.using('lti').filter(pk=self.consumer.pk).update(
+                secret='replicasecret0123456789')
+            consumer = consumer_cache.get(self.consumer.key)
+        self.assertEqual(consumer.secret, 'replicasecret0123456789')
+        self.assertEqual(consumer._state.db, 'lti')
+
+    def test_consumers_are_read_from_primary_after_change(self):
+        with self.configure(REPLICA='lti'):
+            self.replicate(self.consumer)
+            consumer = create_consumer(key='newconsumerkey0123456789',
+                                       secret='newconsumersecret0123456789')
+            # the replica did not catch up yet
+            self.assertEqual(
+                consumer_cache.get(consumer.key), consumer)
+            response = self.client.post('/lti/launch',
+                                        launch_data(consumer))
+            self.assertRedirects(response, '/',
+                                 fetch_redirect_response=False)
+            # another process only sees the shared marker
+            consumer_cache.clear()
+            consumer_writes.reset()
+            self.assertEqual(
+                consumer_cache.get(consumer.key), consumer)
+            consumer_cache.clear()
+            caches['default'].clear()
+            self.assertIsNone(consumer_cache.get(consumer.key))
+
+    def test_consumer_writes_expire_after_lag(self):
+        now = [100.0]
+        writes = ConsumerWrites(clock=lambda: now[0])
+        with self.configure(REPLICA='lti', REPLICA_LAG=5):
+            writes.mark()
+            caches['default'].clear()
+            now[0] += 4.9
+            self.assertTrue(writes.recent())
+            now[0] += 0.2
+            self.assertFalse(writes.recent())
+
+    def test_router(self):
+        router = LTIRouter()
+        with self.configure(NONCES='lti', REPLICA='lti'):
+            self.assertEqual(router.db_for_write(TimestampAndNonce), 'lti')
+            self.assertEqual(router.db_for_read(NonceDigest), 'lti')
+            self.assertEqual(router.db_for_read(Consumer), 'lti')
+            self.assertIsNone(router.db_for_write(Consumer))
+            self.assertIsNone(router.db_for_read(LTIIdentity))
+            consumer_writes.mark()
+            self.assertIsNone(router.db_for_read(Consumer))
+        self.assertEqual(router.db_for_write(TimestampAndNonce), 'default')
+        nonce = TimestampAndNonce(consumer=self.consumer, timestamp=1,
+                                  nonce='n')
+        self.assertTrue(router.allow_relation(nonce, self.consumer))
+        self.assertIsNone(router.allow_relation(self.consumer,
+                                                self.consumer.user))
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class SigningKey(object):
+    """
+    A RSA key which signs tokens with RS256 like a platform.
+    """
+
+    def __init__(self, kid, bits=2048):
+        self.kid = kid
+        self.private = rsa.generate_private_key(public_exponent=65537,
+                                                key_size=bits)
+        self.public = self.private.public_key()
+
+    def jwk(self):
+        return dict(json.loads(RSAAlgorithm.to_jwk(self.public)),
+                    use='sig', alg='RS256', kid=self.kid)
+
+    def sign(self, claims, kid=None, alg='RS256'):
+        key = self.private if alg == 'RS256' else \
+            None if alg == 'none' else 'secret' * 6
+        return jwt.encode(claims, key, algorithm=alg,
+                          headers={'kid': kid or self.kid})
+
+
+SIGNING_KEYS = {}
+
+
+def signing_key(kid, seed=0):
+    """
+    Returns a cached SigningKey, as generating it takes a while. Keys of
+    different seeds differ.
+    """
+    if (kid, seed) not in SIGNING_KEYS:
+        SIGNING_KEYS[(kid, seed)] = SigningKey(kid)
+    return SIGNING_KEYS[(kid, seed)]
+
+
+class KeySetStubHandler(BaseHTTPRequestHandler):
+    """
+    Serves the JWKS of the KeySetStub.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, content = self.server.stub.receive()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeySetStub(object):
+    """
+    A local JWKS endpoint of a platform which counts its requests.
+    """
+
+    def __init__(self, keys, delay=0.0):
+        self.keys = keys
+        self.delay = delay
+        self.status = 200
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          KeySetStubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%d/jwks' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01},
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def receive(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.delay)
+        return self.status, json.dumps(
+            {'keys': [key.jwk() for key in self.keys]}).encode()
+
+
+@skipUnless(jwt, 'needs the lti13 extra')
+class TokenTest(TestCase):
+
+    def setUp(self):
+        self.key = signing_key('k1')
+        self.public = load_jwk(self.key.jwk())
+
+    def test_verify(self):
+        token = self.key.sign({'sub': '42'})
+        self.assertEqual(verify_token(token, {'k1': self.public}.get),
+                         {'sub': '42'})
+
+    def test_rejected_tokens(self):
+        other = signing_key('k1', seed=1)
+        token = self.key.sign({'sub': '42'})
+        header, claims, signature = token.split('.')
+        forged = '.'.join([header, b64url(b'{"sub": "43"}'), signature])
+        for token in (other.sign({'sub': '42'}), forged,
+                      self.key.sign({'sub': '42'}, alg='HS256'),
+                      self.key.sign({'sub': '42'}, alg='none'),
+                      self.key.sign({'sub': '42'}, kid='k2'),
+                      header + '.' + claims, 'a.b.c'):
+            with self.assertRaises(TokenError):
+                verify_token(token, {'k1': self.public}.get)
+
+    def test_short_keys_are_rejected(self):
+        with self.assertRaises(TokenError):
+            load_jwk(SigningKey('k1', bits=1024).jwk())
+        with self.assertRaises(TokenError):
+            load_jwk({'kty': 'RSA', 'n': 'AQAB'})
+
+
+@skipUnless(jwt, 'needs the lti13 extra')
+class KeySetCacheTest(TestCase):
+
+    def setUp(self):
+        self.stub = KeySetStub([signing_key('k1')])
+        self.addCleanup(self.stub.stop)
+        self.now = 1000.0
+        self.cache = KeySetCache(clock=lambda: self.now)
+
+    def test_keys_are_cached_by_kid(self):
+        key = self.cache.get(self.stub.url, 'k1')
+        self.assertEqual(key.public_numbers(),
+                         signing_key('k1').public.public_numbers())
+        self.assertIs(self.cache.get(self.stub.url, 'k1'), key)
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_expired_keys_are_refreshed_in_background(self):
+        key = self.cache.get(self.stub.url, 'k1')
+        self.now += 3600
+        self.stub.delay = 0.1
+        self.assertIs(self.cache.get(self.stub.url, 'k1'), key)
+        self.assertEqual(self.cache.fetched, 1)
+        for i in range(100):
+            if self.cache.fetched == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.cache.fetched, 2)
+        self.assertEqual(self.stub.requests, 2)
+
+    def test_concurrent_misses_fetch_once(self):
+        self.stub.delay = 0.1
+        keys = []
+        threads = [threading.Thread(target=lambda: keys.append(
+            self.cache.get(self.stub.url, 'k1'))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(len(set(id(key) for key in keys)), 1)
+
+    def test_unknown_kid_is_refetched_rarely(self):
+        self.assertIsNone(self.cache.get(self.stub.url, 'k2'))
+        self.assertIsNone(self.cache.get(self.stub.url, 'k2'))
+        self.assertEqual(self.stub.requests, 1)
+        self.stub.keys = [signing_key('k1'), signing_key('k2', seed=1)]
+        self.now += 10
+        self.assertEqual(
+            self.cache.get(self.stub.url, 'k2').public_numbers(),
+            signing_key('k2', seed=1).public.public_numbers())
+        self.assertEqual(self.stub.requests, 2)
+
+    def test_invalid_kid_is_rejected(self):
+        for kid in (None, 1, ['k1'], {'k1': 1}):
+            with self.assertRaises(TokenError):
+                self.cache.get(self.stub.url, kid)
+        self.assertEqual(self.stub.requests, 0)
+
+    def test_failed_fetch_keeps_keys(self):
+        url = self.stub.url
+        self.cache.get(url, 'k1')
+        self.stub.status = 500
+        with self.assertLogs('LTI.lti_provider', 'WARNING'):
+            self.cache._fetch(url, threading.Event())
+        self.assertIsNotNone(self.cache.get(url, 'k1'))
+        self.assertEqual(self.cache.fetched, 1)
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests', CACHES=LOCMEM_CACHES,
+                   LTI_PROVIDER=LTI_PROVIDER, MIDDLEWARE=MIDDLEWARE)
+@skipUnless(jwt, 'needs the lti13 extra')
+class Lti13LaunchTest(TestCase):
+
+    def setUp(self):
+        self.key = signing_key('k1')
+        self.stub = KeySetStub([self.key])
+        self.addCleanup(self.stub.stop)
+        caches['default'].clear()
+        key_set_cache.clear()
+        self.consumer = create_consumer()
+        self.platform = Platform.objects.create(
+            issuer='https://lms.example.com', client_id='tool',
+            deployment_id='d1',
+            auth_login_url='https://lms.example.com/auth?x=1',
+            key_set_url=self.stub.url, consumer=self.consumer)
+
+    def login(self):
+        response = self.client.get('/lti/lti13/login', {
+            'iss': 'https://lms.example.com', 'login_hint': 'hint',
+            'target_link_uri': 'http://testserver/',
+            'lti_message_hint': 'message'})
+        self.assertEqual(response.status_code, 302)
+        url = urlparse(response['Location'])
+        query = dict((name, values[0]) for name, values in
+                     parse_qs(url.query).items())
+        return url, query
+
+    def claims(self, login_nonce, **claims):
+        now = int(time.time())
+        values = {
+            'iss': 'https://lms.example.com', 'aud': 'tool',
+            'sub': '42', 'iat': now, 'exp': now + 300, 'nonce': login_nonce,
+            'email': 'jane@example.com', 'given_name': 'Jane',
+            CLAIM + 'deployment_id': 'd1',
+            CLAIM + 'message_type': 'LtiResourceLinkRequest',
+            CLAIM + 'version': '1.3.0',
+            CLAIM + 'roles': [
+                'http://purl.imsglobal.org/vocab/lis/v2/membership#Learner'],
+            CLAIM + 'context': {'id': 'c1', 'title': 'Course'},
+            CLAIM + 'resource_link': {'id': 'r1'},
+        }
+        values.update(claims)
+        return values
+
+    def launch(self, token=None, **claims):
+        url, query = self.login()
+        if token is None:
+            token = self.key.sign(self.claims(query['nonce'], **claims))
+        return self.client.post('/lti/lti13/launch', {
+            'id_token': token, 'state': query['state']})
+
+    def assertFailed(self, response):
+        self.assertRedirects(response, '/failed',
+                             fetch_redirect_response=False)
+
+    def test_login_redirects_to_platform(self):
+        url, query = self.login()
+        self.assertEqual((url.netloc, url.path),
+                         ('lms.example.com', '/auth'))
+        self.assertEqual(query['x'], '1')
+        self.assertEqual(query['client_id'], 'tool')
+        self.assertEqual(query['redirect_uri'],
+                         'http://testserver/lti/lti13/launch')
+        self.assertEqual(query['lti_message_hint'], 'message')
+        self.assertEqual(query['response_mode'], 'form_post')
+
+    def test_login_of_unknown_platform(self):
+        response = self.client.get('/lti/lti13/login', {
+            'iss': 'https://other.example.com', 'login_hint': 'hint',
+            'target_link_uri': 'http://testserver/'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_launch_provisions_user_of_consumer(self):
+        response = self.launch(**{CLAIM + 'custom': {'page': 'intro'}})
+        self.assertRedirects(response, '/page/intro',
+                             fetch_redirect_response=False)
+        identity = LTIIdentity.objects.select_related('user').get()
+        self.assertEqual(identity.consumer, self.consumer)
+        self.assertEqual(identity.user.email, 'jane@example.com')
+        self.assertEqual(self.client.get('/context').content,
+                         b'c1 http://purl.imsglobal.org/vocab/lis/v2/'
+                         b'membership#Learner')
+
+    def test_same_user_as_lti11_launch(self):
+        self.client.post('/lti/launch', launch_data(self.consumer,
+                                                    user_id='42'))
+        self.client.logout()
+        self.launch()
+        self.assertEqual(User.objects.filter(
+            lti_identities__isnull=False).count(), 1)
+
+    def test_keys_are_fetched_once(self):
+        self.launch()
+        self.client.logout()
+        self.assertRedirects(self.launch(), '/',
+                             fetch_redirect_response=False)
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_state_is_used_once(self):
+        url, query = self.login()
+        data = {'id_token': self.key.sign(self.claims(query['nonce'])),
+                'state': query['state']}
+        self.client.post('/lti/lti13/launch', data)
+        self.client.logout()
+        self.assertFailed(self.client.post('/lti/lti13/launch', data))
+
+    def test_state_is_bound_to_browser(self):
+        url, query = self.login()
+        name = 'lti13_state_' + query['state']
+        cookie = self.client.cookies[name]
+        self.assertEqual(cookie['path'], '/lti/lti13/launch')
+        self.assertTrue(cookie['httponly'])
+        data = {'id_token': self.key.sign(self.claims(query['nonce'])),
+                'state': query['state']}
+        self.assertFailed(Client().post('/lti/lti13/launch', data))
+        other = Client()
+        other.cookies[name] = 'other'
+        self.assertFailed(other.post('/lti/lti13/launch', data))
+        self.assertFalse(LTIIdentity.objects.exists())
+        response = self.client.post('/lti/lti13/launch', data)
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        self.assertEqual(response.cookies[name].value, '')
+
+    def test_invalid_tokens_are_rejected(self):
+        now = int(time.time())
+        self.assertFailed(self.launch(
+            token=signing_key('k1', seed=1).sign({'sub': '42'})))
+        self.assertFailed(self.launch(nonce='other'))
+        self.assertFailed(self.launch(aud=['tool', 'other']))
+        self.assertFailed(self.launch(aud='other'))
+        self.assertFailed(self.launch(iss='https://other.example.com'))
+        self.assertFailed(self.launch(exp=now - 120))
+        self.assertFailed(self.launch(**{CLAIM + 'deployment_id': 'd2'}))
+        self.assertFailed(self.launch(
+            **{CLAIM + 'message_type': 'LtiDeepLinkingRequest'}))
+        header = b64url(json.dumps({'alg': 'RS256', 'kid': ['k1']}).encode())
+        token = self.key.sign({'sub': '42'}).split('.', 1)[1]
+        self.assertFailed(self.launch(token=header + '.' + token))
+        self.assertFalse(LTIIdentity.objects.exists())
+        self.assertRedirects(self.launch(aud=['tool', 'other'], azp='tool'),
+                             '/', fetch_redirect_response=False)
+
+
+class MembershipStubHandler(BaseHTTPRequestHandler):
+    """
+    Serves the pages of the MembershipStub.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, content, link = self.server.stub.receive(self)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if link:
+            self.send_header('Link', '<%s>; rel="next"' % link)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class MembershipStub(object):
+    """
+    A local membership service of a consumer which serves the members in
+    pages of the LTI 1.1 or the NRPS format and records the consumer keys
+    of the requests.
+    """
+
+    def __init__(self, members, page_size=2, nrps=False):
+        self.members = members
+        self.page_size = page_size
+        self.nrps = nrps
+        self.status = 200
+        self.keys = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          MembershipStubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%d/members' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01},
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def receive(self, handler):
+        self.keys.append(re.search(r'oauth_consumer_key="([^"]+)"',
+                                   handler.headers['Authorization']).group(1))
+        page = int(parse_qs(urlparse(handler.path).query).get(
+            'page', ['0'])[0])
+        start = page * self.page_size
+        members = self.members[start:start + self.page_size]
+        next_page = None
+        if start + self.page_size < len(self.members):
+            next_page = '%s?page=%d' % (self.url, page + 1)
+        if self.nrps:
+            data = {'members': [
+                {'user_id': m['userId'], 'email': m.get('email'),
+                 'given_name': m.get('givenName'),
+                 'family_name': m.get('familyName'),
+                 'status': m.get('status', 'Active'),
+                 'roles': ['Learner']} for m in members]}
+            return self.status, json.dumps(data).encode(), next_page
+        data = {'pageOf': {'membershipSubject': {'membership': [
+            {'member': m, 'status': 'liss:' + m.get('status', 'Active'),
+             'role': ['Learner']} for m in members]}},
+            'nextPage': next_page}
+        return self.status, json.dumps(data).encode(), None
+
+
+def roster_member(n, **attributes):
+    """
+    Returns a member of the MembershipStub.
+    """
+    member = {'userId': 'u%d' % n, 'email': 'user%d@example.com' % n,
+              'givenName': 'Given%d' % n, 'familyName': 'Family%d' % n}
+    member.update(attributes)
+    return member
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=LTI_PROVIDER)
+class RosterTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        hooked_users.clear()
+
+    def sync(self, members, batch_size=3, **kwargs):
+        stub = MembershipStub(members, **kwargs)
+        self.addCleanup(stub.stop)
+        counts = RosterSync(self.consumer, batch_size).sync(stub.url)
+        return stub, counts
+
+    def test_parse_page(self):
+        members, next_page = parse_page({'members': [
+            {'user_id': 1, 'email': 'a@example.com', 'status': 'Active'},
+            {'user_id': 2, 'email': 'b@example.com', 'status': 'Inactive'},
+        ]})
+        self.assertEqual(members, [{
+            'user_id': '1', 'lis_person_contact_email_primary':
+            'a@example.com'}])
+        self.assertIsNone(next_page)
+
+    def test_malformed_pages(self):
+        for data in ([], 'members', None, {'members': ['a']},
+                     {'pageOf': []}):
+            with self.assertRaises(RosterError):
+                parse_page(data)
+
+    def test_sync_creates_users_in_chunks(self):
+        members = [roster_member(n) for n in range(7)]
+        stub, counts = self.sync(members)
+        self.assertEqual(stub.keys, [self.consumer.key] * 4)
+        self.assertEqual(counts['created'], 7)
+        user = LTIIdentity.objects.select_related('user').get(
+            uid_hash=sha1(b'u3').hexdigest()).user
+        self.assertEqual((user.email, user.first_name, user.last_name),
+                         ('user3@example.com', 'Given3', 'Family3'))
+        self.assertFalse(user.has_usable_password())
+
+    def test_sync_of_nrps_format(self):
+        members = [roster_member(n) for n in range(5)]
+        members[1]['status'] = 'Inactive'
+        del members[2]['email']
+        stub, counts = self.sync(members, nrps=True)
+        self.assertEqual(len(stub.keys), 3)
+        self.assertEqual((counts['created'], counts['skipped']), (3, 1))
+        self.assertEqual(LTIIdentity.objects.count(), 3)
+
+    def test_sync_updates_changed_users(self):
+        self.sync([roster_member(n) for n in range(4)])
+        members = [roster_member(n) for n in range(4)]
+        members[0]['familyName'] = 'Married'
+        with self.assertNumQueries(2):
+            stub, counts = self.sync(members, batch_size=10, page_size=10)
+        self.assertEqual((counts['updated'], counts['unchanged']), (1, 3))
+        self.assertEqual(User.objects.get(email='user0@example.com')
+                         .last_name, 'Married')
+
+    def test_sync_links_existing_users(self):
+        self.client.post('/lti/launch', launch_data(
+            self.consumer, user_id='u1',
+            lis_person_contact_email_primary='user1@example.com'))
+        LTIIdentity.objects.all().delete()
+        stub, counts = self.sync([roster_member(n) for n in range(3)])
+        self.assertEqual((counts['created'], counts['linked']), (2, 1))
+        self.assertEqual(User.objects.filter(
+            lti_identities__isnull=False).count(), 3)
+
+    def test_sync_updates_linked_users(self):
+        self.client.post('/lti/launch', launch_data(
+            self.consumer, user_id='u1',
+            lis_person_contact_email_primary='old@example.com'))
+        LTIIdentity.objects.all().delete()
+        self.sync([roster_member(1)])
+        user = LTIIdentity.objects.select_related('user').get().user
+        self.assertEqual((user.email, user.first_name, user.last_name),
+                         ('user1@example.com', 'Given1', 'Family1'))
+
+    def test_launch_after_sync_uses_user(self):
+        self.sync([roster_member(n) for n in range(2)])
+        self.client.post('/lti/launch', launch_data(
+            self.consumer, user_id='u1',
+            lis_person_contact_email_primary='user1@example.com'))
+        self.assertEqual(User.objects.filter(
+            lti_identities__isnull=False).count(), 2)
+
+    def test_hook_runs_for_created_users(self):
+        with self.settings(LTI_PROVIDER=dict(
+                LTI_PROVIDER,
+                HOOK_AFTER_USER_CREATION='lti_provider.tests.record_hook')):
+            self.sync([roster_member(n) for n in range(3)])
+            self.sync([roster_member(n) for n in range(4)])
+        self.assertEqual(len(hooked_users), 4)
+
+    def test_failed_request(self):
+        stub = MembershipStub([roster_member(1)])
+        self.addCleanup(stub.stop)
+        stub.status = 401
+        with self.assertRaises(RosterError):
+            RosterSync(self.consumer).sync(stub.url)
+
+    def test_command(self):
+        stub = MembershipStub([roster_member(n) for n in range(3)])
+        self.addCleanup(stub.stop)
+        out = StringIO()
+        call_command('sync_lti_roster', self.consumer.key, stub.url,
+                     '--batch-size', '2', stdout=out)
+        self.assertIn('3 created', out.getvalue())
+
+
+ROLE_GROUPS = {
+    'Instructor': 'teachers',
+    'urn:lti:role:ims/lis/TeachingAssistant': ['teachers', 'assistants'],
+    'Learner': 'students',
+}
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests',
+                   LTI_PROVIDER=dict(LTI_PROVIDER, ROLE_GROUPS=ROLE_GROUPS))
+class RoleGroupsTest(TestCase):
+
+    def setUp(self):
+        self.consumer = create_consumer()
+        group_cache.clear()
+
+    def launch(self, roles):
+        self.client.logout()
+        self.client.post('/lti/launch', launch_data(self.consumer,
+                                                    roles=roles))
+        return User.objects.get(lti_identities__isnull=False)
+
+    def group_names(self, user):
+        return sorted(user.groups.values_list('name', flat=True))
+
+    def test_normalize_role(self):
+        for role in ('Instructor', ' urn:lti:role:ims/lis/Instructor',
+                     'http://purl.imsglobal.org/vocab/lis/v2/'
+                     'membership#Instructor'):
+            self.assertEqual(normalize_role(role), 'Instructor')
+        for role in ('urn:lti:role:ims/lis/Instructor/TeachingAssistant',
+                     'http://purl.imsglobal.org/vocab/lis/v2/'
+                     'membership/Instructor#TeachingAssistant'):
+            self.assertEqual(normalize_role(role), 'TeachingAssistant')
+
+    def test_other_namespaces_stay_distinct(self):
+        for role in ('urn:lti:instrole:ims/lis/Instructor',
+                     'urn:lti:sysrole:ims/lis/Administrator',
+                     'http://purl.imsglobal.org/vocab/lis/v2/'
+                     'institution/person#Instructor',
+                     'http://purl.imsglobal.org/vocab/lis/v2/'
+                     'system/person#Administrator',
+                     'http://purl.imsglobal.org/vocab/lis/v2/'
+                     'person#Instructor'):
+            self.assertEqual(normalize_role(role), role)
+
+    def test_institution_roles_are_not_context_roles(self):
+        user = self.launch('urn:lti:instrole:ims/lis/Instructor,'
+                           'http://purl.imsglobal.org/vocab/lis/v2/'
+                           'institution/person#Instructor')
+        self.assertEqual(self.group_names(user), [])
+        mapping = dict(ROLE_GROUPS, **{
+            'urn:lti:instrole:ims/lis/Instructor': 'staff'})
+        with self.settings(LTI_PROVIDER=dict(LTI_PROVIDER,
+                                             ROLE_GROUPS=mapping)):
+            user = self.launch('urn:lti:instrole:ims/lis/Instructor')
+        self.assertEqual(self.group_names(user), ['staff'])
+
+    def test_groups_follow_roles(self):
+        user = self.launch('urn:lti:role:ims/lis/Learner')
+        self.assertEqual(self.group_names(user), ['students'])
+        user = self.launch('Instructor,urn:lti:role:ims/lis/Mentor')
+        self.assertEqual(self.group_names(user), ['teachers'])
+        user = self.launch('TeachingAssistant')
+        self.assertEqual(self.group_names(user), ['assistants', 'teachers'])
+        self.assertEqual(Group.objects.count(), 3)
+
+    def test_other_groups_are_kept(self):
+        user = self.launch('Learner')
+        user.groups.add(Group.objects.create(name='staff'))
+        user = self.launch('Instructor')
+        self.assertEqual(self.group_names(user), ['staff', 'teachers'])
+
+    def test_unchanged_roles_write_nothing(self):
+        user = self.launch('Instructor')
+        group_cache.group_ids(['Instructor'])
+        tool_provider = tool_provider_for(self.consumer, roles='Instructor')
+        # the nonce (in a savepoint) and the identity
+        with self.assertNumQueries(4):
+            self.assertEqual(LTIAuthBackend().authenticate(
+                None, tool_provider=tool_provider), user)
+
+    async def test_async_launch(self):
+        url = 'http://testserver/lti/launch/async'
+        await self.async_client.post('/lti/launch/async', launch_data(
+            self.consumer, launch_url=url, roles='Instructor'))
+        user = await User.objects.aget(lti_identities__isnull=False)
+        self.assertEqual([group.name async for group in user.groups.all()],
+                         ['teachers'])
+
+    def test_lti13_roles(self):
+        user = self.launch(
+            'http://purl.imsglobal.org/vocab/lis/v2/membership#Learner')
+        self.assertEqual(self.group_names(user), ['students'])
+
+    def test_permissions_of_groups(self):
+        Group.objects.create(name='teachers').permissions.add(
+            Permission.objects.get(codename='change_consumer'))
+        user = self.launch('Learner')
+        self.assertFalse(user.has_perm('lti_provider.change_consumer'))
+        user = self.launch('Instructor')
+        self.assertTrue(user.has_perm('lti_provider.change_consumer'))
+
+    def test_disabled_without_mapping(self):
+        with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+            user = self.launch('Instructor')
+        self.assertEqual(self.group_names(user), [])
+        self.assertEqual(LTIIdentity.objects.get().role_groups, '')
+
+
+@override_settings(ROOT_URLCONF='lti_provider.tests', CACHES=LOCMEM_CACHES,
+                   LTI_PROVIDER=dict(LTI_PROVIDER, USER_CACHING=True))
+class UserCacheTest(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username='cached')
+        self.backend = LTIAuthBackend()
+
+    def test_user_is_cached(self):
+        self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user.username, 'cached')
+
+    def test_saved_user_is_reloaded(self):
+        self.backend.get_user(self.user.pk)
+        self.user.first_name = 'Jane'
+        self.user.save()
+        with self.assertNumQueries(1):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user.first_name, 'Jane')
+
+    def test_deleted_user_is_not_returned(self):
+        self.backend.get_user(self.user.pk)
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_user_loaded_during_change_is_ignored(self):
+        def load(user_id):
+            user = User.objects.get(pk=user_id)
+            # another request saves the user after it was read
+            User.objects.get(pk=user_id).save()
+            return user
+
+        usercache.user_cache.get(self.user.pk, load)
+        with self.assertNumQueries(1):
+            self.backend.get_user(self.user.pk)
+
+    def test_update_needs_invalidation(self):
+        self.backend.get_user(self.user.pk)
+        users = User.objects.filter(pk=self.user.pk)
+        users.update(is_active=False)
+        self.assertTrue(self.backend.get_user(self.user.pk).is_active)
+        usercache.user_cache.invalidate_many([self.user.pk])
+        self.assertFalse(self.backend.get_user(self.user.pk).is_active)
+
+    def test_request_memo(self):
+        usercache.start_request()
+        self.addCleanup(usercache.finish_request)
+        user = self.backend.get_user(self.user.pk)
+        self.assertIs(self.backend.get_user(self.user.pk), user)
+        user.save()
+        self.assertIsNot(self.backend.get_user(self.user.pk), user)
+
+    def test_disabled(self):
+        with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+            self.backend.get_user(self.user.pk)
+            with self.assertNumQueries(1):
+                self.backend.get_user(self.user.pk)
+
+    def test_request_signals_depend_on_setting(self):
+        with mock.patch.object(usercache, 'start_request') as start, \
+                mock.patch.object(usercache, 'finish_request') as finish:
+            with self.settings(LTI_PROVIDER=LTI_PROVIDER):
+                self.client.get('/lti/launch')
+            self.assertFalse(start.called or finish.called)
+            self.client.get('/lti/launch')
+            self.assertTrue(start.called and finish.called)
+
+    def test_launch_updates_cached_user(self):
+        consumer = create_consumer()
+        self.client.post('/lti/launch', launch_data(consumer))
+        user = User.objects.get(lti_identities__isnull=False)
+        self.backend.get_user(user.pk)
+        self.client.post('/lti/launch', launch_data(
+            consumer, lis_person_name_given='Janet'))
+        self.assertEqual(self.backend.get_user(user.pk).first_name, 'Janet')
+
+    def test_roster_sync_updates_cached_user(self):
+        consumer = create_consumer()
+        stub = MembershipStub([roster_member(1)])
+        self.addCleanup(stub.stop)
+        RosterSync(consumer).sync(stub.url)
+        user = User.objects.get(lti_identities__isnull=False)
+        self.backend.get_user(user.pk)
+        stub.members = [roster_member(1, givenName='Changed')]
+        RosterSync(consumer).sync(stub.url)
+        self.assertEqual(self.backend.get_user(user.pk).first_name,
+                         'Changed')
+
+    def test_page_view_benchmark(self):
+        benchmark = PageViewBenchmark(self.user)
+        uncached = benchmark.run(False, 3)
+        cached = benchmark.run(True, 3)
+        # the session and twice the user, the session only
+        self.assertEqual((uncached['queries'], cached['queries']), (3, 1))
@@ -0,0 +1,113 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module verifies the JSON Web Tokens of LTI 1.3 launches with PyJWT
+and cryptography, which are installed by the lti13 extra. The platforms
+sign their tokens with RS256 (RSASSA-PKCS1-v1_5 with SHA-256). Other
+algorithms, including none and the HMAC algorithms, are rejected.
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import jwt
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
+    from jwt.algorithms import RSAAlgorithm
+except ImportError:
+    jwt = None
+
+# keys with a shorter modulus are rejected
+MIN_KEY_BITS = 2048
+
+# the claims are checked by lti13.check_claims with a configured leeway
+DECODE_OPTIONS = {
+    'verify_signature': True,
+    'verify_exp': False,
+    'verify_nbf': False,
+    'verify_iat': False,
+    'verify_aud': False,
+    'verify_iss': False,
+}
+
+
+class TokenError(ValueError):
+    """
+    Raised if a token is malformed or its signature is invalid.
+    """
+
+
+def require_jwt():
+    """
+    Raises ImproperlyConfigured if PyJWT or cryptography is missing.
+    """
+    if jwt is None:
+        raise ImproperlyConfigured(
+            'LTI 1.3 requires the lti13 extra: '
+            'pip install django-lti-provider-auth[lti13]')
+
+
+def load_jwk(jwk):
+    """
+    Returns the RSA public key of a JWK (a dictionary with kty RSA, n and
+    e) with a modulus of at least MIN_KEY_BITS bits.
+
+    Keyword arguments:
+        - jwk -- the decoded JWK
+    """
+    require_jwt()
+    if not isinstance(jwk, dict) or jwk.get('kty') != 'RSA':
+        raise TokenError('not a RSA key')
+    try:
+        key = RSAAlgorithm.from_jwk(jwk)
+    except (jwt.InvalidKeyError, ValueError, TypeError, KeyError):
+        raise TokenError('invalid RSA key')
+    if not isinstance(key, RSAPublicKey) or key.key_size < MIN_KEY_BITS:
+        raise TokenError('unsupported RSA key')
+    return key
+
+
+def verify_token(token, get_key):
+    """
+    Returns the claims of a token signed with RS256 by a known key. The
+    time, issuer and audience claims are not checked.
+
+    Keyword arguments:
+        - token -- the token string
+        - get_key -- callable returning the public key of a kid or None
+    """
+    require_jwt()
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.InvalidTokenError:
+        raise TokenError('malformed token')
+    if header.get('alg') != 'RS256':
+        raise TokenError('unsupported algorithm')
+    key = get_key(header.get('kid'))
+    if key is None:
+        raise TokenError('unknown key')
+    try:
+        return jwt.decode(token, key, algorithms=['RS256'],
+                          options=DECODE_OPTIONS)
+    except jwt.InvalidSignatureError:
+        raise TokenError('invalid signature')
+    except jwt.InvalidTokenError:
+        raise TokenError('malformed token')
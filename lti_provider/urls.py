@@ -24,7 +24,8 @@ This module designs the urls of the lti_provider App.
 """
 
 from django.urls import re_path
-from lti_provider.views import tool_config, lti_launch
+from lti_provider.views import tool_config, lti_launch, lti_launch_async, \
+    lti13_launch, lti13_login, metrics
 
 
 urlpatterns = [
@@ -32,4 +33,12 @@ urlpatterns = [
         tool_config, name='lti_provider.views.tool_config'),
     re_path(r'^launch$',
         lti_launch, name='lti_provider.views.lti_launch'),
+    re_path(r'^launch/async$',
+        lti_launch_async, name='lti_provider.views.lti_launch_async'),
+    re_path(r'^lti13/login$',
+        lti13_login, name='lti_provider.views.lti13_login'),
+    re_path(r'^lti13/launch$',
+        lti13_launch, name='lti_provider.views.lti13_launch'),
+    re_path(r'^metrics$',
+        metrics, name='lti_provider.views.metrics'),
 ]
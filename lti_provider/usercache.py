@@ -0,0 +1,157 @@
+
+# Copyright (c) 2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module provides the user cache of LTIAuthBackend.get_user, which is
+called for every request of a logged in user. If USER_CACHING is enabled,
+the users are stored in the cache named by USER_CACHE and memoized for the
+rest of a request, so a page view needs no query for its user.
+"""
+
+import uuid
+from contextvars import ContextVar
+
+from django.core.cache import caches
+
+from lti_provider.utils import get_setting
+
+USER_KEY = 'lti_provider:user:%s'
+
+USER_VERSION_KEY = 'lti_provider:user_version:%s'
+
+# the users loaded by the current request or None outside of a request
+_request_users = ContextVar('lti_provider_request_users', default=None)
+
+
+def enabled():
+    """
+    Returns true if USER_CACHING is enabled (default: false).
+    """
+    return get_setting('USER_CACHING', False)
+
+
+def start_request():
+    """
+    Starts the memo of the users loaded by the current request.
+    """
+    _request_users.set({})
+
+
+def finish_request():
+    """
+    Drops the memo of the users loaded by the current request.
+    """
+    _request_users.set(None)
+
+
+class UserCache(object):
+    """
+    Caches users by their primary key. A cached user is stored with the
+    version of the user, a random token under its own key which is replaced
+    whenever the user is saved or deleted. An entry of an older version is
+    ignored, so a user loaded by a request while it was changed by another
+    one is never returned afterwards. Both keys expire after
+    USER_CACHE_TIMEOUT seconds (default: 60).
+
+    Changes which send no post_save, e.g. QuerySet.update, are not noticed,
+    so a deactivated user or a changed password is only seen after the
+    timeout unless the users are passed to invalidate_many.
+    """
+
+    @property
+    def cache(self):
+        """
+        Returns the cache of the users (USER_CACHE, default: 'default').
+        """
+        return caches[get_setting('USER_CACHE', 'default')]
+
+    @property
+    def timeout(self):
+        """
+        Returns the seconds a user is cached.
+        """
+        return get_setting('USER_CACHE_TIMEOUT', 60)
+
+    def get(self, user_id, load):
+        """
+        Returns the user with the given primary key from the memo of the
+        request, the cache or by calling load, which raises DoesNotExist for
+        users that do not exist.
+
+        Keyword arguments:
+            - user_id -- the primary key of the user
+            - load -- callable returning the user of a primary key
+        """
+        memo = _request_users.get()
+        if memo is not None and user_id in memo:
+            return memo[user_id]
+        cache = self.cache
+        key, version_key = USER_KEY % user_id, USER_VERSION_KEY % user_id
+        entries = cache.get_many([key, version_key])
+        version = entries.get(version_key)
+        entry = entries.get(key)
+        if version is not None and entry is not None and \
+                entry[0] == version:
+            user = entry[1]
+        else:
+            if version is None:
+                cache.add(version_key, uuid.uuid4().hex, self.timeout)
+                version = cache.get(version_key)
+            user = load(user_id)
+            if version is not None:
+                cache.set(key, (version, user), self.timeout)
+        if memo is not None:
+            memo[user_id] = user
+        return user
+
+    def invalidate(self, user_id):
+        """
+        Replaces the version of a user, so its cached entry is ignored, and
+        drops it from the memo of the request.
+
+        Keyword arguments:
+            - user_id -- the primary key of the user
+        """
+        memo = _request_users.get()
+        if memo is not None:
+            memo.pop(user_id, None)
+        self.cache.set(USER_VERSION_KEY % user_id, uuid.uuid4().hex,
+                       self.timeout)
+
+    def invalidate_many(self, user_ids):
+        """
+        Invalidates several users with one cache request, e.g. after
+        QuerySet.update or bulk_update, which send no post_save.
+
+        Keyword arguments:
+            - user_ids -- iterable of primary keys of users
+        """
+        user_ids = list(user_ids)
+        memo = _request_users.get()
+        if memo is not None:
+            for user_id in user_ids:
+                memo.pop(user_id, None)
+        self.cache.set_many(
+            dict((USER_VERSION_KEY % user_id, uuid.uuid4().hex)
+                 for user_id in user_ids), self.timeout)
+
+
+user_cache = UserCache()
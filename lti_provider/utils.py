@@ -23,10 +23,23 @@
 This module provides some helper functions for the LTI Provider.
 """
 
+from django.conf import settings
 from django.urls import reverse
 from django.core.exceptions import ImproperlyConfigured
 
 
+def get_setting(name, default=None):
+    """
+    Returns an optional entry of the LTI_PROVIDER setting or the given
+    default if it is not configured.
+
+    Keyword arguments:
+        name -- key in the LTI_PROVIDER setting
+        default -- value returned if the key is missing
+    """
+    return getattr(settings, 'LTI_PROVIDER', {}).get(name, default)
+
+
 def get_by_py_path(py_path):
     """
     Imports and returns a python callable.
@@ -24,19 +24,51 @@ This module provides validators for the LTI request of the lti_provider-App.
 """
 
 import logging
+import time
 from oauthlib.oauth1 import RequestValidator
-from lti_provider.models import Consumer, TimestampAndNonce
+from lti_provider.cache import consumer_cache
+from lti_provider.nonces import get_nonce_store
+from lti_provider.utils import get_setting
 
 # Get an instance of a logger
 logger = logging.getLogger('LTI.lti_provider')
 
+# secret used to verify the signature of requests of unknown consumers
+DUMMY_CLIENT_SECRET = 'dummy_client_sec_123456'
+
 
 class LTIValidator(RequestValidator):
     """
     This validator implements the RequestValidator from the oauthlib.
     It implements only the methods required for a LTI request.
+
+    The oauthlib checks the nonce before the signature. With defer_nonce
+    the nonce is only checked for its timestamp and consumer by the
+    oauthlib and has to be recorded by record_nonce after the request was
+    verified, so requests with a bad signature write nothing.
     """
 
+    def __init__(self, defer_nonce=False):
+        """
+        Keyword arguments:
+            - defer_nonce -- flag if the nonce is recorded by record_nonce
+        """
+        super().__init__()
+        self.failure = None
+        self.nonce_checked = False
+        self.defer_nonce = defer_nonce
+        self.pending_nonce = None
+
+    def failure_reason(self):
+        """
+        Returns the reason why a request was rejected: 'invalid_request' if
+        the oauthlib rejected it before the nonce was checked, 'replay',
+        'unknown_consumer' or 'bad_signature'.
+        """
+        if self.failure:
+            return self.failure
+        return 'bad_signature' if self.nonce_checked else 'invalid_request'
+
     @property
     def enforce_ssl(self):
         """
@@ -45,6 +77,14 @@ class LTIValidator(RequestValidator):
         logger.debug('called')
         return False
 
+    @property
+    def timestamp_lifetime(self):
+        """
+        Returns the seconds a timestamp may differ from the current time
+        (TIMESTAMP_LIFETIME, default: 600).
+        """
+        return get_setting('TIMESTAMP_LIFETIME', 600)
+
     @property
     def nonce_length(self):
         """
@@ -69,11 +109,10 @@ class LTIValidator(RequestValidator):
             - request -- calling request
         """
         logger.debug('called')
-        try:
-            c = Consumer.objects.get(key=client_key)
-            return str(c.secret)
-        except Consumer.DoesNotExist:
-            return 'dummy_client_sec_123456'
+        c = consumer_cache.get(client_key)
+        if c is None:
+            return DUMMY_CLIENT_SECRET
+        return str(c.secret)
 
     def validate_client_key(self, client_key, request):
         """
@@ -84,14 +123,10 @@ class LTIValidator(RequestValidator):
             - request -- calling request
         """
         logger.debug('called')
-        try:
-            n = Consumer.objects.filter(key=client_key).count()
-            if n > 0:
-                return True
-            else:
-                return False
-        except Consumer.DoesNotExist:
+        if consumer_cache.get(client_key) is None:
+            self.failure = self.failure or 'unknown_consumer'
             return False
+        return True
 
     def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
                                      request, request_token=None,
@@ -109,21 +144,115 @@ class LTIValidator(RequestValidator):
             - access_token -- unused for LTI
         """
         logger.debug('called')
-        tn = TimestampAndNonce.objects.filter(
-            consumer__key=client_key,
-            timestamp=timestamp,
-            nonce=nonce).count()
-        if tn > 0:
+        self.nonce_checked = True
+        if not self.check_timestamp(timestamp):
+            self.failure = 'invalid_request'
             return False
-        else:
-            try:
-                c = Consumer.objects.get(key=client_key)
-            except Consumer.DoesNotExist:
-                logger.debug('wrong consumer key')
-                return False
-            t = TimestampAndNonce(
-                consumer=c,
-                timestamp=timestamp,
-                nonce=nonce)
-            t.save()
+        c = consumer_cache.get(client_key)
+        if c is None:
+            logger.debug('wrong consumer key')
+            self.failure = 'unknown_consumer'
+            return False
+        if self.defer_nonce:
+            self.pending_nonce = (c, timestamp, nonce)
             return True
+        if not get_nonce_store().add(c, timestamp, nonce,
+                                     self.timestamp_lifetime):
+            self.failure = 'replay'
+            return False
+        return True
+
+    def record_nonce(self):
+        """
+        Records the deferred nonce of a verified request. Returns false if
+        the request is a replay.
+        """
+        if self.pending_nonce is None:
+            return False
+        if not get_nonce_store().add(*self.pending_nonce,
+                                     self.timestamp_lifetime):
+            self.failure = 'replay'
+            return False
+        return True
+
+    async def arecord_nonce(self):
+        """
+        Async version of record_nonce.
+        """
+        if self.pending_nonce is None:
+            return False
+        if not await get_nonce_store().aadd(*self.pending_nonce,
+                                            self.timestamp_lifetime):
+            self.failure = 'replay'
+            return False
+        return True
+
+    def check_timestamp(self, timestamp):
+        """
+        Returns true if the timestamp is within the accepted window.
+
+        Keyword arguments:
+            - timestamp -- the timestamp to check
+        """
+        try:
+            if abs(time.time() - int(timestamp)) > self.timestamp_lifetime:
+                logger.debug('timestamp out of window')
+                return False
+        except (TypeError, ValueError):
+            logger.debug('invalid timestamp')
+            return False
+        return True
+
+
+class AsyncLTIValidator(LTIValidator):
+    """
+    This validator is used by the async launch. The consumer is loaded by
+    aprepare with the async ORM before the signature is verified, so the
+    methods called by the oauthlib do not access the database. The nonce is
+    recorded by arecord_nonce after the request was verified.
+    """
+
+    def __init__(self):
+        super().__init__(defer_nonce=True)
+        self.client_key = None
+        self.consumer = None
+
+    async def aprepare(self, client_key, timestamp, nonce):
+        """
+        Loads the consumer of a request.
+
+        Keyword arguments:
+            - client_key -- the key of the consumer
+            - timestamp -- the timestamp of the request
+            - nonce -- the nonce of the request
+        """
+        logger.debug('called')
+        self.client_key = client_key
+        if not client_key or not nonce or not self.check_timestamp(timestamp):
+            self.failure = 'invalid_request'
+            return
+        self.consumer = await consumer_cache.aget(client_key)
+        if self.consumer is None:
+            logger.debug('wrong consumer key')
+            self.failure = 'unknown_consumer'
+
+    def get_client_secret(self, client_key, request):
+        logger.debug('called')
+        if self.consumer is None or client_key != self.client_key:
+            return DUMMY_CLIENT_SECRET
+        return str(self.consumer.secret)
+
+    def validate_client_key(self, client_key, request):
+        logger.debug('called')
+        return self.consumer is not None and client_key == self.client_key
+
+    def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
+                                     request, request_token=None,
+                                     access_token=None):
+        logger.debug('called')
+        self.nonce_checked = True
+        if self.failure or client_key != self.client_key or \
+                not self.check_timestamp(timestamp):
+            return False
+        self.pending_nonce = (self.consumer, timestamp, nonce)
+        return True
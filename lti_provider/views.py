@@ -25,45 +25,72 @@ This module provides the views of the lti_provider.
 
 
 import logging
-from lti import ToolConfig
+from asgiref.sync import sync_to_async
 from lti.contrib.django import DjangoToolProvider
-from django.http import HttpResponse, HttpResponseBadRequest, \
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, \
     HttpResponseRedirect
-from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
-from django.contrib.auth import authenticate, login, logout
+from django.views.decorators.http import condition, require_http_methods, \
+    require_POST
+from django.contrib.auth import BACKEND_SESSION_KEY, authenticate, login, \
+    logout
+from django.core.exceptions import PermissionDenied
 from django.conf import settings
+from django.urls import reverse
+
+from lti_provider.backends import LTIAuthBackend
+from lti_provider.cache import consumer_cache, tool_config_cache
+from lti_provider.context import store_launch_context
+from lti_provider.lti13 import STATE_COOKIE, LaunchError, \
+    login_redirect_url, set_state_cookie, verify_launch
+from lti_provider.metrics import measure, outcome, registry
+from lti_provider.metrics import enabled as metrics_enabled
+from lti_provider.prevalidation import prevalidate
+from lti_provider.prevalidation import enabled as prevalidation_enabled
+from lti_provider.ratelimit import consumer_limits, launch_slots, \
+    rate_limiter, retry_after_header
+from lti_provider.ratelimit import enabled as ratelimit_enabled
+from lti_provider.redirects import get_redirect_table
+from lti_provider.utils import get_setting, reverse_from_settings
 
-from lti_provider.utils import reverse_from_settings
+LTI_AUTH_BACKEND = 'lti_provider.backends.LTIAuthBackend'
 
 # Get an instance of a logger
 logger = logging.getLogger('LTI.lti_provider')
 
 
+def tool_config_etag(request):
+    """
+    Returns the ETag of the tool configuration for a request.
+    """
+    return tool_config_cache.get(request).etag
+
+
+def tool_config_last_modified(request):
+    """
+    Returns the modification time of the tool configuration for a request.
+    """
+    return tool_config_cache.get(request).last_modified
+
+
 @csrf_exempt
+@condition(etag_func=tool_config_etag,
+           last_modified_func=tool_config_last_modified)
 def tool_config(request):
     """
     This view returns a xml file with information about the LTI provider.
+    The xml is cached per host and conditional requests are answered with
+    304 Not Modified without generating it.
 
     Decorators:
         - csrf_exempt -- disable csrf protection
+        - condition -- handle ETag and Last-Modified
 
     Keyword arguments:
         - request -- calling HttpRequest
     """
-    app_title = settings.LTI_PROVIDER['TITLE']
-    app_description = settings.LTI_PROVIDER['DESCRIPTION']
-    launch_url = request.build_absolute_uri(
-        reverse('lti_provider.views.lti_launch'))
-
-    lti_tool_config = ToolConfig(
-        title=app_title,
-        launch_url=launch_url,
-        secure_launch_url=launch_url,
-        description=app_description
-    )
-
-    return HttpResponse(lti_tool_config.to_xml(), content_type='text/xml')
+    return HttpResponse(tool_config_cache.get(request).xml,
+                        content_type='text/xml')
 
 
 @csrf_exempt
@@ -78,37 +105,378 @@ def lti_launch(request):
     Keyword arguments:
         - request -- calling HttpRequest
     """
-    if request.user.is_authenticated:
-        logout(request)
+    if not launch_slots.acquire():
+        return launch_shed()
+    try:
+        with measure('launch'):
+            return _lti_launch(request)
+    finally:
+        launch_slots.release()
+
+
+def _lti_launch(request, authenticate_request=None):
+    """
+    Implements lti_launch and lti13_launch, measured as a whole by them. If
+    REUSE_SESSION is enabled the current user is logged out after the
+    authentication, so a relaunch of the same user could keep the session.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+        - authenticate_request -- function like authenticate_launch
+    """
+    reuse = reuse_session_enabled()
+    if not reuse:
+        with measure('logout'):
+            if request.user.is_authenticated:
+                logout(request)
+
+    authenticate_request = authenticate_request or authenticate_launch
+    user, tool_provider, response = authenticate_request(request)
+    if user is None:
+        if reuse:
+            with measure('logout'):
+                switch_user(request, None)
+        return response
+    with measure('login'):
+        switch_user(request, user, tool_provider)
+    outcome('success')
+    with measure('redirect'):
+        return redirect_to_destination(tool_provider)
+
+
+def authenticate_launch(request):
+    """
+    Returns a tuple of the active user, the tool provider and None for a
+    valid launch or None, None and the response for a rejected launch.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    failed = settings.LTI_PROVIDER['FAILED_VIEW']
+    if prevalidation_failed(request):
+        return None, None, HttpResponseRedirect(reverse_from_settings(failed))
+    response = rate_limited(request)
+    if response is not None:
+        return None, None, response
 
     try:
-        tool_provider = DjangoToolProvider.from_django_request(request=request)
+        with measure('parse'):
+            tool_provider = DjangoToolProvider.from_django_request(
+                request=request)
     except:
-        return HttpResponseBadRequest('wrong config')
+        outcome('bad_config')
+        return None, None, HttpResponseBadRequest('wrong config')
 
     user = authenticate(request=request, tool_provider=tool_provider)
+    if user is not None and not user.is_active:
+        outcome('inactive_user')
+        user = None
+    if user is None:
+        return None, None, HttpResponseRedirect(reverse_from_settings(failed))
+    return user, tool_provider, None
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def lti13_login(request):
+    """
+    This is the OIDC login initiation of a LTI 1.3 platform. It redirects
+    to the authorization endpoint of the platform, which posts the id_token
+    to lti13_launch, and binds the login to the browser by a cookie.
+
+    Decorators:
+        - csrf_exempt -- disable csrf protection
+        - require_http_methods -- allow GET and POST
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    path = reverse('lti_provider.views.lti13_launch')
+    try:
+        url, name, browser = login_redirect_url(
+            params, request.build_absolute_uri(path))
+    except LaunchError as e:
+        logger.debug('LTI 1.3 login rejected: %s', e)
+        return HttpResponseBadRequest(str(e))
+    response = HttpResponseRedirect(url)
+    set_state_cookie(response, request, name, browser, path)
+    return response
+
+
+@csrf_exempt
+@require_POST
+def lti13_launch(request):
+    """
+    This is the entry point of LTI 1.3 launches. The id_token is verified
+    and the user is authenticated and redirected like by lti_launch.
+
+    Decorators:
+        - csrf_exempt -- disable csrf protection
+        - require_POST -- the platform posts the id_token
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    if not launch_slots.acquire():
+        return launch_shed()
+    try:
+        with measure('launch'):
+            response = _lti_launch(request, authenticate_platform_launch)
+    finally:
+        launch_slots.release()
+    name = STATE_COOKIE % request.POST.get('state', '')
+    if name in request.COOKIES:
+        response.delete_cookie(
+            name, path=request.path,
+            samesite='None' if request.is_secure() else 'Lax')
+    return response
+
+
+def authenticate_platform_launch(request):
+    """
+    Returns a tuple of the active user, the tool provider and None for a
+    valid LTI 1.3 launch or None, None and the response for a rejected
+    launch.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
     failed = settings.LTI_PROVIDER['FAILED_VIEW']
-    if user is not None:
-        if user.is_active:
-            login(request, user)
-            ps = settings.LTI_PROVIDER['PARAMETERS_TO_VIEW']
-            for p in ps:
-                ok = True
-                ap = {}
-                for pn in p[0]:
-                    gp = tool_provider.get_custom_param(pn)
-                    ap[pn] = gp
-                    if not gp:
-                        ok = False
-                if ok:
-                    try:
-                        return HttpResponseRedirect(reverse(
-                            p[1], kwargs=ap))
-                    except:
-                        pass
-            default = settings.LTI_PROVIDER['DEFAULT_VIEW']
-            return HttpResponseRedirect(reverse_from_settings(default))
-        else:
-            return HttpResponseRedirect(reverse_from_settings(failed))
+    try:
+        with measure('verify'):
+            launch = verify_launch(request)
+    except LaunchError as e:
+        logger.debug('LTI 1.3 launch rejected: %s', e)
+        outcome(e.reason)
+        return None, None, HttpResponseRedirect(reverse_from_settings(failed))
+
+    user = authenticate(request=request, launch=launch)
+    if user is not None and not user.is_active:
+        outcome('inactive_user')
+        user = None
+    if user is None:
+        return None, None, HttpResponseRedirect(reverse_from_settings(failed))
+    return user, launch.tool_provider, None
+
+
+async def lti_launch_async(request):
+    """
+    This is the async version of lti_launch for ASGI deployments. The
+    consumer, the nonce and the user are handled with the async ORM. The
+    session is written by login and logout which are only available
+    synchronously in Django 4.2, so they run in a single thread hop.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    if not launch_slots.acquire():
+        return launch_shed()
+    try:
+        with measure('launch'):
+            return await _lti_launch_async(request)
+    finally:
+        launch_slots.release()
+
+
+async def _lti_launch_async(request):
+    """
+    Implements lti_launch_async, measured as a whole by lti_launch_async.
+    """
+    failed = settings.LTI_PROVIDER['FAILED_VIEW']
+    if prevalidation_failed(request):
+        await sync_to_async(switch_user)(request, None)
+        return HttpResponseRedirect(reverse_from_settings(failed))
+    response = await arate_limited(request)
+    if response is not None:
+        await sync_to_async(switch_user)(request, None)
+        return response
+
+    try:
+        with measure('parse'):
+            tool_provider = DjangoToolProvider.from_django_request(
+                request=request)
+    except:
+        outcome('bad_config')
+        await sync_to_async(switch_user)(request, None)
+        return HttpResponseBadRequest('wrong config')
+
+    try:
+        user = await LTIAuthBackend().aauthenticate(
+            request, tool_provider=tool_provider)
+    except PermissionDenied:
+        user = None
+    if user is not None and user.is_active:
+        user.backend = LTI_AUTH_BACKEND
+        with measure('login'):
+            await sync_to_async(switch_user)(request, user, tool_provider)
+        outcome('success')
+        with measure('redirect'):
+            return redirect_to_destination(tool_provider)
     else:
+        if user is not None:
+            outcome('inactive_user')
+        await sync_to_async(switch_user)(request, None)
         return HttpResponseRedirect(reverse_from_settings(failed))
+
+
+# csrf_exempt of Django 4.2 wraps views in a sync function
+lti_launch_async.csrf_exempt = True
+
+
+def prevalidation_failed(request):
+    """
+    Returns true if PREVALIDATION is enabled and the launch is rejected by
+    the pre-validation. The rejection is sent as outcome unknown_consumer or
+    invalid_request.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    if not prevalidation_enabled():
+        return False
+    with measure('prevalidate'):
+        reason = prevalidate(request)
+    if reason is None:
+        return False
+    if reason == 'unknown_consumer':
+        outcome('unknown_consumer')
+    else:
+        outcome('invalid_request')
+    return True
+
+
+def rate_limited(request):
+    """
+    Returns a 429 response if RATE_LIMITING is enabled and the consumer of
+    the launch exceeded its rate limit or None otherwise. The limit is
+    checked before the signature, with the consumer from the cache.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    key = request.POST.get('oauth_consumer_key')
+    if not ratelimit_enabled() or not key:
+        return None
+    with measure('ratelimit'):
+        rate, burst = consumer_limits(consumer_cache.get(key))
+        retry_after = rate_limiter.acquire(key, rate, burst)
+    if not retry_after:
+        return None
+    return too_many_launches(retry_after)
+
+
+async def arate_limited(request):
+    """
+    Async version of rate_limited.
+    """
+    key = request.POST.get('oauth_consumer_key')
+    if not ratelimit_enabled() or not key:
+        return None
+    with measure('ratelimit'):
+        rate, burst = consumer_limits(await consumer_cache.aget(key))
+        retry_after = await rate_limiter.aacquire(key, rate, burst)
+    if not retry_after:
+        return None
+    return too_many_launches(retry_after)
+
+
+def too_many_launches(retry_after):
+    """
+    Returns the 429 response of a rate limited launch and sends the outcome
+    rate_limited.
+
+    Keyword arguments:
+        - retry_after -- seconds until the next launch is accepted
+    """
+    outcome('rate_limited')
+    response = HttpResponse('too many launches', status=429,
+                            content_type='text/plain')
+    response['Retry-After'] = retry_after_header(retry_after)
+    return response
+
+
+def launch_shed():
+    """
+    Returns the 503 response of a launch beyond MAX_CONCURRENT_LAUNCHES and
+    sends the outcome shed.
+    """
+    outcome('shed')
+    response = HttpResponse('too many concurrent launches', status=503,
+                            content_type='text/plain')
+    response['Retry-After'] = retry_after_header(1)
+    return response
+
+
+def reuse_session_enabled():
+    """
+    Returns true if REUSE_SESSION is enabled (default: false).
+    """
+    return get_setting('REUSE_SESSION', False)
+
+
+def owns_session(request, user):
+    """
+    Returns true if REUSE_SESSION is enabled and the user is already logged
+    in to the session by a launch.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+        - user -- the authenticated user of the launch
+    """
+    return (reuse_session_enabled() and
+            request.user.is_authenticated and
+            request.user.pk == user.pk and
+            request.session.get(BACKEND_SESSION_KEY) == LTI_AUTH_BACKEND)
+
+
+def switch_user(request, user, tool_provider=None):
+    """
+    Logs out the current user and logs in the given user if it is not None.
+    The session is kept without a flush and a new key if the user already
+    owns it (see owns_session); any other user gets a new session. The
+    context of the launch is stored in the session of the user.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+        - user -- the user to log in or None
+        - tool_provider -- the LTI tool provider instance of the launch
+    """
+    if user is None or not owns_session(request, user):
+        if request.user.is_authenticated:
+            logout(request)
+        if user is not None:
+            login(request, user)
+    else:
+        logger.debug('session reused')
+    if user is not None and tool_provider is not None:
+        store_launch_context(request, tool_provider)
+
+
+def redirect_to_destination(tool_provider):
+    """
+    Returns a redirect to the first view of PARAMETERS_TO_VIEW whose
+    parameters are sent with the request or to the DEFAULT_VIEW.
+
+    Keyword arguments:
+        - tool_provider -- the LTI tool provider instance
+    """
+    url = get_redirect_table().resolve(tool_provider)
+    if url is not None:
+        return HttpResponseRedirect(url)
+    default = settings.LTI_PROVIDER['DEFAULT_VIEW']
+    return HttpResponseRedirect(reverse_from_settings(default))
+
+
+def metrics(request):
+    """
+    This view returns the launch metrics in the Prometheus text format. It
+    only exists if METRICS is enabled.
+
+    Keyword arguments:
+        - request -- calling HttpRequest
+    """
+    if not metrics_enabled():
+        raise Http404
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4')
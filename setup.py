@@ -18,6 +18,9 @@ setuptools.setup(
        'lti>=0.9.2',
        'django>=4.2.0,<4.3'
     ],
+    extras_require={
+       'lti13': ['PyJWT[crypto]>=2.4'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Framework :: Django",